@@ -18,8 +18,11 @@ from mypl_token import TokenType, Token
 from mypl_ast_parser import ASTParser
 from mypl_printer import PrintVisitor
 from mypl_semantic_checker import SemanticChecker
-from mypl_code_gen import CodeGenerator
-from mypl_vm import VM
+from mypl_code_gen import code_generator
+from mypl_vm import VM, ENGINES, GC_MODES, GC_GROWTH, GC_THRESHOLD, GC_STEP_INTERVAL, GC_STEP_BUDGET
+from mypl_vm import parse_heap_limit
+from mypl_jit import JIT_THRESHOLD
+from mypl_debug import TraceSink, parse_pc_range
 
 
 def run_lex_mode(in_stream):
@@ -104,13 +107,15 @@ def run_check_mode(in_stream):
 
 
     
-def run_ir_mode(in_stream):
+def run_ir_mode(in_stream, engine='table', **vm_options):
     """Generates the intermediate representation (VM instructions) for the
     given mypl program and prints to standard output the resulting
-    instructions.
+    instructions (the generated Python source for the py engine).
 
     Args: 
         in_stream -- A wrapped input stream containing a mypl program.
+        engine -- The VM execution engine to generate code for.
+        vm_options -- Additional VM constructor options.
 
     """
     try: 
@@ -119,8 +124,8 @@ def run_ir_mode(in_stream):
         ast = parser.parse()
         visitor = SemanticChecker()
         ast.accept(visitor)
-        vm = VM()
-        codegen = CodeGenerator(vm)
+        vm = VM(engine=engine, **vm_options)
+        codegen = code_generator(vm)
         ast.accept(codegen)
         print(vm)
     except MyPLError as ex:
@@ -128,27 +133,54 @@ def run_ir_mode(in_stream):
         exit(1)
 
     
-def run_normal_mode(in_stream):
+def run_normal_mode(in_stream, engine='table', fuse_report=False, trace=None,
+                    gc_stats=False, heap_snapshot=None, **vm_options):
     """Executes the given mypl program. Any output produced by the program
     is printed to standard output. 
 
     Args: 
         in_stream -- A wrapped input stream containing a mypl program.
+        engine -- The VM execution engine to run the program with.
+        fuse_report -- If True, the superinstructions created are
+                       summarized on standard error after the run.
+                       (The longest incremental gc pause is also
+                       reported there for the incremental collector.)
+        trace -- An optional TraceSink to trace instructions to.
+        gc_stats -- If True, garbage collection statistics and a pause
+                    histogram are printed to standard error after the
+                    run (also if it ends in an error).
+        heap_snapshot -- If given, the file a heap snapshot is written to
+                         after the run, also if it ends in an error (as
+                         DOT for a .dot file name, and as JSON otherwise).
+        vm_options -- Additional VM constructor options.
 
     """
+    vm = None
     try: 
         lexer = Lexer(in_stream)
         parser = ASTParser(lexer)
         ast = parser.parse()
         visitor = SemanticChecker()
         ast.accept(visitor)
-        vm = VM()
-        codegen = CodeGenerator(vm)
+        vm = VM(engine=engine, **vm_options)
+        codegen = code_generator(vm)
         ast.accept(codegen)
-        vm.run()
+        vm.run(trace=trace)
+        if fuse_report:
+            print(vm.fusion_report(), file=sys.stderr)
+        if vm.gc == 'incremental':
+            print(f'max gc pause: {vm.max_gc_pause * 1000:.3f} ms '
+                  f'(step budget: {vm.gc_step_budget} objects)', file=sys.stderr)
     except MyPLError as ex:
         print(ex)
         exit(1)
+    finally:
+        # also reported when the run ends in an error (e.g., out of memory)
+        if vm is not None and gc_stats:
+            print(vm.gc_history.report(), file=sys.stderr)
+        if vm is not None and heap_snapshot:
+            with open(heap_snapshot, 'w', encoding='utf-8') as out:
+                vm.heap_snapshot(out, 'dot' if heap_snapshot.endswith('.dot') else 'json')
 
 
     
@@ -170,9 +202,45 @@ if __name__ == '__main__':
     group.add_argument('--check', action='store_true', help=help_msg)
     help_msg = 'displays intermediate code'
     group.add_argument('--ir', action='store_true', help=help_msg)
+    help_msg = 'VM execution engine (default: table)'
+    argparser.add_argument('--engine', choices=ENGINES, default='table', help=help_msg)
+    help_msg = 'trace and compile hot loops (table engine)'
+    argparser.add_argument('--jit', action='store_true', help=help_msg)
+    help_msg = 'fuse common instruction sequences into superinstructions'
+    argparser.add_argument('--fuse', action='store_true', help=help_msg)
+    help_msg = 'keep the fields of structs that do not escape their function in locals'
+    argparser.add_argument('--scalar-replace', action='store_true', help=help_msg)
+    help_msg = 'fuse and report the superinstructions created (on stderr)'
+    argparser.add_argument('--fuse-report', action='store_true', help=help_msg)
+    help_msg = 'garbage collector (default: marksweep)'
+    argparser.add_argument('--gc', choices=GC_MODES, default='marksweep', help=help_msg)
+    help_msg = 'collect garbage once allocations find this many heap objects'
+    argparser.add_argument('--gc-threshold', type=int, help=help_msg)
+    help_msg = (f'heap growth factor between collections (default: {GC_GROWTH}); '
+                f'without --gc-threshold, the first collection is at {GC_THRESHOLD} objects')
+    argparser.add_argument('--gc-growth', type=float, help=help_msg)
+    help_msg = f'instructions between incremental gc steps (default: {GC_STEP_INTERVAL})'
+    argparser.add_argument('--gc-step-interval', type=int, default=GC_STEP_INTERVAL, help=help_msg)
+    help_msg = f'objects marked per incremental gc step (default: {GC_STEP_BUDGET})'
+    argparser.add_argument('--gc-step-budget', type=int, default=GC_STEP_BUDGET, help=help_msg)
+    help_msg = 'print garbage collection statistics (on stderr) at exit'
+    argparser.add_argument('--gc-stats', action='store_true', help=help_msg)
+    help_msg = 'limit the heap to N objects or to a size (e.g., 64MB); may be given twice'
+    argparser.add_argument('--max-heap', type=parse_heap_limit, action='append', metavar='LIMIT',
+                           help=help_msg)
+    help_msg = 'write a heap snapshot (JSON, or DOT for a .dot file) at exit'
+    argparser.add_argument('--heap-snapshot-on-exit', metavar='FILE', help=help_msg)
+    help_msg = 'trace executed instructions to stderr (not the py engine)'
+    argparser.add_argument('--trace', choices=['text', 'json'], help=help_msg)
+    help_msg = 'only trace instructions in the function (repeatable)'
+    argparser.add_argument('--trace-function', action='append', help=help_msg)
+    help_msg = 'only trace instructions with pc in START:END'
+    argparser.add_argument('--trace-pc', type=parse_pc_range, metavar='START:END', help=help_msg)
     help_msg = 'mypl program file (optional)'
     argparser.add_argument('filename', nargs='?', help=help_msg)
     args = argparser.parse_args()
+    if args.trace and args.engine == 'py':
+        argparser.error('--trace is not supported by the py engine')
     # get the input (file or standard in)
     in_stream = StdInWrapper(sys.stdin)
     if args.filename:
@@ -182,6 +250,26 @@ if __name__ == '__main__':
             print(f"ERROR: Could not open file '{args.filename}'")
             exit(1)
     # check args and route to appropriate function
+    vm_options = {}
+    if args.jit:
+        vm_options['jit_threshold'] = JIT_THRESHOLD
+    if args.fuse or args.fuse_report:
+        vm_options['fuse'] = True
+    if args.scalar_replace:
+        vm_options['scalar_replace'] = True
+    if args.gc != 'marksweep':
+        vm_options['gc'] = args.gc
+    if args.gc == 'incremental':
+        vm_options['gc_step_interval'] = args.gc_step_interval
+        vm_options['gc_step_budget'] = args.gc_step_budget
+    if args.gc_threshold is not None:
+        vm_options['gc_threshold'] = args.gc_threshold
+    if args.gc_growth is not None:
+        vm_options['gc_growth'] = args.gc_growth
+        # a growth factor only applies to allocation-triggered collection
+        vm_options.setdefault('gc_threshold', GC_THRESHOLD)
+    for kind, limit in args.max_heap or []:
+        vm_options['max_objects' if kind == 'objects' else 'max_heap_bytes'] = limit
     if args.lex:
         run_lex_mode(in_stream)
     elif args.parse:
@@ -191,9 +279,13 @@ if __name__ == '__main__':
     elif args.check:
         run_check_mode(in_stream)
     elif args.ir:
-        run_ir_mode(in_stream)
+        run_ir_mode(in_stream, args.engine, **vm_options)
     else:
-        run_normal_mode(in_stream)
+        trace = None
+        if args.trace:
+            trace = TraceSink(sys.stderr, args.trace_function, args.trace_pc, args.trace)
+        run_normal_mode(in_stream, args.engine, args.fuse_report, trace, args.gc_stats,
+                        args.heap_snapshot_on_exit, **vm_options)
     # close the (wrapped) input stream
     in_stream.close()
 
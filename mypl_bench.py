@@ -0,0 +1,198 @@
+"""Benchmark driver for measuring MyPL VM throughput.
+
+Runs each given mypl program (by default the examples/bench_*.mypl
+scripts) and reports the number of VM instructions executed, the best
+wall-clock time over a number of runs, and the resulting instructions
+per second. With --gc, times garbage collection of heaps of different
+sizes instead, and with --gc-compare, compares the garbage collectors.
+
+NAME: Colin McClelland
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+import argparse
+import contextlib
+import glob
+import io
+import sys
+import time
+
+from mypl_iowrapper import FileWrapper
+from mypl_lexer import Lexer
+from mypl_ast_parser import ASTParser
+from mypl_semantic_checker import SemanticChecker
+from mypl_code_gen import code_generator
+from mypl_frame import VMFrameTemplate, VMFrame
+from mypl_vm import VM, ENGINES, GC_MODES
+from mypl_jit import JIT_THRESHOLD
+
+
+def build_vm(filename, engine='table', **vm_options):
+    """Returns a VM loaded with the compiled mypl program in the given
+    file.
+
+    Args:
+        filename -- The mypl program to compile.
+        engine -- The VM execution engine to use.
+        vm_options -- Additional VM constructor options.
+
+    """
+    with open(filename, 'r', encoding='utf-8') as f:
+        in_stream = FileWrapper(io.StringIO(f.read()))
+    ast = ASTParser(Lexer(in_stream)).parse()
+    ast.accept(SemanticChecker())
+    vm = VM(engine=engine, **vm_options)
+    ast.accept(code_generator(vm))
+    return vm
+
+
+def count_instructions(filename, engine='table'):
+    """Returns the number of instructions executed when running the
+    program, found by wrapping each dispatch table entry in a counter.
+    Register machine instructions are counted for the register engine
+    and stack VM instructions (on the table engine) otherwise, so for
+    the closure and py engines instructions per second is the rate of
+    equivalent stack VM instructions.
+
+    """
+    vm = build_vm(filename, 'register' if engine == 'register' else 'table')
+    count = 0
+    def counted(handler):
+        def wrapper(*args):
+            nonlocal count
+            count += 1
+            return handler(*args)
+        return wrapper
+    vm.dispatch = [counted(handler) for handler in vm.dispatch]
+    vm.reg_dispatch = [counted(handler) for handler in vm.reg_dispatch]
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm.run()
+    return count
+
+
+def count_frames(filename, engine='table', **vm_options):
+    """Returns the number of frames allocated when running the program
+    (calls that reuse a pooled frame allocate none).
+
+    """
+    vm = build_vm(filename, engine, **vm_options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm.run()
+    return vm.frames_created
+
+
+def time_run(filename, repeat, engine='table', **vm_options):
+    """Returns the best wall-clock time (in seconds) of running the
+    program the given number of times. Compilation is not timed.
+
+    """
+    best = None
+    for _ in range(repeat):
+        vm = build_vm(filename, engine, **vm_options)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            vm.run()
+            elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def peak_heap(filename, engine='table', **vm_options):
+    """Returns the most objects on the heap at once when running the
+    program.
+
+    """
+    vm = build_vm(filename, engine, **vm_options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm.run()
+    return vm.peak_heap
+
+
+def time_collection(live, repeat, gc='marksweep'):
+    """Returns the best wall-clock time (in seconds) of a collection
+    with the given collector, the given number of live structs (held in
+    an array stored in a main frame variable), and as many garbage
+    structs.
+
+    """
+    best = None
+    for _ in range(repeat):
+        vm = VM(gc=gc, gc_threshold=4 * live)
+        array = vm.alloc_array(live)
+        for i in range(live):
+            vm.set_index(array, i, vm.alloc_struct())
+            vm.alloc_struct()
+        vm.call_stack.append(VMFrame(VMFrameTemplate('main', 0), 0, [array]))
+        start = time.perf_counter()
+        vm.run_garbage_collector()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+if __name__ == '__main__':
+    about = 'Measure MyPL VM instructions per second.'
+    argparser = argparse.ArgumentParser(prog='mypl_bench', description=about)
+    help_msg = 'mypl program files (default: examples/bench_*.mypl)'
+    argparser.add_argument('filenames', nargs='*', help=help_msg)
+    help_msg = 'number of timed runs per program (best is reported)'
+    argparser.add_argument('--repeat', type=int, default=3, help=help_msg)
+    help_msg = 'VM execution engines to time (default: all)'
+    argparser.add_argument('--engine', choices=ENGINES, action='append', help=help_msg)
+    help_msg = 'also time the table engine with hot loop tracing on'
+    argparser.add_argument('--jit', action='store_true', help=help_msg)
+    help_msg = 'fuse superinstructions before timing'
+    argparser.add_argument('--fuse', action='store_true', help=help_msg)
+    help_msg = 'compare frames allocated and time with frame pooling off and on'
+    argparser.add_argument('--frames', action='store_true', help=help_msg)
+    help_msg = 'time mark-sweep and copying collections with 10k, 100k, and 1M live objects'
+    argparser.add_argument('--gc', action='store_true', help=help_msg)
+    help_msg = 'compare peak heap size and time of the garbage collectors'
+    argparser.add_argument('--gc-compare', action='store_true', help=help_msg)
+    args = argparser.parse_args()
+    engines = args.engine or ENGINES
+    vm_options = {'fuse': True} if args.fuse else {}
+    filenames = args.filenames or sorted(glob.glob('examples/bench_*.mypl'))
+    if args.gc:
+        print(f'{"gc":<12}{"live objects":>12}{"seconds":>10}{"objects/s":>14}')
+        for gc in ('marksweep', 'copying'):
+            for live in (10_000, 100_000, 1_000_000):
+                seconds = time_collection(live, args.repeat, gc)
+                print(f'{gc:<12}{live:>12,}{seconds:>10.3f}{2 * live / seconds:>14,.0f}')
+        sys.exit()
+    if args.gc_compare:
+        filenames = args.filenames or sorted(glob.glob('examples/*.mypl'))
+        print(f'{"program":<28}{"gc":<14}{"peak heap":>10}{"seconds":>10}')
+        for filename in filenames:
+            for gc in GC_MODES:
+                peak = peak_heap(filename, gc=gc, **vm_options)
+                seconds = time_run(filename, args.repeat, gc=gc, **vm_options)
+                print(f'{filename:<28}{gc:<14}{peak:>10}{seconds:>10.3f}')
+        sys.exit()
+    if args.frames:
+        print(f'{"program":<28}{"engine":<10}{"pool":<6}{"frames":>10}{"seconds":>10}')
+        for filename in filenames:
+            for engine in engines:
+                if engine == 'py':
+                    continue
+                for pool in (False, True):
+                    frames = count_frames(filename, engine, frame_pool=pool, **vm_options)
+                    seconds = time_run(filename, args.repeat, engine, frame_pool=pool, **vm_options)
+                    print(f'{filename:<28}{engine:<10}{"on" if pool else "off":<6}{frames:>10}{seconds:>10.3f}')
+        sys.exit()
+    print(f'{"program":<28}{"engine":<10}{"instrs":>12}{"seconds":>10}{"instrs/s":>14}')
+    for filename in filenames:
+        stack_instrs = count_instructions(filename)
+        for engine in engines:
+            instrs = stack_instrs
+            if engine == 'register':
+                instrs = count_instructions(filename, engine)
+            seconds = time_run(filename, args.repeat, engine, **vm_options)
+            print(f'{filename:<28}{engine:<10}{instrs:>12}{seconds:>10.3f}{instrs / seconds:>14,.0f}')
+        if args.jit:
+            seconds = time_run(filename, args.repeat, jit_threshold=JIT_THRESHOLD, **vm_options)
+            print(f'{filename:<28}{"jit":<10}{stack_instrs:>12}{seconds:>10.3f}{stack_instrs / seconds:>14,.0f}')
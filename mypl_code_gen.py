@@ -1,4 +1,5 @@
-"""IR code generator for converting MyPL to VM Instructions. 
+"""IR code generator for converting MyPL to VM Instructions, and a
+Python backend compiling MyPL functions to Python functions.
 
 NAME: Colin McClelland
 DATE: Spring 2024
@@ -6,12 +7,25 @@ CLASS: CPSC 326
 
 """
 
+import re
+
 from mypl_token import *
 from mypl_ast import *
 from mypl_var_table import *
 from mypl_frame import *
 from mypl_opcode import *
 from mypl_vm import *
+from mypl_escape import EscapeAnalysis, new_struct, field_slot, slot_path
+
+
+def struct_layout(struct_def):
+    """Returns field name -> (offset, type name) for the fields of the
+    struct definition. A struct object holds its field values in the
+    order the fields are declared, so GETF and SETF take the offset.
+
+    """
+    return {field.var_name.lexeme: (i, field.data_type.type_name.lexeme)
+            for i, field in enumerate(struct_def.fields)}
 
 
 class CodeGenerator (Visitor):
@@ -30,14 +44,63 @@ class CodeGenerator (Visitor):
         self.var_table = VarTable()
         # struct name -> StructDef for struct field info
         self.struct_defs = {}
+        # struct name -> field name -> (offset, type name)
+        self.layouts = {}
+        # function name -> number of parameters
+        self.arg_counts = {}
+        # struct name -> number of fields
+        self.field_counts = {}
+        # most variables in scope at once in the current function
+        self.max_vars = 0
+        # the struct variables to scalar replace (if the vm asks for it)
+        self.escapes = EscapeAnalysis()
 
     
     def add_instr(self, instr):
         """Helper function to add an instruction to the current template."""
         self.curr_template.instructions.append(instr)
 
+
+    def add_var(self, var_name, type_name=None):
+        """Helper function to add a variable to the var table."""
+        self.var_table.add(var_name, type_name)
+        self.max_vars = max(self.max_vars, self.var_table.total_vars)
+
+
+    def assign_fields(self, var_name, new_rvalue, declare=False):
+        """Generates a new struct assigned to a scalar replaced variable
+        (see mypl_escape): the field values are pushed in order and then
+        stored in the variable's field slots (added if declare is True).
+
+        """
+        fields = self.struct_defs[new_rvalue.type_name.lexeme].fields
+        for param in new_rvalue.struct_params:
+            param.accept(self)
+        slots = [field_slot(var_name, field.var_name.lexeme) for field in fields]
+        if declare:
+            for slot, field in zip(slots, fields):
+                self.add_var(slot, field.data_type.type_name.lexeme)
+        for slot in reversed(slots):
+            self.add_instr(STORE(self.var_table.get(slot)))
+
+
+    def visit_stmts(self, stmts):
+        """Generates a statement list. A call used as a statement leaves
+        its result on the operand stack (every call but print returns
+        a value, null for void functions), so it is popped.
+
+        """
+        for stmt in stmts:
+            stmt.accept(self)
+            if isinstance(stmt, CallExpr) and stmt.fun_name.lexeme != 'print':
+                self.add_instr(POP())
+
         
     def visit_program(self, program):
+        if self.vm.scalar_replace:
+            program.accept(self.escapes)
+        for fun_def in program.fun_defs:
+            self.arg_counts[fun_def.fun_name.lexeme] = len(fun_def.params)
         for struct_def in program.struct_defs:
             struct_def.accept(self)
         for fun_def in program.fun_defs:
@@ -45,21 +108,26 @@ class CodeGenerator (Visitor):
 
     
     def visit_struct_def(self, struct_def):
-        # remember the struct def for later
-        self.struct_defs[struct_def.struct_name.lexeme] = struct_def
+        # remember the struct def (and its field offsets) for later
+        name = struct_def.struct_name.lexeme
+        self.struct_defs[name] = struct_def
+        self.layouts[name] = struct_layout(struct_def)
+        self.field_counts[name] = len(struct_def.fields)
+        self.vm.add_struct_type(name, self.layouts[name])
 
         
     def visit_fun_def(self, fun_def):
 
         self.curr_template = VMFrameTemplate(fun_def.fun_name.lexeme, len(fun_def.params), [])
+        self.max_vars = 0
         self.var_table.push_environment()
 
         for i in range(len(fun_def.params)):
-            self.var_table.add(fun_def.params[i].var_name.lexeme)
+            param = fun_def.params[i]
+            self.add_var(param.var_name.lexeme, param.data_type.type_name.lexeme)
             self.add_instr(STORE(i))
         
-        for stmt in fun_def.stmts:
-            stmt.accept(self)
+        self.visit_stmts(fun_def.stmts)
         
         if fun_def.return_type.type_name.lexeme == 'void':
             self.add_instr(PUSH(None))
@@ -70,6 +138,8 @@ class CodeGenerator (Visitor):
         # for instr in self.curr_template.instructions:
         #     print(instr)
 
+        self.curr_template.local_count = self.max_vars
+        self.curr_template.size_frame(self.arg_counts, self.field_counts)
         self.vm.add_frame_template(self.curr_template)
   
     
@@ -79,52 +149,64 @@ class CodeGenerator (Visitor):
 
         
     def visit_var_decl(self, var_decl):
+        if id(var_decl) in self.escapes.replaced:
+            self.assign_fields(var_decl.var_def.var_name.lexeme, new_struct(var_decl.expr), True)
+            return
         if var_decl.expr.first is not None:
             var_decl.expr.accept(self)
         else:
             self.add_instr(PUSH(None))
-        self.var_table.add(var_decl.var_def.var_name.lexeme)
-        address = self.var_table.get(var_decl.var_def.var_name.lexeme)
+        var_def = var_decl.var_def
+        self.add_var(var_def.var_name.lexeme, var_def.data_type.type_name.lexeme)
+        address = self.var_table.get(var_def.var_name.lexeme)
         self.add_instr(STORE(address))
 
     
     def visit_assign_stmt(self, assign_stmt):
-        address = self.var_table.get(assign_stmt.lvalue[0].var_name.lexeme)
-        if len(assign_stmt.lvalue) == 1:
-            if assign_stmt.lvalue[0].array_expr is not None:
+        lvalue = assign_stmt.lvalue
+        if id(assign_stmt) in self.escapes.uses:
+            if len(lvalue) == 1:
+                self.assign_fields(lvalue[0].var_name.lexeme, new_struct(assign_stmt.expr))
+                return
+            lvalue = slot_path(lvalue)
+        address = self.var_table.get(lvalue[0].var_name.lexeme)
+        if len(lvalue) == 1:
+            if lvalue[0].array_expr is not None:
                 self.add_instr(LOAD(address))
-                assign_stmt.lvalue[0].array_expr.accept(self)
+                lvalue[0].array_expr.accept(self)
                 assign_stmt.expr.accept(self)
                 self.add_instr(SETI())
             else:
                 assign_stmt.expr.accept(self)
-                address = self.var_table.get(assign_stmt.lvalue[0].var_name.lexeme)
+                address = self.var_table.get(lvalue[0].var_name.lexeme)
                 self.add_instr(STORE(address))
 
         else:
             self.add_instr(LOAD(address))
-            if assign_stmt.lvalue[0].array_expr is not None:
-                assign_stmt.lvalue[0].array_expr.accept(self)
+            if lvalue[0].array_expr is not None:
+                lvalue[0].array_expr.accept(self)
                 self.add_instr(GETI())
 
-            for i in range(1, len(assign_stmt.lvalue)):
-                if i == len(assign_stmt.lvalue)-1:
-                    if assign_stmt.lvalue[i].array_expr is not None:
+            type_name = self.var_table.get_type(lvalue[0].var_name.lexeme)
+            for i in range(1, len(lvalue)):
+                offset, type_name = self.layouts[type_name][lvalue[i].var_name.lexeme]
+                if i == len(lvalue)-1:
+                    if lvalue[i].array_expr is not None:
                         # could still have a path expression:  n.next[0]
-                        self.add_instr(GETF(assign_stmt.lvalue[i].var_name.lexeme))
-                        assign_stmt.lvalue[i].array_expr.accept(self)
+                        self.add_instr(GETF(offset))
+                        lvalue[i].array_expr.accept(self)
                         assign_stmt.expr.accept(self)
                         self.add_instr(SETI())
                     else:
                         assign_stmt.expr.accept(self)
-                        self.add_instr(SETF(assign_stmt.lvalue[i].var_name.lexeme))
+                        self.add_instr(SETF(offset))
                 else:
-                    if assign_stmt.lvalue[i].array_expr is not None:
-                        self.add_instr(GETF(assign_stmt.lvalue[i].var_name.lexeme))
-                        assign_stmt.lvalue[i].array_expr.accept(self)
+                    if lvalue[i].array_expr is not None:
+                        self.add_instr(GETF(offset))
+                        lvalue[i].array_expr.accept(self)
                         self.add_instr(GETI())
                     else:
-                        self.add_instr(GETF(assign_stmt.lvalue[i].var_name.lexeme))
+                        self.add_instr(GETF(offset))
 
 
     def visit_while_stmt(self, while_stmt):
@@ -133,8 +215,7 @@ class CodeGenerator (Visitor):
         self.add_instr(JMPF(-1))
         jmpf_idx = len(self.curr_template.instructions) - 1
         self.var_table.push_environment()
-        for stmt in while_stmt.stmts:
-            stmt.accept(self)
+        self.visit_stmts(while_stmt.stmts)
         self.var_table.pop_environment()
         self.add_instr(JMP(start_idx))
         self.add_instr(NOP())
@@ -149,8 +230,7 @@ class CodeGenerator (Visitor):
         for_stmt.condition.accept(self)
         self.add_instr(JMPF(-1))
         jmpf_idx = len(self.curr_template.instructions) - 1
-        for stmt in for_stmt.stmts:
-            stmt.accept(self)
+        self.visit_stmts(for_stmt.stmts)
         for_stmt.assign_stmt.accept(self)
         self.var_table.pop_environment()
         self.add_instr(JMP(start_idx))
@@ -163,8 +243,7 @@ class CodeGenerator (Visitor):
         self.add_instr(JMPF(-1))
         if_jmpf_idx = len(self.curr_template.instructions) - 1
         self.var_table.push_environment()
-        for stmt in if_stmt.if_part.stmts:
-            stmt.accept(self)
+        self.visit_stmts(if_stmt.if_part.stmts)
         self.var_table.pop_environment()
         self.add_instr(JMP(-1)) # after the if body executes, go to very end past else if and else
         if_jmp_idx = len(self.curr_template.instructions) - 1
@@ -178,8 +257,7 @@ class CodeGenerator (Visitor):
             self.add_instr(JMPF(-1))
             elif_jmpf_idx = len(self.curr_template.instructions) - 1
             self.var_table.push_environment()
-            for stmt in else_if_block.stmts:
-                stmt.accept(self)
+            self.visit_stmts(else_if_block.stmts)
             self.var_table.pop_environment()
             self.add_instr(JMP(-1)) # jump to the very end if we enter the body of an elseif
             elseif_jmp_idx = len(self.curr_template.instructions) - 1
@@ -189,8 +267,7 @@ class CodeGenerator (Visitor):
             else_if_indexes.append(elseif_jmp_idx)
 
         self.var_table.push_environment()
-        for stmt in if_stmt.else_stmts:
-            stmt.accept(self)
+        self.visit_stmts(if_stmt.else_stmts)
         self.var_table.pop_environment()
 
         self.add_instr(NOP())
@@ -313,11 +390,9 @@ class CodeGenerator (Visitor):
     def visit_new_rvalue(self, new_rvalue):
         # struct
         if new_rvalue.array_expr is None:
-            self.add_instr(ALLOCS())
-            for i in range(len(new_rvalue.struct_params)):
-                self.add_instr(DUP())
-                new_rvalue.struct_params[i].accept(self)
-                self.add_instr(SETF(self.struct_defs[new_rvalue.type_name.lexeme].fields[i].var_name.lexeme))
+            for param in new_rvalue.struct_params:
+                param.accept(self)
+            self.add_instr(NEWS(new_rvalue.type_name.lexeme))
         # array
         else:
             new_rvalue.array_expr.accept(self)
@@ -325,34 +400,1068 @@ class CodeGenerator (Visitor):
 
 
     def visit_var_rvalue(self, var_rvalue):
-        address = self.var_table.get(var_rvalue.path[0].var_name.lexeme)
-        if len(var_rvalue.path) == 1:
-            if var_rvalue.path[0].array_expr is not None:
+        path = var_rvalue.path
+        if id(var_rvalue) in self.escapes.uses:
+            path = slot_path(path)
+        address = self.var_table.get(path[0].var_name.lexeme)
+        if len(path) == 1:
+            if path[0].array_expr is not None:
                 self.add_instr(LOAD(address))
-                var_rvalue.path[0].array_expr.accept(self)
+                path[0].array_expr.accept(self)
                 self.add_instr(GETI())
             else:
                 self.add_instr(LOAD(address))
                 
         else:
             self.add_instr(LOAD(address))
-            if var_rvalue.path[0].array_expr is not None:
-                var_rvalue.path[0].array_expr.accept(self)
+            if path[0].array_expr is not None:
+                path[0].array_expr.accept(self)
                 self.add_instr(GETI())
 
-            for i in range(1, len(var_rvalue.path)):
-                if i == len(var_rvalue.path)-1:
-                    if var_rvalue.path[i].array_expr is not None:
+            type_name = self.var_table.get_type(path[0].var_name.lexeme)
+            for i in range(1, len(path)):
+                offset, type_name = self.layouts[type_name][path[i].var_name.lexeme]
+                if i == len(path)-1:
+                    if path[i].array_expr is not None:
                         # could still have a path expression:  n.next[0]
-                        self.add_instr(GETF(var_rvalue.path[i].var_name.lexeme))
-                        var_rvalue.path[i].array_expr.accept(self)
+                        self.add_instr(GETF(offset))
+                        path[i].array_expr.accept(self)
                         self.add_instr(GETI())
                     else:
-                        self.add_instr(GETF(var_rvalue.path[i].var_name.lexeme))
+                        self.add_instr(GETF(offset))
                 else:
-                    if var_rvalue.path[i].array_expr is not None:
-                        self.add_instr(GETF(var_rvalue.path[i].var_name.lexeme))
-                        var_rvalue.path[i].array_expr.accept(self)
+                    if path[i].array_expr is not None:
+                        self.add_instr(GETF(offset))
+                        path[i].array_expr.accept(self)
                         self.add_instr(GETI())
                     else:
-                        self.add_instr(GETF(var_rvalue.path[i].var_name.lexeme))
+                        self.add_instr(GETF(offset))
+
+
+
+#----------------------------------------------------------------------
+# Python backend (mypl --engine=py)
+#----------------------------------------------------------------------
+
+# built-in functions without side effects (other than errors)
+PURE_BUILT_INS = ['itos', 'dtos', 'stoi', 'dtoi', 'itod', 'stod', 'length', 'get']
+
+
+def has_effects(node):
+    """Returns True if evaluating the given expression node can call a
+    user-defined function, read input, or allocate a heap object.
+
+    """
+    if isinstance(node, Expr):
+        return has_effects(node.first) or (node.rest is not None and has_effects(node.rest))
+    if isinstance(node, SimpleTerm):
+        return has_effects(node.rvalue)
+    if isinstance(node, ComplexTerm):
+        return has_effects(node.expr)
+    if isinstance(node, NewRValue):
+        return True
+    if isinstance(node, CallExpr):
+        if node.fun_name.lexeme not in PURE_BUILT_INS:
+            return True
+        return any(has_effects(arg) for arg in node.args)
+    if isinstance(node, VarRValue):
+        return any(ref.array_expr is not None and has_effects(ref.array_expr) for ref in node.path)
+    return False
+
+
+def py_write(val):
+    if type(val) == bool:
+        val = 'true' if val else 'false'
+    print('null' if val == None else val, end='')
+
+
+def py_read():
+    return input()
+
+
+def py_getc(idx, string):
+    if idx == None:
+        raise VMError("index cannot be null")
+    if string == None:
+        raise VMError("string cannot be null")
+    if (idx < 0 or idx > len(string)-1):
+        raise VMError("index out of bounds")
+    return string[idx]
+
+
+def py_toint(val):
+    if val == None:
+        raise VMError("argument cannot be null")
+    try:
+        return int(val)
+    except ValueError:
+        raise VMError("invalid argument")
+
+
+def py_todbl(val):
+    if val == None:
+        raise VMError("argument cannot be null")
+    try:
+        return float(val)
+    except ValueError:
+        raise VMError("invalid argument")
+
+
+def py_tostr(val):
+    if val == None:
+        raise VMError("argument cannot be null")
+    return str(val)
+
+
+def py_null_operand(op):
+    if op in ('<', '<='):
+        raise VMError("null cannot be used in operations")
+    raise VMError("null cannot be used in arithmetic operations")
+
+
+def py_add(y, x):
+    if x == None or y == None:
+        raise VMError("null cannot be used in arithmetic operations")
+    return y + x
+
+
+def py_sub(y, x):
+    if x == None or y == None:
+        raise VMError("null cannot be used in arithmetic operations")
+    return y - x
+
+
+def py_mul(y, x):
+    if x == None or y == None:
+        raise VMError("null cannot be used in arithmetic operations")
+    return y * x
+
+
+def py_div(y, x):
+    if x == 0:
+        raise VMError("Division by zero error")
+    if x == None or y == None:
+        raise VMError("null cannot be used in arithmetic operations")
+    if type(x) == int and type(y) == int:
+        return y // x
+    return y / x
+
+
+def py_lt(y, x):
+    if x == None or y == None:
+        raise VMError("null cannot be used in operations")
+    return y < x
+
+
+def py_le(y, x):
+    if x == None or y == None:
+        raise VMError("null cannot be used in operations")
+    return y <= x
+
+
+def py_and(y, x):
+    if x == None or y == None:
+        raise VMError("null cannot be used in logical operations")
+    return y and x
+
+
+def py_or(y, x):
+    if x == None or y == None:
+        raise VMError("null cannot be used in logical operations")
+    return y or x
+
+
+def py_not(x):
+    if x == None:
+        raise VMError("null cannot be used in logical operations")
+    return not x
+
+
+class PyCodeGenerator (Visitor):
+    """Compiles each mypl function into a Python function whose mypl
+    variables are Python locals (v0, v1, ... by var table offset) and
+    whose heap operations go through the VM's heap, so objects and
+    the garbage collector are shared with the stack VM engines.
+
+    Calls, inputs, and allocations are hoisted into temporaries (t0,
+    t1, ...) in evaluation order, which keeps the stack VM's order of
+    evaluation and keeps every intermediate heap reference in a local
+    the garbage collector can see.
+
+    """
+
+    def __init__(self, vm):
+        """Creates a new Python code generator given a VM.
+
+        Args:
+            vm -- The target vm (run with engine='py').
+        """
+        self.vm = vm
+        # for var -> index (local variable name) mappings
+        self.var_table = VarTable()
+        # struct name -> StructDef for struct field info
+        self.struct_defs = {}
+        # struct name -> field name -> (offset, type name)
+        self.layouts = {}
+        # the lines of the function being generated
+        self.lines = []
+        self.indent = 0
+        self.temp_count = 0
+        # the python expression for the most recently visited expression
+        self.curr_expr = None
+        # the struct variables to scalar replace (if the vm asks for it)
+        self.escapes = EscapeAnalysis()
+        # globals of the compiled functions: runtime helpers and the
+        # compiled functions themselves (as f_<name>) and struct types
+        # (as s_<name>)
+        self.namespace = {
+            '_news': vm.alloc_struct,
+            '_alloca': vm.alloc_array,
+            '_setf': vm.set_field,
+            '_getf': vm.get_field,
+            '_seti': vm.set_index,
+            '_geti': vm.get_index,
+            '_len': vm.length,
+            '_collect': vm.collect_py_garbage,
+            '_enter_main': vm.enter_py_main,
+            '_write': py_write,
+            '_read': py_read,
+            '_getc': py_getc,
+            '_toint': py_toint,
+            '_todbl': py_todbl,
+            '_tostr': py_tostr,
+            '_null_operand': py_null_operand,
+            '_add': py_add,
+            '_sub': py_sub,
+            '_mul': py_mul,
+            '_div': py_div,
+            '_lt': py_lt,
+            '_le': py_le,
+            '_and': py_and,
+            '_or': py_or,
+            '_not': py_not,
+            '_HaltProgram': HaltProgram,
+        }
+
+
+    def add_line(self, line):
+        """Helper function to add a line at the current indentation."""
+        self.lines.append('    ' * self.indent + line)
+
+
+    def new_temp(self):
+        """Returns the name of a fresh temporary local."""
+        name = f't{self.temp_count}'
+        self.temp_count += 1
+        return name
+
+
+    def hoist(self, expr):
+        """Returns a local holding the value of the python expression,
+        evaluating it into a new temporary unless it is already a
+        local or a literal.
+
+        """
+        if re.fullmatch(r'[vt]\d+|None|True|False|[\d.]+', expr):
+            return expr
+        temp = self.new_temp()
+        self.add_line(f'{temp} = {expr}')
+        return temp
+
+
+    def eval_in_order(self, nodes):
+        """Returns the python expressions for the given expression nodes,
+        hoisting any whose value could be changed by the effects of a
+        later node.
+
+        """
+        exprs = []
+        for i in range(len(nodes)):
+            nodes[i].accept(self)
+            expr = self.curr_expr
+            if any(has_effects(node) for node in nodes[i+1:]):
+                expr = self.hoist(expr)
+            exprs.append(expr)
+        return exprs
+
+
+    def null_checked(self, op, left, right, helper):
+        """Returns the python expression for left op right, where op
+        rejects null operands: inline, checking each local operand, if
+        both operands are locals or non-null constants, and through the
+        helper (which checks both) otherwise.
+
+        """
+        checks = []
+        for operand in (left, right):
+            if re.fullmatch(r'[vt]\d+', operand):
+                checks.append(f'{operand} is not None')
+            elif not (operand[0].isdigit() or operand[0] in '\'"' or operand in ('True', 'False')):
+                return f'{helper}({left}, {right})'
+        if not checks:
+            return f'({left} {op} {right})'
+        return f'({left} {op} {right} if {" and ".join(checks)} else _null_operand({op!r}))'
+
+
+    def visit_stmts(self, stmts):
+        """Generates the statement list of a block (pass if empty)."""
+        for stmt in stmts:
+            stmt.accept(self)
+            if isinstance(stmt, CallExpr) and not re.fullmatch(r't\d+', self.curr_expr):
+                self.add_line(self.curr_expr)
+        if not stmts:
+            self.add_line('pass')
+
+
+    def assign_fields(self, var_name, new_rvalue, declare=False):
+        """Generates a new struct assigned to a scalar replaced variable
+        (see mypl_escape): a tuple assignment of the field values to the
+        variable's field locals (added if declare is True).
+
+        """
+        fields = self.struct_defs[new_rvalue.type_name.lexeme].fields
+        values = self.eval_in_order(new_rvalue.struct_params)
+        slots = [field_slot(var_name, field.var_name.lexeme) for field in fields]
+        if declare:
+            for slot, field in zip(slots, fields):
+                self.var_table.add(slot, field.data_type.type_name.lexeme)
+        targets = [f'v{self.var_table.get(slot)}' for slot in slots]
+        if targets:
+            self.add_line(f'{", ".join(targets)} = {", ".join(values)}')
+
+
+    def visit_program(self, program):
+        if self.vm.scalar_replace:
+            program.accept(self.escapes)
+        for struct_def in program.struct_defs:
+            struct_def.accept(self)
+        for fun_def in program.fun_defs:
+            fun_def.accept(self)
+
+
+    def visit_struct_def(self, struct_def):
+        # remember the struct def (and its field offsets) for later
+        name = struct_def.struct_name.lexeme
+        self.struct_defs[name] = struct_def
+        self.layouts[name] = struct_layout(struct_def)
+        self.vm.add_struct_type(name, self.layouts[name])
+        self.namespace[f's_{name}'] = self.vm.struct_types[name]
+
+
+    def visit_fun_def(self, fun_def):
+        name = fun_def.fun_name.lexeme
+        self.lines = []
+        self.indent = 0
+        self.temp_count = 0
+        self.var_table.push_environment()
+        params = []
+        for param in fun_def.params:
+            self.var_table.add(param.var_name.lexeme, param.data_type.type_name.lexeme)
+            params.append(f'v{self.var_table.get(param.var_name.lexeme)}')
+        self.add_line(f'def f_{name}({", ".join(params)}):')
+        self.indent = 1
+        if name == 'main':
+            self.add_line('_enter_main()')
+        self.visit_stmts(fun_def.stmts)
+        if fun_def.return_type.type_name.lexeme == 'void':
+            self.add_line('return None')
+        elif not fun_def.stmts or not isinstance(fun_def.stmts[-1], ReturnStmt):
+            self.add_line('raise _HaltProgram()')
+        self.var_table.pop_environment()
+        source = '\n'.join(self.lines) + '\n'
+        exec(compile(source, PY_CODE_FILENAME, 'exec'), self.namespace)
+        self.vm.add_py_function(name, self.namespace[f'f_{name}'], source)
+
+
+    def visit_return_stmt(self, return_stmt):
+        return_stmt.expr.accept(self)
+        self.add_line(f'return {self.curr_expr}')
+
+
+    def visit_var_decl(self, var_decl):
+        if id(var_decl) in self.escapes.replaced:
+            self.assign_fields(var_decl.var_def.var_name.lexeme, new_struct(var_decl.expr), True)
+            return
+        if var_decl.expr.first is not None:
+            var_decl.expr.accept(self)
+            expr = self.curr_expr
+        else:
+            expr = 'None'
+        var_def = var_decl.var_def
+        self.var_table.add(var_def.var_name.lexeme, var_def.data_type.type_name.lexeme)
+        address = self.var_table.get(var_def.var_name.lexeme)
+        self.add_line(f'v{address} = {expr}')
+
+
+    def visit_assign_stmt(self, assign_stmt):
+        lvalue = assign_stmt.lvalue
+        if id(assign_stmt) in self.escapes.uses:
+            if len(lvalue) == 1:
+                self.assign_fields(lvalue[0].var_name.lexeme, new_struct(assign_stmt.expr))
+                return
+            lvalue = slot_path(lvalue)
+        effects = has_effects(assign_stmt.expr)
+        target = f'v{self.var_table.get(lvalue[0].var_name.lexeme)}'
+        if len(lvalue) == 1 and lvalue[0].array_expr is None:
+            assign_stmt.expr.accept(self)
+            self.add_line(f'{target} = {self.curr_expr}')
+            return
+        # evaluate the object (and index) being assigned into
+        type_name = self.var_table.get_type(lvalue[0].var_name.lexeme)
+        for i in range(len(lvalue)):
+            if i > 0:
+                offset, type_name = self.layouts[type_name][lvalue[i].var_name.lexeme]
+                if i == len(lvalue) - 1 and lvalue[i].array_expr is None:
+                    break
+                target = f'_getf({target}, {offset})'
+            if lvalue[i].array_expr is not None:
+                if has_effects(lvalue[i].array_expr):
+                    target = self.hoist(target)
+                lvalue[i].array_expr.accept(self)
+                idx = self.curr_expr
+                if i < len(lvalue) - 1:
+                    target = f'_geti({target}, {idx})'
+        if effects:
+            target = self.hoist(target)
+        if lvalue[-1].array_expr is not None:
+            if effects:
+                idx = self.hoist(idx)
+            assign_stmt.expr.accept(self)
+            self.add_line(f'_seti({target}, {idx}, {self.curr_expr})')
+        else:
+            assign_stmt.expr.accept(self)
+            self.add_line(f'_setf({target}, {offset}, {self.curr_expr})')
+
+
+    def loop_header(self, condition):
+        """Adds the header of a while loop with the given condition. The
+        indentation is left at the loop body.
+
+        """
+        mark = len(self.lines)
+        self.indent += 1
+        condition.accept(self)
+        if len(self.lines) == mark:
+            self.lines.append('    ' * (self.indent - 1) + f'while {self.curr_expr}:')
+        else:
+            # the condition needs statements of its own each iteration
+            self.lines.insert(mark, '    ' * (self.indent - 1) + 'while True:')
+            self.add_line(f'if not {self.curr_expr}:')
+            self.add_line('    break')
+
+
+    def visit_while_stmt(self, while_stmt):
+        self.loop_header(while_stmt.condition)
+        self.var_table.push_environment()
+        self.visit_stmts(while_stmt.stmts)
+        self.var_table.pop_environment()
+        self.indent -= 1
+
+
+    def visit_for_stmt(self, for_stmt):
+        self.var_table.push_environment()
+        for_stmt.var_decl.accept(self)
+        self.loop_header(for_stmt.condition)
+        self.visit_stmts(for_stmt.stmts)
+        for_stmt.assign_stmt.accept(self)
+        self.var_table.pop_environment()
+        self.indent -= 1
+
+
+    def visit_if_stmt(self, if_stmt):
+        if_stmt.if_part.condition.accept(self)
+        self.add_line(f'if {self.curr_expr}:')
+        self.indent += 1
+        self.var_table.push_environment()
+        self.visit_stmts(if_stmt.if_part.stmts)
+        self.var_table.pop_environment()
+        self.indent -= 1
+        nested = 0
+        for else_if in if_stmt.else_ifs:
+            mark = len(self.lines)
+            self.indent += 1
+            else_if.condition.accept(self)
+            if len(self.lines) == mark:
+                self.indent -= 1
+                self.add_line(f'elif {self.curr_expr}:')
+            else:
+                # the condition needs statements, so nest it in an else
+                self.lines.insert(mark, '    ' * (self.indent - 1) + 'else:')
+                self.add_line(f'if {self.curr_expr}:')
+                nested += 1
+            self.indent += 1
+            self.var_table.push_environment()
+            self.visit_stmts(else_if.stmts)
+            self.var_table.pop_environment()
+            self.indent -= 1
+        if if_stmt.else_stmts:
+            self.add_line('else:')
+            self.indent += 1
+            self.var_table.push_environment()
+            self.visit_stmts(if_stmt.else_stmts)
+            self.var_table.pop_environment()
+            self.indent -= 1
+        self.indent -= nested
+
+
+    def visit_call_expr(self, call_expr):
+        name = call_expr.fun_name.lexeme
+        args = self.eval_in_order(call_expr.args)
+        if name == 'print':
+            self.curr_expr = f'_write({args[0]})'
+        elif name == 'input':
+            self.curr_expr = self.hoist('_read()')
+        elif name == 'itos' or name == 'dtos':
+            self.curr_expr = f'_tostr({args[0]})'
+        elif name == 'stoi' or name == 'dtoi':
+            self.curr_expr = f'_toint({args[0]})'
+        elif name == 'itod' or name == 'stod':
+            self.curr_expr = f'_todbl({args[0]})'
+        elif name == 'length':
+            self.curr_expr = f'_len({args[0]})'
+        elif name == 'get':
+            self.curr_expr = f'_getc({args[0]}, {args[1]})'
+        else:
+            temp = self.new_temp()
+            self.add_line(f'{temp} = f_{name}({", ".join(args)})')
+            # collect on return, as the stack VM does on RET
+            self.add_line('_collect()')
+            self.curr_expr = temp
+
+
+    def visit_expr(self, expr):
+        if expr.op is None:
+            expr.first.accept(self)
+            result = self.curr_expr
+        else:
+            op = expr.op.lexeme
+            # same evaluation order as the stack VM: > and >= evaluate
+            # the rest first and are then compared as < and <=
+            if op == '>' or op == '>=':
+                left, right = self.eval_in_order([expr.rest, expr.first])
+            else:
+                left, right = self.eval_in_order([expr.first, expr.rest])
+            # operators that reject null operands raise the VM's errors
+            # for them (== and != compare null)
+            if op == '+':
+                result = self.null_checked('+', left, right, '_add')
+            elif op == '-':
+                result = self.null_checked('-', left, right, '_sub')
+            elif op == '*':
+                result = self.null_checked('*', left, right, '_mul')
+            elif op == '/':
+                result = f'_div({left}, {right})'
+            elif op == 'and':
+                result = f'_and({left}, {right})'
+            elif op == 'or':
+                result = f'_or({left}, {right})'
+            elif op == '<' or op == '>':
+                result = self.null_checked('<', left, right, '_lt')
+            elif op == '<=' or op == '>=':
+                result = self.null_checked('<=', left, right, '_le')
+            else:
+                result = f'({left} {op} {right})'
+        if expr.not_op:
+            result = f'_not({result})'
+        self.curr_expr = result
+
+
+    def visit_simple_term(self, simple_term):
+        simple_term.rvalue.accept(self)
+
+
+    def visit_complex_term(self, complex_term):
+        complex_term.expr.accept(self)
+
+
+    def visit_simple_rvalue(self, simple_rvalue):
+        val = simple_rvalue.value.lexeme
+        if simple_rvalue.value.token_type == TokenType.INT_VAL:
+            self.curr_expr = str(int(val))
+        elif simple_rvalue.value.token_type == TokenType.DOUBLE_VAL:
+            self.curr_expr = repr(float(val))
+        elif simple_rvalue.value.token_type == TokenType.STRING_VAL:
+            val = val.replace('\\n', '\n')
+            val = val.replace('\\t', '\t')
+            self.curr_expr = repr(val)
+        elif val == 'true':
+            self.curr_expr = 'True'
+        elif val == 'false':
+            self.curr_expr = 'False'
+        elif val == 'null':
+            self.curr_expr = 'None'
+
+
+    def visit_new_rvalue(self, new_rvalue):
+        # struct
+        if new_rvalue.array_expr is None:
+            values = self.eval_in_order(new_rvalue.struct_params)
+            self.curr_expr = self.hoist(f'_news([{", ".join(values)}], s_{new_rvalue.type_name.lexeme})')
+        # array
+        else:
+            new_rvalue.array_expr.accept(self)
+            self.curr_expr = self.hoist(f'_alloca({self.curr_expr})')
+
+
+    def visit_var_rvalue(self, var_rvalue):
+        path = var_rvalue.path
+        if id(var_rvalue) in self.escapes.uses:
+            path = slot_path(path)
+        result = f'v{self.var_table.get(path[0].var_name.lexeme)}'
+        type_name = self.var_table.get_type(path[0].var_name.lexeme)
+        for i in range(len(path)):
+            if i > 0:
+                offset, type_name = self.layouts[type_name][path[i].var_name.lexeme]
+                result = f'_getf({result}, {offset})'
+            if path[i].array_expr is not None:
+                if has_effects(path[i].array_expr):
+                    result = self.hoist(result)
+                path[i].array_expr.accept(self)
+                result = f'_geti({result}, {self.curr_expr})'
+        self.curr_expr = result
+
+
+
+#----------------------------------------------------------------------
+# Register machine backend (mypl --engine=register)
+#----------------------------------------------------------------------
+
+class RegCodeGenerator (Visitor):
+    """Generates register machine instructions (RegInstrs) whose
+    operands name frame variable slots. Each mypl variable is the
+    register at its var table offset, followed by the temporaries of
+    the function's most demanding statement, followed by one register
+    per constant (filled in when the frame is created). Variables and
+    constants are used in place, so reading them needs no instruction.
+
+    While a function is generated, temporaries are ('t', n) and
+    constants ('k', n) placeholders, resolved to slots once the
+    function's variable and temporary counts are known.
+
+    """
+
+    def __init__(self, vm):
+        """Creates a new register code generator given a VM.
+
+        Args:
+            vm -- The target vm (run with engine='register').
+        """
+        self.vm = vm
+        # the current frame template being generated
+        self.curr_template = None
+        # for var -> index mappings wrt to environments
+        self.var_table = VarTable()
+        # struct name -> StructDef for struct field info
+        self.struct_defs = {}
+        # struct name -> field name -> (offset, type name)
+        self.layouts = {}
+        # the register holding the most recently visited expression
+        self.curr_reg = None
+        # per function register allocation
+        self.max_vars = 0
+        self.temp_count = 0
+        self.max_temps = 0
+        self.constants = []
+        self.const_regs = {}
+        # the struct variables to scalar replace (if the vm asks for it)
+        self.escapes = EscapeAnalysis()
+
+
+    def add_instr(self, opcode, *operand):
+        """Helper function to add an instruction to the current template."""
+        self.curr_template.instructions.append(RegInstr(opcode, operand))
+
+
+    def new_temp(self):
+        """Returns a fresh temporary register (for the current statement)."""
+        reg = ('t', self.temp_count)
+        self.temp_count += 1
+        self.max_temps = max(self.max_temps, self.temp_count)
+        return reg
+
+
+    def const(self, val):
+        """Returns the constant register holding val."""
+        key = (type(val), val)
+        if key not in self.const_regs:
+            self.const_regs[key] = ('k', len(self.constants))
+            self.constants.append(val)
+        return self.const_regs[key]
+
+
+    def add_var(self, var_name, type_name=None):
+        """Adds the variable to the var table and returns its register."""
+        self.var_table.add(var_name, type_name)
+        self.max_vars = max(self.max_vars, self.var_table.total_vars)
+        return self.var_table.get(var_name)
+
+
+    def assign(self, reg, src):
+        """Adds the instructions for register reg = register src. If src
+        is the temporary just written, that instruction writes reg
+        directly instead.
+
+        """
+        instrs = self.curr_template.instructions
+        if type(src) == tuple and src[0] == 't' and instrs:
+            last = instrs[-1]
+            if REG_OPERANDS[last.opcode][:1] == 'd' and last.operand[0] == src:
+                last.operand = (reg,) + last.operand[1:]
+                return
+        self.add_instr(RegOpCode.MOV, reg, src)
+
+
+    def assign_fields(self, var_name, new_rvalue, declare=False):
+        """Generates a new struct assigned to a scalar replaced variable
+        (see mypl_escape): the field values are evaluated in order and
+        then moved to the variable's field registers (added if declare
+        is True), copying first any value read from those registers.
+
+        """
+        fields = self.struct_defs[new_rvalue.type_name.lexeme].fields
+        srcs = []
+        for param in new_rvalue.struct_params:
+            param.accept(self)
+            srcs.append(self.curr_reg)
+        slots = [field_slot(var_name, field.var_name.lexeme) for field in fields]
+        if declare:
+            regs = [self.add_var(slot, field.data_type.type_name.lexeme)
+                    for slot, field in zip(slots, fields)]
+        else:
+            regs = [self.var_table.get(slot) for slot in slots]
+        for i in range(len(srcs)):
+            if srcs[i] in regs:
+                temp = self.new_temp()
+                self.add_instr(RegOpCode.MOV, temp, srcs[i])
+                srcs[i] = temp
+        for reg, src in zip(regs, srcs):
+            self.assign(reg, src)
+
+
+    def resolve(self, reg):
+        if type(reg) != tuple:
+            return reg
+        if reg[0] == 't':
+            return self.max_vars + reg[1]
+        return self.max_vars + self.max_temps + reg[1]
+
+
+    def resolve_registers(self):
+        """Replaces the placeholder registers of the current template's
+        instructions with frame slots and sets its initial registers.
+
+        """
+        for instr in self.curr_template.instructions:
+            operand = []
+            for kind, arg in zip(REG_OPERANDS[instr.opcode], instr.operand):
+                if kind in 'dr':
+                    arg = self.resolve(arg)
+                elif kind == 'A':
+                    arg = tuple(self.resolve(reg) for reg in arg)
+                operand.append(arg)
+            instr.operand = tuple(operand)
+        self.curr_template.registers = [None] * (self.max_vars + self.max_temps) + self.constants
+        self.curr_template.local_count = len(self.curr_template.registers)
+        self.curr_template.max_stack_depth = 0
+
+
+    def visit_stmts(self, stmts):
+        """Generates a statement list (temporaries are only live within
+        a statement, so each statement reuses them).
+
+        """
+        for stmt in stmts:
+            self.temp_count = 0
+            stmt.accept(self)
+
+
+    def patch(self, idx):
+        """Sets the jump target of the instruction at idx to the next
+        instruction.
+
+        """
+        instr = self.curr_template.instructions[idx]
+        instr.operand = instr.operand[:-1] + (len(self.curr_template.instructions),)
+
+
+    def visit_program(self, program):
+        if self.vm.scalar_replace:
+            program.accept(self.escapes)
+        for struct_def in program.struct_defs:
+            struct_def.accept(self)
+        for fun_def in program.fun_defs:
+            fun_def.accept(self)
+
+
+    def visit_struct_def(self, struct_def):
+        # remember the struct def (and its field offsets) for later
+        name = struct_def.struct_name.lexeme
+        self.struct_defs[name] = struct_def
+        self.layouts[name] = struct_layout(struct_def)
+        self.vm.add_struct_type(name, self.layouts[name])
+
+
+    def visit_fun_def(self, fun_def):
+        self.curr_template = VMFrameTemplate(fun_def.fun_name.lexeme, len(fun_def.params), [])
+        self.max_vars = 0
+        self.max_temps = 0
+        self.constants = []
+        self.const_regs = {}
+        self.var_table.push_environment()
+        # arguments are passed in the first registers
+        for param in fun_def.params:
+            self.add_var(param.var_name.lexeme, param.data_type.type_name.lexeme)
+        self.visit_stmts(fun_def.stmts)
+        if fun_def.return_type.type_name.lexeme == 'void':
+            self.add_instr(RegOpCode.RET, self.const(None))
+        self.var_table.pop_environment()
+        self.resolve_registers()
+        self.vm.add_frame_template(self.curr_template)
+
+
+    def visit_return_stmt(self, return_stmt):
+        return_stmt.expr.accept(self)
+        self.add_instr(RegOpCode.RET, self.curr_reg)
+
+
+    def visit_var_decl(self, var_decl):
+        if id(var_decl) in self.escapes.replaced:
+            self.assign_fields(var_decl.var_def.var_name.lexeme, new_struct(var_decl.expr), True)
+            return
+        if var_decl.expr.first is not None:
+            var_decl.expr.accept(self)
+            src = self.curr_reg
+        else:
+            src = self.const(None)
+        var_def = var_decl.var_def
+        reg = self.add_var(var_def.var_name.lexeme, var_def.data_type.type_name.lexeme)
+        self.assign(reg, src)
+
+
+    def visit_assign_stmt(self, assign_stmt):
+        lvalue = assign_stmt.lvalue
+        if id(assign_stmt) in self.escapes.uses:
+            if len(lvalue) == 1:
+                self.assign_fields(lvalue[0].var_name.lexeme, new_struct(assign_stmt.expr))
+                return
+            lvalue = slot_path(lvalue)
+        reg = self.var_table.get(lvalue[0].var_name.lexeme)
+        if len(lvalue) == 1 and lvalue[0].array_expr is None:
+            assign_stmt.expr.accept(self)
+            self.assign(reg, self.curr_reg)
+            return
+        # evaluate the object (and index) being assigned into
+        type_name = self.var_table.get_type(lvalue[0].var_name.lexeme)
+        for i in range(len(lvalue)):
+            if i > 0:
+                offset, type_name = self.layouts[type_name][lvalue[i].var_name.lexeme]
+                if i == len(lvalue) - 1 and lvalue[i].array_expr is None:
+                    break
+                obj = self.new_temp()
+                self.add_instr(RegOpCode.GETF, obj, reg, offset)
+                reg = obj
+            if lvalue[i].array_expr is not None:
+                lvalue[i].array_expr.accept(self)
+                idx = self.curr_reg
+                if i < len(lvalue) - 1:
+                    obj = self.new_temp()
+                    self.add_instr(RegOpCode.GETI, obj, reg, idx)
+                    reg = obj
+        assign_stmt.expr.accept(self)
+        if lvalue[-1].array_expr is not None:
+            self.add_instr(RegOpCode.SETI, reg, idx, self.curr_reg)
+        else:
+            self.add_instr(RegOpCode.SETF, reg, offset, self.curr_reg)
+
+
+    def visit_while_stmt(self, while_stmt):
+        start_idx = len(self.curr_template.instructions)
+        while_stmt.condition.accept(self)
+        self.add_instr(RegOpCode.JMPF, self.curr_reg, -1)
+        jmpf_idx = len(self.curr_template.instructions) - 1
+        self.var_table.push_environment()
+        self.visit_stmts(while_stmt.stmts)
+        self.var_table.pop_environment()
+        self.add_instr(RegOpCode.JMP, start_idx)
+        self.patch(jmpf_idx)
+
+
+    def visit_for_stmt(self, for_stmt):
+        self.var_table.push_environment()
+        for_stmt.var_decl.accept(self)
+        start_idx = len(self.curr_template.instructions)
+        self.temp_count = 0
+        for_stmt.condition.accept(self)
+        self.add_instr(RegOpCode.JMPF, self.curr_reg, -1)
+        jmpf_idx = len(self.curr_template.instructions) - 1
+        self.visit_stmts(for_stmt.stmts)
+        self.visit_stmts([for_stmt.assign_stmt])
+        self.var_table.pop_environment()
+        self.add_instr(RegOpCode.JMP, start_idx)
+        self.patch(jmpf_idx)
+
+
+    def visit_if_stmt(self, if_stmt):
+        end_jmp_idxs = []
+        for part in [if_stmt.if_part] + if_stmt.else_ifs:
+            self.temp_count = 0
+            part.condition.accept(self)
+            self.add_instr(RegOpCode.JMPF, self.curr_reg, -1)
+            jmpf_idx = len(self.curr_template.instructions) - 1
+            self.var_table.push_environment()
+            self.visit_stmts(part.stmts)
+            self.var_table.pop_environment()
+            # after the body executes, go to the very end
+            self.add_instr(RegOpCode.JMP, -1)
+            end_jmp_idxs.append(len(self.curr_template.instructions) - 1)
+            self.patch(jmpf_idx)
+        self.var_table.push_environment()
+        self.visit_stmts(if_stmt.else_stmts)
+        self.var_table.pop_environment()
+        for idx in end_jmp_idxs:
+            self.patch(idx)
+
+
+    def visit_call_expr(self, call_expr):
+        name = call_expr.fun_name.lexeme
+        args = []
+        for arg in call_expr.args:
+            arg.accept(self)
+            args.append(self.curr_reg)
+        if name == 'print':
+            self.add_instr(RegOpCode.WRITE, args[0])
+            self.curr_reg = None
+            return
+        dest = self.new_temp()
+        if name == 'input':
+            self.add_instr(RegOpCode.READ, dest)
+        elif name == 'itos' or name == 'dtos':
+            self.add_instr(RegOpCode.TOSTR, dest, args[0])
+        elif name == 'stoi' or name == 'dtoi':
+            self.add_instr(RegOpCode.TOINT, dest, args[0])
+        elif name == 'itod' or name == 'stod':
+            self.add_instr(RegOpCode.TODBL, dest, args[0])
+        elif name == 'length':
+            self.add_instr(RegOpCode.LEN, dest, args[0])
+        elif name == 'get':
+            self.add_instr(RegOpCode.GETC, dest, args[0], args[1])
+        else:
+            self.add_instr(RegOpCode.CALL, dest, name, tuple(args))
+        self.curr_reg = dest
+
+
+    def visit_expr(self, expr):
+        if expr.op is None:
+            expr.first.accept(self)
+            result = self.curr_reg
+        else:
+            op = expr.op.lexeme
+            # same evaluation order as the stack VM: > and >= evaluate
+            # the rest first and are then compared as < and <=
+            if op == '>' or op == '>=':
+                expr.rest.accept(self)
+                left = self.curr_reg
+                expr.first.accept(self)
+                right = self.curr_reg
+            else:
+                expr.first.accept(self)
+                left = self.curr_reg
+                expr.rest.accept(self)
+                right = self.curr_reg
+            result = self.new_temp()
+            self.add_instr(REG_BINARY_OPS[op], result, left, right)
+        if expr.not_op:
+            reg = self.new_temp()
+            self.add_instr(RegOpCode.NOT, reg, result)
+            result = reg
+        self.curr_reg = result
+
+
+    def visit_data_type(self, data_type):
+        # nothing to do here
+        pass
+
+
+    def visit_var_def(self, var_def):
+        # nothing to do here
+        pass
+
+
+    def visit_simple_term(self, simple_term):
+        simple_term.rvalue.accept(self)
+
+
+    def visit_complex_term(self, complex_term):
+        complex_term.expr.accept(self)
+
+
+    def visit_simple_rvalue(self, simple_rvalue):
+        val = simple_rvalue.value.lexeme
+        if simple_rvalue.value.token_type == TokenType.INT_VAL:
+            self.curr_reg = self.const(int(val))
+        elif simple_rvalue.value.token_type == TokenType.DOUBLE_VAL:
+            self.curr_reg = self.const(float(val))
+        elif simple_rvalue.value.token_type == TokenType.STRING_VAL:
+            val = val.replace('\\n', '\n')
+            val = val.replace('\\t', '\t')
+            self.curr_reg = self.const(val)
+        elif val == 'true':
+            self.curr_reg = self.const(True)
+        elif val == 'false':
+            self.curr_reg = self.const(False)
+        elif val == 'null':
+            self.curr_reg = self.const(None)
+
+
+    def visit_new_rvalue(self, new_rvalue):
+        obj = self.new_temp()
+        # struct
+        if new_rvalue.array_expr is None:
+            srcs = []
+            for param in new_rvalue.struct_params:
+                param.accept(self)
+                srcs.append(self.curr_reg)
+            self.add_instr(RegOpCode.NEWS, obj, new_rvalue.type_name.lexeme, tuple(srcs))
+        # array
+        else:
+            new_rvalue.array_expr.accept(self)
+            self.add_instr(RegOpCode.ALLOCA, obj, self.curr_reg)
+        self.curr_reg = obj
+
+
+    def visit_var_rvalue(self, var_rvalue):
+        path = var_rvalue.path
+        if id(var_rvalue) in self.escapes.uses:
+            path = slot_path(path)
+        reg = self.var_table.get(path[0].var_name.lexeme)
+        type_name = self.var_table.get_type(path[0].var_name.lexeme)
+        for i in range(len(path)):
+            if i > 0:
+                offset, type_name = self.layouts[type_name][path[i].var_name.lexeme]
+                obj = self.new_temp()
+                self.add_instr(RegOpCode.GETF, obj, reg, offset)
+                reg = obj
+            if path[i].array_expr is not None:
+                path[i].array_expr.accept(self)
+                elem = self.new_temp()
+                self.add_instr(RegOpCode.GETI, elem, reg, self.curr_reg)
+                reg = elem
+        self.curr_reg = reg
+
+
+# binary operator -> register opcode (> and >= swap their operands)
+REG_BINARY_OPS = {
+    '+': RegOpCode.ADD, '-': RegOpCode.SUB, '*': RegOpCode.MUL,
+    '/': RegOpCode.DIV, 'and': RegOpCode.AND, 'or': RegOpCode.OR,
+    '==': RegOpCode.CMPEQ, '!=': RegOpCode.CMPNE, '<': RegOpCode.CMPLT,
+    '>': RegOpCode.CMPLT, '<=': RegOpCode.CMPLE, '>=': RegOpCode.CMPLE,
+}
+
+
+def code_generator(vm):
+    """Returns the code generator for the VM's execution engine."""
+    if vm.engine == 'py':
+        return PyCodeGenerator(vm)
+    if vm.engine == 'register':
+        return RegCodeGenerator(vm)
+    return CodeGenerator(vm)
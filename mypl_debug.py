@@ -0,0 +1,100 @@
+"""Instruction trace events and sinks for debugging the MyPL VM.
+
+VM.run(debug=True), or VM.run(trace=sink), runs the program in a
+separate instrumented run loop (the production loops have no debug
+checks) that reports each instruction about to execute to a trace
+sink as a TraceEvent. A sink can be limited to some functions and to
+a range of instruction offsets, and writes events as text or as JSON
+lines.
+
+NAME: Colin McClelland
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+import json
+import sys
+from dataclasses import dataclass
+from typing import Any
+
+
+@dataclass(slots=True)
+class TraceEvent:
+    """An instruction about to execute: the function it is in, its pc,
+    the instruction, the value on top of the operand stack (None if
+    empty), and the number of frames on the call stack.
+
+    """
+    function: str
+    pc: int
+    instr: Any
+    stack_top: Any
+    depth: int
+
+    def to_dict(self):
+        return {'function': self.function, 'pc': self.pc, 'instr': repr(self.instr),
+                'stack_top': repr(self.stack_top), 'depth': self.depth}
+
+
+class TraceSink:
+    """Writes the trace events it accepts to an output stream."""
+
+    def __init__(self, out=None, functions=None, pc_range=None, fmt='text'):
+        """Creates a trace sink.
+
+        Args:
+            out -- The stream to write to (default: standard output).
+            functions -- If given, only events in these functions.
+            pc_range -- If given, a (start, end) pair: only events with
+                        start <= pc < end.
+            fmt -- 'text' for a line per event, 'json' for JSON lines.
+
+        """
+        self.out = out
+        self.functions = set(functions) if functions else None
+        self.pc_range = pc_range
+        self.fmt = fmt
+
+
+    def accepts(self, function, pc):
+        """Returns True if events for the instruction at pc in the given
+        function pass the sink's filters.
+
+        """
+        if self.functions is not None and function not in self.functions:
+            return False
+        if self.pc_range is not None and not self.pc_range[0] <= pc < self.pc_range[1]:
+            return False
+        return True
+
+
+    def emit(self, event):
+        """Writes the event."""
+        out = self.out or sys.stdout
+        if self.fmt == 'json':
+            out.write(json.dumps(event.to_dict()) + '\n')
+        else:
+            out.write(f'{event.function}:{event.pc:<5} {str(event.instr):<40} '
+                      f'top={event.stack_top!r} depth={event.depth}\n')
+
+
+class ListTraceSink(TraceSink):
+    """Collects the trace events it accepts in a list (events)."""
+
+    def __init__(self, functions=None, pc_range=None):
+        super().__init__(functions=functions, pc_range=pc_range)
+        self.events = []
+
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+def parse_pc_range(text):
+    """Returns the (start, end) pair for a 'start:end' pc range, where
+    either bound may be omitted.
+
+    """
+    start, _, end = text.partition(':')
+    return (int(start) if start else 0, int(end) if end else sys.maxsize)
@@ -0,0 +1,219 @@
+"""Escape analysis of MyPL struct variables for scalar replacement.
+
+A struct variable does not escape its function if it is declared as a
+new struct, is only ever reassigned a new struct of its type, and is
+otherwise only used through its fields (n.val, n.next.val, n.xs[0],
+n.val = e, ...): it is never returned, passed to a function, stored
+in a field or an array, assigned to another variable, compared, or
+printed. Its structs are then only reachable through the variable, so
+the code generators (with VM(scalar_replace=True)) keep each field in
+a local slot of its own instead of allocating the structs on the heap.
+
+NAME: Colin McClelland
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+from mypl_token import Token
+from mypl_ast import *
+
+
+def new_struct(expr):
+    """Returns the NewRValue of an expression that is just a new struct
+    (e.g., new Node(1, null)), or None.
+
+    """
+    if expr.op is not None or expr.not_op or not isinstance(expr.first, SimpleTerm):
+        return None
+    rvalue = expr.first.rvalue
+    if isinstance(rvalue, NewRValue) and rvalue.array_expr is None:
+        return rvalue
+    return None
+
+
+def field_slot(var_name, field_name):
+    """Returns the var table name of the local slot of a scalar replaced
+    variable's field.
+
+    """
+    return f'{var_name}.{field_name}'
+
+
+def slot_path(path):
+    """Returns the path of a use of a scalar replaced variable (n.f.g)
+    rewritten to start at the local slot of its field (n.f, then .g).
+
+    """
+    name = path[1].var_name
+    slot = Token(name.token_type, field_slot(path[0].var_name.lexeme, name.lexeme),
+                 name.line, name.column)
+    return [VarRef(slot, path[1].array_expr)] + path[2:]
+
+
+class EscapeAnalysis(Visitor):
+    """Visitor finding the struct variables of each function that can
+    be scalar replaced. After visiting a program, replaced holds the
+    ids of their VarDecl nodes, and uses the ids of the VarRValue and
+    AssignStmt nodes whose path starts at one of them.
+
+    """
+
+    def __init__(self):
+        self.struct_defs = {}
+        self.replaced = set()
+        self.uses = set()
+        # scopes of the function being analyzed: var name -> the id
+        # of a candidate struct variable's VarDecl, or None
+        self.environments = []
+        # id of a candidate VarDecl -> ids of the nodes using it
+        self.candidate_uses = {}
+        self.escaped = set()
+
+
+    def lookup(self, var_name):
+        """Returns the id of the candidate VarDecl the variable name refers
+        to in the current scope, or None.
+
+        """
+        for env in reversed(self.environments):
+            if var_name in env:
+                return env[var_name]
+        return None
+
+
+    def visit_stmts(self, stmts):
+        self.environments.append({})
+        for stmt in stmts:
+            stmt.accept(self)
+        self.environments.pop()
+
+
+    def visit_program(self, program):
+        for struct_def in program.struct_defs:
+            struct_def.accept(self)
+        for fun_def in program.fun_defs:
+            fun_def.accept(self)
+
+
+    def visit_struct_def(self, struct_def):
+        self.struct_defs[struct_def.struct_name.lexeme] = struct_def
+
+
+    def visit_fun_def(self, fun_def):
+        self.candidate_uses = {}
+        self.escaped = set()
+        self.environments = [{param.var_name.lexeme: None for param in fun_def.params}]
+        self.visit_stmts(fun_def.stmts)
+        self.environments = []
+        for decl_id, uses in self.candidate_uses.items():
+            if decl_id not in self.escaped:
+                self.replaced.add(decl_id)
+                self.uses.update(uses)
+
+
+    def visit_return_stmt(self, return_stmt):
+        return_stmt.expr.accept(self)
+
+
+    def visit_var_decl(self, var_decl):
+        if var_decl.expr.first is not None:
+            var_decl.expr.accept(self)
+        data_type = var_decl.var_def.data_type
+        candidate = None
+        new = new_struct(var_decl.expr) if var_decl.expr.first is not None else None
+        if (not data_type.is_array and data_type.type_name.lexeme in self.struct_defs
+                and new is not None and new.type_name.lexeme == data_type.type_name.lexeme):
+            candidate = id(var_decl)
+            self.candidate_uses[candidate] = []
+        self.environments[-1][var_decl.var_def.var_name.lexeme] = candidate
+
+
+    def visit_assign_stmt(self, assign_stmt):
+        lvalue = assign_stmt.lvalue
+        candidate = self.lookup(lvalue[0].var_name.lexeme)
+        if candidate is not None:
+            if len(lvalue) > 1 or new_struct(assign_stmt.expr) is not None:
+                self.candidate_uses[candidate].append(id(assign_stmt))
+            else:
+                self.escaped.add(candidate)
+        for ref in lvalue:
+            if ref.array_expr is not None:
+                ref.array_expr.accept(self)
+        assign_stmt.expr.accept(self)
+
+
+    def visit_while_stmt(self, while_stmt):
+        while_stmt.condition.accept(self)
+        self.visit_stmts(while_stmt.stmts)
+
+
+    def visit_for_stmt(self, for_stmt):
+        self.environments.append({})
+        for_stmt.var_decl.accept(self)
+        for_stmt.condition.accept(self)
+        self.visit_stmts(for_stmt.stmts)
+        for_stmt.assign_stmt.accept(self)
+        self.environments.pop()
+
+
+    def visit_if_stmt(self, if_stmt):
+        for part in [if_stmt.if_part] + if_stmt.else_ifs:
+            part.condition.accept(self)
+            self.visit_stmts(part.stmts)
+        self.visit_stmts(if_stmt.else_stmts)
+
+
+    def visit_call_expr(self, call_expr):
+        for arg in call_expr.args:
+            arg.accept(self)
+
+
+    def visit_expr(self, expr):
+        expr.first.accept(self)
+        if expr.rest is not None:
+            expr.rest.accept(self)
+
+
+    def visit_data_type(self, data_type):
+        # nothing to do here
+        pass
+
+
+    def visit_var_def(self, var_def):
+        # nothing to do here
+        pass
+
+
+    def visit_simple_term(self, simple_term):
+        simple_term.rvalue.accept(self)
+
+
+    def visit_complex_term(self, complex_term):
+        complex_term.expr.accept(self)
+
+
+    def visit_simple_rvalue(self, simple_rvalue):
+        # nothing to do here
+        pass
+
+
+    def visit_new_rvalue(self, new_rvalue):
+        if new_rvalue.array_expr is not None:
+            new_rvalue.array_expr.accept(self)
+        else:
+            for param in new_rvalue.struct_params:
+                param.accept(self)
+
+
+    def visit_var_rvalue(self, var_rvalue):
+        path = var_rvalue.path
+        candidate = self.lookup(path[0].var_name.lexeme)
+        if candidate is not None:
+            if len(path) > 1:
+                self.candidate_uses[candidate].append(id(var_rvalue))
+            else:
+                self.escaped.add(candidate)
+        for ref in path:
+            if ref.array_expr is not None:
+                ref.array_expr.accept(self)
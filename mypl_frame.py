@@ -10,18 +10,89 @@ CLASS: CPSC 326
 
 from dataclasses import dataclass, field
 from typing import Any
-from mypl_opcode import OpCode
+from mypl_opcode import OpCode, REG_OPERANDS
 
 
 @dataclass
 class VMFrameTemplate:
-    """A VM function-call frame template (type)."""
+    """A VM function-call frame template (type).
+
+    The instructions are kept for display (--ir) and debugging. The VM
+    executes from the packed opcodes and operands tuples, which hold
+    the opcode values and operands of the instructions followed by an
+    end-of-code sentinel (opcode value 0), filled in by lower(). The
+    closure engine caches the template's compiled closures in closures.
+
+    Templates generated for the register engine hold RegInstrs, and
+    registers is the initial register file of a frame: a slot for
+    each variable and temporary followed by the function's constants.
+
+    Frames are created with local_count variable slots, and
+    max_stack_depth is the most values the operand stack can hold
+    (both None until set by the code generator or size_frame()).
+    Frames of the function that have returned are kept in free_frames
+    for reuse by later calls.
+
+    """
     function_name: str
     arg_count: int
     instructions: list['VMInstr'] = field(default_factory=list) 
+    opcodes: tuple[int, ...] = ()
+    operands: tuple[Any, ...] = ()
+    closures: list[Any] = field(default_factory=list)
+    registers: list[Any] = field(default_factory=list)
+    local_count: int = None
+    max_stack_depth: int = None
+    free_frames: list['VMFrame'] = field(default_factory=list)
+
+    def size_frame(self, arg_counts=None, field_counts=None):
+        """Sets local_count (if not set) to the number of variable slots
+        the instructions use, and max_stack_depth to the deepest the
+        operand stack gets along any path through the instructions
+        (starting with the arguments on the stack). Each call pops the
+        number of arguments given for the function in arg_counts (none
+        if missing, which over-estimates the depth), and each NEWS the
+        number of fields given for the struct in field_counts.
+
+        """
+        arg_counts = arg_counts or {}
+        field_counts = field_counts or {}
+        instrs = self.instructions
+        if self.local_count is None:
+            slots = [instr.operand for instr in instrs if instr.opcode in (OpCode.LOAD, OpCode.STORE)]
+            self.local_count = max(slots, default=-1) + 1
+        max_depth = self.arg_count
+        visited = set()
+        work = [(0, self.arg_count)]
+        while work:
+            pc, depth = work.pop()
+            if pc in visited or pc >= len(instrs):
+                continue
+            visited.add(pc)
+            instr = instrs[pc]
+            if instr.opcode == OpCode.CALL:
+                depth += 1 - arg_counts.get(instr.operand, 0)
+            elif instr.opcode == OpCode.NEWS:
+                depth += 1 - field_counts.get(instr.operand, 0)
+            else:
+                depth += STACK_EFFECTS[instr.opcode]
+            max_depth = max(max_depth, depth)
+            if instr.opcode in (OpCode.JMP, OpCode.JMPF):
+                work.append((instr.operand, depth))
+            if instr.opcode not in (OpCode.JMP, OpCode.RET):
+                work.append((pc + 1, depth))
+        self.max_stack_depth = max_depth
+
+    def lower(self):
+        """Pack the instructions into the parallel opcodes and operands
+        tuples executed by the VM run loop.
+
+        """
+        self.opcodes = tuple(instr.opcode.value for instr in self.instructions) + (0,)
+        self.operands = tuple(instr.operand for instr in self.instructions) + (None,)
 
     
-@dataclass
+@dataclass(slots=True)
 class VMFrame:
     """A VM function-call frame."""
     template: VMFrameTemplate
@@ -30,7 +101,32 @@ class VMFrame:
     operand_stack: list[Any] = field(default_factory=list) 
 
 
-@dataclass
+class HeapRef(int):
+    """A reference to a heap object, held in frames and in objects: the
+    object's number as an int subclass, so references take no more
+    memory than their number, hash and compare like it (the heap tables
+    can be indexed by either), and are told from other values by
+    type(val) == HeapRef.
+
+    """
+    __slots__ = ()
+
+
+class Struct(list):
+    """A struct object: the list of its field values, in the order the
+    struct's fields are declared (GETF and SETF take a field's offset,
+    resolved by the code generator). Each struct type is a subclass
+    (see VM.add_struct_type) whose fields attribute names the fields by
+    offset, so objects take no memory for their field names. Structs
+    are told from arrays on the copying collector's heap by
+    isinstance(obj, Struct).
+
+    """
+    __slots__ = ()
+    fields = ()
+
+
+@dataclass(slots=True)
 class VMInstr:
     """A VM instruction."""
     opcode: OpCode
@@ -44,6 +140,45 @@ class VMInstr:
         s += f'  // {self.comment}' if self.comment else ''
         return s
 
+# opcode -> change in operand stack size (CALL depends on the callee,
+# and NEWS on its struct's field count)
+STACK_EFFECTS = {
+    OpCode.PUSH: 1, OpCode.POP: -1, OpCode.LOAD: 1, OpCode.STORE: -1,
+    OpCode.ADD: -1, OpCode.SUB: -1, OpCode.MUL: -1, OpCode.DIV: -1,
+    OpCode.CMPLT: -1, OpCode.CMPLE: -1, OpCode.CMPEQ: -1, OpCode.CMPNE: -1,
+    OpCode.AND: -1, OpCode.OR: -1, OpCode.NOT: 0,
+    OpCode.JMP: 0, OpCode.JMPF: -1, OpCode.RET: -1,
+    OpCode.WRITE: -1, OpCode.READ: 1, OpCode.LEN: 0, OpCode.GETC: -1,
+    OpCode.TOINT: 0, OpCode.TODBL: 0, OpCode.TOSTR: 0,
+    OpCode.SETF: -2, OpCode.GETF: 0, OpCode.ALLOCA: 0,
+    OpCode.SETI: -3, OpCode.GETI: -1, OpCode.DUP: 1, OpCode.NOP: 0,
+}
+
+
+@dataclass(slots=True)
+class RegInstr:
+    """A register machine instruction, whose operand is the tuple of
+    its operands (see REG_OPERANDS).
+
+    """
+    opcode: Any
+    operand: tuple = ()
+    comment: str = ''
+
+    def __repr__(self):
+        args = []
+        for kind, arg in zip(REG_OPERANDS[self.opcode], self.operand):
+            if kind in 'dr':
+                args.append(f'r{arg}')
+            elif kind == 'A':
+                args.append('(' + ', '.join(f'r{reg}' for reg in arg) + ')')
+            else:
+                args.append(str(arg))
+        s = f'{self.opcode}({", ".join(args)})'
+        s += f'  // {self.comment}' if self.comment else ''
+        return s
+
+
 # Helper functions for creating specific instruction types
 
 def PUSH(value):
@@ -124,14 +259,14 @@ def TODBL():
 def TOSTR():
     return VMInstr(OpCode.TOSTR)
 
-def ALLOCS():
-    return VMInstr(OpCode.ALLOCS)
+def NEWS(struct_name):
+    return VMInstr(OpCode.NEWS, struct_name)
 
-def SETF(field_name):
-    return VMInstr(OpCode.SETF, field_name)
+def SETF(field_offset):
+    return VMInstr(OpCode.SETF, field_offset)
 
-def GETF(field_name):
-    return VMInstr(OpCode.GETF, field_name)
+def GETF(field_offset):
+    return VMInstr(OpCode.GETF, field_offset)
 
 def ALLOCA():
     return VMInstr(OpCode.ALLOCA)
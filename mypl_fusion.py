@@ -0,0 +1,94 @@
+"""Superinstruction fusion pass for MyPL VM code.
+
+Runs over a function's instructions after code generation and replaces
+common instruction sequences (e.g., LOAD a; PUSH v; ADD; STORE b for
+i = i + 1, or LOAD a; PUSH v; CMPLT; JMPF t for a loop test) with a
+single superinstruction (see SUPERINSTRUCTIONS in mypl_opcode), so
+the VM dispatches once instead of once per instruction. The operand of
+a superinstruction is the tuple of the operands of the instructions it
+replaces (in order, skipping instructions without operands). Jump
+offsets are remapped to the fused code, and a sequence is never fused
+if a jump lands inside of it.
+
+NAME: Colin McClelland
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+from mypl_opcode import OpCode, SUPERINSTRUCTIONS
+from mypl_frame import VMInstr
+
+
+# instructions that take an operand
+OPERAND_OPCODES = {OpCode.PUSH, OpCode.LOAD, OpCode.STORE, OpCode.JMP,
+                   OpCode.JMPF, OpCode.CALL, OpCode.NEWS, OpCode.SETF,
+                   OpCode.GETF}
+
+# patterns to match, longest first (so LOAD a; PUSH v; ADD; STORE b is
+# not fused as LOAD_PUSH_ADD followed by STORE)
+PATTERNS = sorted(SUPERINSTRUCTIONS.items(), key=lambda item: -len(item[1]))
+
+
+def fuse_instructions(instructions, counts=None):
+    """Returns the instructions with fusible sequences replaced by
+    superinstructions.
+
+    Args:
+        instructions -- The function's instruction list.
+        counts -- Optional Counter updated with the number of times
+                  each superinstruction was created.
+
+    """
+    opcodes = [instr.opcode for instr in instructions]
+    targets = {instr.operand for instr in instructions
+               if instr.opcode in (OpCode.JMP, OpCode.JMPF)}
+    # group the instructions as (start, length, superinstruction)
+    groups = []
+    i = 0
+    while i < len(instructions):
+        group = (i, 1, None)
+        for fused, pattern in PATTERNS:
+            end = i + len(pattern)
+            if tuple(opcodes[i:end]) == pattern and targets.isdisjoint(range(i + 1, end)):
+                group = (i, len(pattern), fused)
+                break
+        groups.append(group)
+        i += group[1]
+    # old offset -> new offset for jump targets
+    new_offset = {start: new for new, (start, _, _) in enumerate(groups)}
+    new_offset[len(instructions)] = len(groups)
+    fused_instrs = []
+    for start, length, fused in groups:
+        instrs = instructions[start:start + length]
+        operands = [new_offset[instr.operand] if instr.opcode in (OpCode.JMP, OpCode.JMPF)
+                    else instr.operand for instr in instrs]
+        if fused is None:
+            fused_instrs.append(VMInstr(instrs[0].opcode, operands[0], instrs[0].comment))
+            continue
+        operand = tuple(operands[j] for j in range(length) if instrs[j].opcode in OPERAND_OPCODES)
+        comment = '; '.join(instr.comment for instr in instrs if instr.comment)
+        fused_instrs.append(VMInstr(fused, operand, comment))
+        if counts is not None:
+            counts[fused.name] += 1
+    return fused_instrs
+
+
+def split_operand(fused, operand):
+    """Returns the (opcode, operand) pairs of the instructions replaced
+    by the given superinstruction and its operand.
+
+    """
+    operands = iter(operand)
+    return [(opcode, next(operands) if opcode in OPERAND_OPCODES else None)
+            for opcode in SUPERINSTRUCTIONS[fused]]
+
+
+def fusion_report(counts):
+    """Returns a printable summary of the superinstructions created."""
+    total = sum(counts.values())
+    lines = [f'{"superinstruction":<24}{"fused":>8}']
+    for name, count in counts.most_common():
+        lines.append(f'{name:<24}{count:>8}')
+    lines.append(f'{"total":<24}{total:>8}')
+    return '\n'.join(lines)
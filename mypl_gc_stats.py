@@ -0,0 +1,130 @@
+"""Garbage collection statistics for the MyPL VM.
+
+The VM records every collection it runs (full mark-sweep collections,
+nursery collections, completed incremental collections, reference
+counting releases, and copying collections) in its GCStats, which keeps
+running totals and a GCEvent for each of the last GC_EVENTS_KEPT, with
+the pause, the time spent marking (or copying) and sweeping, the
+number of objects on the heap before and after, and the number of
+structs and arrays freed. VM.gc_stats() returns the summary, and
+report() formats it with a histogram of the pauses.
+
+NAME: Colin McClelland
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+from bisect import bisect_right
+from collections import Counter, deque
+from dataclasses import dataclass
+
+
+# upper bounds (in milliseconds) of the pause histogram buckets
+PAUSE_BUCKETS = (0.01, 0.1, 1, 10, 100, 1000)
+
+# the most recent collections kept as GCEvents
+GC_EVENTS_KEPT = 1000
+
+
+@dataclass(slots=True)
+class GCEvent:
+    """A collection: the collector that ran it, its (longest) pause,
+    mark (or copy) and sweep times in seconds, the objects on the heap
+    before and after, and the structs and arrays freed.
+
+    """
+    collector: str
+    pause: float
+    mark_time: float
+    sweep_time: float
+    live_before: int
+    live_after: int
+    freed_structs: int
+    freed_arrays: int
+
+
+class GCStats:
+    """The collections run by a VM: running totals over all of them,
+    and GCEvents for the most recent max_events (so a long run keeps
+    a bounded amount of statistics).
+
+    """
+
+    def __init__(self, max_events=GC_EVENTS_KEPT):
+        self.events = deque(maxlen=max_events)
+        self.collections = 0
+        self.by_collector = Counter()
+        self.pause_total = 0.0
+        self.pause_max = 0.0
+        self.mark_time = 0.0
+        self.sweep_time = 0.0
+        self.freed_structs = 0
+        self.freed_arrays = 0
+        # pauses per PAUSE_BUCKETS bucket (the last for longer pauses)
+        self.pause_counts = [0] * (len(PAUSE_BUCKETS) + 1)
+
+
+    def record(self, collector, pause, mark_time, sweep_time, live_before,
+               live_after, freed_structs, freed_arrays):
+        """Adds a collection."""
+        self.collections += 1
+        self.by_collector[collector] += 1
+        self.pause_total += pause
+        self.pause_max = max(self.pause_max, pause)
+        self.mark_time += mark_time
+        self.sweep_time += sweep_time
+        self.freed_structs += freed_structs
+        self.freed_arrays += freed_arrays
+        self.pause_counts[bisect_right(PAUSE_BUCKETS, pause * 1000)] += 1
+        self.events.append(GCEvent(collector, pause, mark_time, sweep_time, live_before,
+                                   live_after, freed_structs, freed_arrays))
+
+
+    def summary(self):
+        """Returns a dictionary summarizing the collections (with the
+        GCEvents of the most recent ones).
+
+        """
+        return {
+            'collections': self.collections,
+            'by_collector': dict(self.by_collector),
+            'pause_total': self.pause_total,
+            'pause_max': self.pause_max,
+            'pause_mean': self.pause_total / self.collections if self.collections else 0.0,
+            'mark_time': self.mark_time,
+            'sweep_time': self.sweep_time,
+            'freed_structs': self.freed_structs,
+            'freed_arrays': self.freed_arrays,
+            'pause_histogram': self.histogram(),
+            'events': list(self.events),
+        }
+
+
+    def histogram(self):
+        """Returns the number of pauses in each bucket as a list of
+        (upper bound in ms, count) pairs, the last bound being None.
+
+        """
+        return list(zip(PAUSE_BUCKETS + (None,), self.pause_counts))
+
+
+    def report(self):
+        """Returns a printable summary with a pause histogram."""
+        stats = self.summary()
+        collectors = ', '.join(f'{name} {count}' for name, count in stats['by_collector'].items())
+        lines = [f'gc collections: {stats["collections"]}' + (f' ({collectors})' if collectors else ''),
+                 f'gc pause total: {stats["pause_total"] * 1000:.3f} ms, '
+                 f'max: {stats["pause_max"] * 1000:.3f} ms, mean: {stats["pause_mean"] * 1000:.3f} ms',
+                 f'gc mark time: {stats["mark_time"] * 1000:.3f} ms, '
+                 f'sweep time: {stats["sweep_time"] * 1000:.3f} ms',
+                 f'gc freed: {stats["freed_structs"]} structs, {stats["freed_arrays"]} arrays',
+                 'gc pauses:']
+        largest = max((count for _, count in stats['pause_histogram']), default=0)
+        lower = 0
+        for bound, count in stats['pause_histogram']:
+            label = f'{lower:g}-{bound:g} ms' if bound is not None else f'>= {lower:g} ms'
+            bar = '#' * (count * 40 // largest) if largest else ''
+            lines.append(f'  {label:<14}{count:>8} {bar}')
+            lower = bound
+        return '\n'.join(lines)
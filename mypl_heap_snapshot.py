@@ -0,0 +1,200 @@
+"""Heap snapshots of the MyPL VM for leak analysis.
+
+A snapshot lists every object on the heap (reachable or not yet
+collected) with its kind, an estimate of its size in bytes, its
+references to other objects (labeled by field name or array index),
+and the path by which it is retained: the frame slot it is reached
+from and the references followed from there (the shortest such path).
+Snapshots are written object by object, as JSON or as a Graphviz DOT
+graph, so a large heap does not have to be formatted in memory first.
+
+VM.heap_snapshot() writes a snapshot of the heap at that point of the
+run (e.g., from a TraceSink), and mypl --heap-snapshot-on-exit writes
+one when the program ends.
+
+NAME: Colin McClelland
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+import json
+import sys
+from collections import deque
+
+from mypl_frame import HeapRef, Struct
+
+
+# the hops kept at each end of a long retaining path
+PATH_HOPS = 4
+
+
+def heap_objects(vm):
+    """Yields the (object number, kind, Struct or array list) of each
+    object on the VM's heap, in allocation order.
+
+    """
+    if vm.heap is not None:
+        for num, data in enumerate(vm.heap):
+            yield num, 'struct' if isinstance(data, Struct) else 'array', data
+        return
+    heaps = {'struct': vm.struct_heap, 'array': vm.array_heap}
+    for num, obj in vm.object_graph.items():
+        yield num, obj.kind, heaps[obj.kind][num]
+
+
+def slots(data):
+    """Returns the (label, value) pairs of a struct's fields, labeled
+    by name, or an array's elements, labeled by index.
+
+    """
+    if isinstance(data, Struct):
+        return zip(data.fields, data)
+    return enumerate(data)
+
+
+def size_estimate(data):
+    """Returns the estimated size in bytes of an object: its container
+    and the non-reference values it holds.
+
+    """
+    size = sys.getsizeof(data)
+    for _, val in slots(data):
+        if val is not None and type(val) != HeapRef:
+            size += sys.getsizeof(val)
+    return size
+
+
+def root_slots(frames):
+    """Yields the (label, object number) of each object reference in
+    the variables and operand stacks of the given frames.
+
+    """
+    for depth, frame in enumerate(frames):
+        name = f'{frame.template.function_name}#{depth}'
+        for i, val in enumerate(frame.variables):
+            if type(val) == HeapRef:
+                yield f'{name}.var{i}', val
+        for i, val in enumerate(frame.operand_stack):
+            if type(val) == HeapRef:
+                yield f'{name}.stack{i}', val
+
+
+def py_root_slots(frames):
+    """Yields the (label, object number) of each object reference in
+    the locals of the given Python frames of compiled mypl functions
+    (py engine).
+
+    """
+    for depth, frame in enumerate(frames):
+        # compiled functions are named f_<name>
+        name = f'{frame.f_code.co_name[2:]}#{depth}'
+        # variables (v<slot>) first, then temporaries (t<n>)
+        local_vars = sorted(frame.f_locals.items(), key=lambda item: item[0][0] != 'v')
+        for var, val in local_vars:
+            if type(val) == HeapRef:
+                yield f'{name}.{var}', val
+
+
+def retainers(objects, roots):
+    """Returns object number -> (retaining object number or None for a
+    root, label, first hops of the path) for the objects reachable from
+    the roots, found breadth first so each has a shortest path.
+
+    """
+    retained = {}
+    queue = deque()
+    for label, num in roots:
+        if num not in retained:
+            retained[num] = (None, label, (label,))
+            queue.append(num)
+    while queue:
+        num = queue.popleft()
+        prefix = retained[num][2]
+        data = objects.get(num)
+        if data is None:
+            continue
+        for label, val in slots(data):
+            if type(val) == HeapRef and val not in retained:
+                hop = f'{num}.{label}'
+                first = prefix + (hop,) if len(prefix) < PATH_HOPS else prefix
+                retained[val] = (num, hop, first)
+                queue.append(val)
+    return retained
+
+
+def retaining_path(num, retained):
+    """Returns the retaining path of the object as a list of hops from
+    its root (None if unreachable), with '...' standing for the middle
+    of a long path.
+
+    """
+    if num not in retained:
+        return None
+    hops = []
+    parent = num
+    while parent is not None and len(hops) < 2 * PATH_HOPS:
+        parent, hop, _ = retained[parent]
+        hops.append(hop)
+    hops.reverse()
+    if parent is None:
+        return hops
+    return list(retained[num][2]) + ['...'] + hops[-PATH_HOPS:]
+
+
+def write_snapshot(vm, out, fmt='json', frames=None):
+    """Writes a snapshot of the VM's heap to the stream out.
+
+    Args:
+        vm -- The VM.
+        out -- The text stream to write to.
+        fmt -- 'json' or 'dot'.
+        frames -- The frames whose slots are the roots (default: the
+                  frames on the call stack), Python frames for the py
+                  engine.
+
+    """
+    if frames is None:
+        frames = vm.call_stack
+    if vm.engine == 'py':
+        roots = list(py_root_slots(frames))
+    else:
+        roots = list(root_slots(frames))
+    objects = {num: data for num, _, data in heap_objects(vm)}
+    retained = retainers(objects, roots)
+    if fmt == 'dot':
+        write_dot(vm, out, roots, retained)
+    else:
+        write_json(vm, out, roots, retained)
+
+
+def write_json(vm, out, roots, retained):
+    out.write('{"objects": [\n')
+    count = 0
+    total = 0
+    for num, kind, data in heap_objects(vm):
+        size = size_estimate(data)
+        edges = [{'label': label, 'to': val} for label, val in slots(data) if type(val) == HeapRef]
+        entry = {'id': num, 'kind': kind, 'size': size, 'edges': edges,
+                 'reachable': num in retained, 'path': retaining_path(num, retained)}
+        out.write((',\n' if count else '') + json.dumps(entry))
+        count += 1
+        total += size
+    out.write('\n],\n"roots": ' + json.dumps([{'label': label, 'to': num} for label, num in roots]))
+    summary = {'objects': count, 'reachable': len(retained), 'size': total}
+    out.write(',\n"summary": ' + json.dumps(summary) + '}\n')
+
+
+def write_dot(vm, out, roots, retained):
+    out.write('digraph heap {\n')
+    out.write('  node [shape=record];\n')
+    for label, num in roots:
+        out.write(f'  "{label}" [shape=box];\n')
+        out.write(f'  "{label}" -> n{num};\n')
+    for num, kind, data in heap_objects(vm):
+        style = '' if num in retained else ', style=dashed'
+        out.write(f'  n{num} [label="{num} {kind} {size_estimate(data)}B"{style}];\n')
+        for label, val in slots(data):
+            if type(val) == HeapRef:
+                out.write(f'  n{num} -> n{val} [label="{label}"];\n')
+    out.write('}\n')
@@ -0,0 +1,340 @@
+"""Hot-loop tracing JIT for the MyPL VM (table engine).
+
+The VM counts how often each backward JMP (the loop back edges emitted
+by visit_while_stmt and visit_for_stmt) reaches its loop head. Once a
+loop is hot, one iteration of its body is interpreted while recording
+the instructions executed, the direction taken by each branch, and the
+types of the values involved. The recorded trace is compiled into a
+Python function that runs whole iterations with the frame's variables
+held in Python locals. Type and branch guards check that later
+iterations follow the recorded path; when one fails the trace writes
+its state back into the frame (variables and operand stack) and
+returns the pc where the interpreter resumes (deoptimization).
+
+Only innermost loops without calls, returns, input, or allocations are
+traced; any other loop is blacklisted and stays interpreted.
+
+NAME: Colin McClelland
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+from mypl_opcode import OpCode, SUPERINSTRUCTIONS
+from mypl_fusion import split_operand
+from mypl_frame import HeapRef
+
+
+# loop head visits before a loop is traced
+JIT_THRESHOLD = 50
+
+# longest trace (in instructions) that will be recorded
+MAX_TRACE_LENGTH = 500
+
+# opcodes a trace may contain (recording stops at anything else)
+TRACEABLE = {op.value for op in [
+    OpCode.PUSH, OpCode.POP, OpCode.LOAD, OpCode.STORE, OpCode.ADD,
+    OpCode.SUB, OpCode.MUL, OpCode.DIV, OpCode.CMPLT, OpCode.CMPLE,
+    OpCode.CMPEQ, OpCode.CMPNE, OpCode.AND, OpCode.OR, OpCode.NOT,
+    OpCode.JMP, OpCode.JMPF, OpCode.WRITE, OpCode.LEN, OpCode.GETC,
+    OpCode.TOINT, OpCode.TODBL, OpCode.TOSTR, OpCode.SETF, OpCode.GETF,
+    OpCode.SETI, OpCode.GETI, OpCode.DUP, OpCode.NOP]}
+
+# superinstructions are recorded as the instructions they replace (none
+# of which guard anything but a final branch, so every guard in one can
+# resume after it or at its jump target)
+FUSED = {op.value for op in SUPERINSTRUCTIONS}
+TRACEABLE |= FUSED
+
+# built-ins run in a trace through their VM handler
+HANDLER_OPS = {op.value for op in [
+    OpCode.WRITE, OpCode.LEN, OpCode.GETC, OpCode.TOINT, OpCode.TODBL,
+    OpCode.TOSTR]}
+
+
+# opcodes whose pushed value type is recorded (and guarded)
+RESULT_OPS = {op.value for op in [
+    OpCode.GETF, OpCode.GETI, OpCode.LEN, OpCode.GETC, OpCode.TOINT,
+    OpCode.TODBL, OpCode.TOSTR]}
+
+
+class TraceEntry:
+    """One recorded instruction: its pc, opcode value, operand, whether
+    a branch was taken, and the type of the value it pushed (if any).
+
+    """
+
+    def __init__(self, pc, opcode, operand):
+        self.pc = pc
+        self.opcode = opcode
+        self.operand = operand
+        self.taken = False
+        self.result_type = None
+
+
+def record_trace(vm, frame, target, back_edge):
+    """Interprets one iteration of the loop whose head is target and
+    whose back edge (JMP) is at back_edge, recording each instruction.
+
+    Returns the recorded entries if the iteration made it back to the
+    loop head, else None. Either way the frame's pc is left where the
+    interpreter should continue.
+
+    """
+    opcodes = frame.template.opcodes
+    operands = frame.template.operands
+    dispatch = vm.dispatch
+    entries = []
+    pc = target
+    while True:
+        frame.pc = pc
+        opcode = opcodes[pc]
+        if opcode not in TRACEABLE or len(entries) >= MAX_TRACE_LENGTH:
+            return None
+        if opcode == OpCode.JMP.value:
+            entries.append(TraceEntry(pc, opcode, operands[pc]))
+            if operands[pc] == target:
+                frame.pc = target
+                return entries
+            if operands[pc] < pc:
+                # an inner loop, only innermost loops are traced
+                return None
+            pc = operands[pc]
+        else:
+            frame.pc = pc + 1
+            dispatch[opcode](frame, operands[pc])
+            if opcode in FUSED:
+                for op, operand in split_operand(OpCode(opcode), operands[pc]):
+                    entries.append(TraceEntry(pc, op.value, operand))
+            else:
+                entries.append(TraceEntry(pc, opcode, operands[pc]))
+            entry = entries[-1]
+            entry.taken = frame.pc != pc + 1
+            if entry.opcode in RESULT_OPS:
+                entry.result_type = type(frame.operand_stack[-1])
+            pc = frame.pc
+        if pc < target or pc > back_edge:
+            # the iteration left the loop
+            frame.pc = pc
+            return None
+
+
+class TraceCompiler:
+    """Compiles recorded trace entries into Python source by symbolically
+    executing the operand stack. Each stack slot is a (python
+    expression, type) pair; every computed value is evaluated into its
+    own temporary so the stack can be rebuilt at any guard.
+
+    """
+
+    def __init__(self, vm, frame, target, entries):
+        self.vm = vm
+        self.target = target
+        self.entries = entries
+        # types of the variables at the loop head
+        self.entry_types = [type(val) for val in frame.variables]
+        self.lines = []
+        self.stack = []
+        self.var_types = {}       # variable -> current (static) type
+        self.guarded = []         # variables read before written
+        self.temp_count = 0
+        self.stored = sorted({e.operand for e in entries if e.opcode == OpCode.STORE.value})
+        self.used = sorted({e.operand for e in entries
+                            if e.opcode in (OpCode.LOAD.value, OpCode.STORE.value)})
+
+
+    def add_line(self, line, indent=2):
+        self.lines.append('    ' * indent + line)
+
+
+    def new_temp(self, expr, val_type):
+        """Evaluates expr into a new temporary and pushes it."""
+        temp = f's{self.temp_count}'
+        self.temp_count += 1
+        self.add_line(f'{temp} = {expr}')
+        self.stack.append((temp, val_type))
+        return temp
+
+
+    def exit_lines(self, resume_pc, stack, indent=3):
+        """Adds the lines that write the trace state back into the frame
+        and return resume_pc to the interpreter.
+
+        """
+        for i in self.stored:
+            self.add_line(f'variables[{i}] = v{i}', indent)
+        if stack:
+            self.add_line(f'stack.extend(({", ".join(s[0] for s in stack)},))', indent)
+        self.add_line(f'return {resume_pc}', indent)
+
+
+    def guard(self, cond, resume_pc, stack):
+        """Adds a guard that deoptimizes to resume_pc if cond holds."""
+        self.add_line(f'if {cond}:')
+        self.exit_lines(resume_pc, stack)
+
+
+    def materialize(self, var):
+        """Copies stack slots that read variable var into temporaries
+        (before var is overwritten).
+
+        """
+        for i in range(len(self.stack)):
+            if self.stack[i][0] == f'v{var}':
+                temp = f's{self.temp_count}'
+                self.temp_count += 1
+                self.add_line(f'{temp} = v{var}')
+                self.stack[i] = (temp, self.stack[i][1])
+
+
+    def compile(self):
+        """Returns the trace source, or None if the trace cannot be
+        compiled (unsupported types or not type stable).
+
+        """
+        for entry in self.entries:
+            if not self.compile_entry(entry):
+                return None
+        # the loop must come back around with the stack empty and with
+        # the types the entry guards check
+        if self.stack:
+            return None
+        for var in self.guarded:
+            if self.var_types[var] != self.entry_types[var]:
+                return None
+        header = ['def trace(frame):',
+                  '    variables = frame.variables',
+                  '    stack = frame.operand_stack']
+        for var in self.used:
+            header.append(f'    v{var} = variables[{var}]')
+        checks = [f'type(v{var}) is not {self.entry_types[var].__name__}' for var in self.guarded]
+        if checks:
+            header.append(f'    if {" or ".join(checks)}:')
+            header.append(f'        return {self.target}')
+        header.append('    while True:')
+        return '\n'.join(header + self.lines) + '\n'
+
+
+    def compile_entry(self, entry):
+        op = OpCode(entry.opcode)
+        operand = entry.operand
+        stack = self.stack
+        if op == OpCode.PUSH:
+            stack.append((repr(operand), type(operand)))
+        elif op == OpCode.POP:
+            stack.pop()
+        elif op == OpCode.DUP:
+            stack.append(stack[-1])
+        elif op == OpCode.LOAD:
+            if operand not in self.var_types:
+                if operand >= len(self.entry_types):
+                    return False
+                self.var_types[operand] = self.entry_types[operand]
+                self.guarded.append(operand)
+            stack.append((f'v{operand}', self.var_types[operand]))
+        elif op == OpCode.STORE:
+            expr, val_type = stack.pop()
+            self.materialize(operand)
+            self.add_line(f'v{operand} = {expr}')
+            self.var_types[operand] = val_type
+        elif op in (OpCode.ADD, OpCode.SUB, OpCode.MUL, OpCode.DIV):
+            x, x_type = stack.pop()
+            y, y_type = stack.pop()
+            allowed = (int, float, str) if op == OpCode.ADD else (int, float)
+            if x_type != y_type or x_type not in allowed:
+                return False
+            if op == OpCode.DIV:
+                # let the interpreter report division by zero
+                self.guard(f'{x} == 0', entry.pc, stack + [(y, y_type), (x, x_type)])
+                symbol = '//' if x_type == int else '/'
+            else:
+                symbol = {OpCode.ADD: '+', OpCode.SUB: '-', OpCode.MUL: '*'}[op]
+            self.new_temp(f'{y} {symbol} {x}', x_type)
+        elif op in (OpCode.CMPLT, OpCode.CMPLE):
+            x, x_type = stack.pop()
+            y, y_type = stack.pop()
+            if x_type != y_type or x_type not in (int, float, str):
+                return False
+            self.new_temp(f'{y} {"<" if op == OpCode.CMPLT else "<="} {x}', bool)
+        elif op in (OpCode.CMPEQ, OpCode.CMPNE):
+            x, _ = stack.pop()
+            y, _ = stack.pop()
+            self.new_temp(f'{y} {"==" if op == OpCode.CMPEQ else "!="} {x}', bool)
+        elif op in (OpCode.AND, OpCode.OR):
+            x, x_type = stack.pop()
+            y, y_type = stack.pop()
+            if x_type != bool or y_type != bool:
+                return False
+            self.new_temp(f'{y} {"and" if op == OpCode.AND else "or"} {x}', bool)
+        elif op == OpCode.NOT:
+            x, x_type = stack.pop()
+            if x_type != bool:
+                return False
+            self.new_temp(f'not {x}', bool)
+        elif op == OpCode.JMPF:
+            cond, cond_type = stack.pop()
+            if cond_type != bool:
+                return False
+            if entry.taken:
+                self.guard(cond, entry.pc + 1, stack)
+            else:
+                self.guard(f'not {cond}', operand, stack)
+        elif op in (OpCode.JMP, OpCode.NOP):
+            pass
+        elif op == OpCode.GETI:
+            idx, _ = stack.pop()
+            oid, _ = stack.pop()
+            self.typed_result(f'get_index({oid}, {idx})', entry)
+        elif op == OpCode.GETF:
+            oid, _ = stack.pop()
+            self.typed_result(f'get_field({oid}, {operand!r})', entry)
+        elif op == OpCode.SETI:
+            val, _ = stack.pop()
+            idx, _ = stack.pop()
+            oid, _ = stack.pop()
+            self.add_line(f'set_index({oid}, {idx}, {val})')
+        elif op == OpCode.SETF:
+            val, _ = stack.pop()
+            oid, _ = stack.pop()
+            self.add_line(f'set_field({oid}, {operand!r}, {val})')
+        elif entry.opcode in HANDLER_OPS:
+            # run the built-in's handler on the real operand stack
+            args = 2 if op == OpCode.GETC else 1
+            values = [stack.pop()[0] for _ in range(args)][::-1]
+            self.add_line(f'stack.extend(({", ".join(values)},))')
+            self.add_line(f'dispatch[{entry.opcode}](frame, None)')
+            if op != OpCode.WRITE:
+                self.typed_result('stack.pop()', entry)
+        else:
+            return False
+        return True
+
+
+    def typed_result(self, expr, entry):
+        """Pushes the value of expr, guarded to have the recorded type."""
+        temp = self.new_temp(expr, entry.result_type)
+        self.guard(f'type({temp}) is not {entry.result_type.__name__}', entry.pc + 1, self.stack)
+
+
+def compile_trace(vm, frame, target, entries):
+    """Returns the compiled trace function for the recorded entries, or
+    None if the trace cannot be compiled.
+
+    """
+    source = TraceCompiler(vm, frame, target, entries).compile()
+    if source is None:
+        return None
+    namespace = {
+        'vm': vm,
+        'dispatch': vm.dispatch,
+        'get_index': vm.get_index,
+        'set_index': vm.set_index,
+        'get_field': vm.get_field,
+        'set_field': vm.set_field,
+        'NoneType': type(None),
+        'HeapRef': HeapRef,
+    }
+    exec(compile(source, f'<trace {frame.template.function_name}:{target}>', 'exec'), namespace)
+    trace = namespace['trace']
+    trace.source = source
+    return trace
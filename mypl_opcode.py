@@ -49,14 +49,110 @@ OpCode = Enum('OpCode', [
     'TOSTR',   # pop x, push str(x)
 
     # heap
-    'ALLOCS',  # allocate struct object, push oid x
-    'SETF',    # pop value x, pop oid y, set obj(y)[A] = x
-    'GETF',    # pop oid x, push obj(x)[A] onto stack
+    'NEWS',    # pop a value per field of struct A, allocate struct object A
+               # with them as its fields (the first pushed at offset 0), push oid x
+    'SETF',    # pop value x, pop oid y, set obj(y)[A] = x (field offset A)
+    'GETF',    # pop oid x, push obj(x)[A] onto stack (field offset A)
     'ALLOCA',  # pop int x, allocate array object with x None values, push oid
     'SETI',    # pop value x, pop index y, pop oid z, set array obj(z)[y] = x
     'GETI',    # pop index x, pop oid y, push obj(y)[x] onto stack
 
     # special
     'DUP',     # pop x, push x, push x
-    'NOP'      # do nothing
+    'NOP',     # do nothing
+
+    # superinstructions (created by mypl_fusion, operand A is the tuple
+    # of the fused instructions' operands)
+    'LOAD_LOAD',             # LOAD a, LOAD b
+    'LOAD_PUSH',             # LOAD a, PUSH v
+    'LOAD_LOAD_ADD',         # LOAD a, LOAD b, ADD
+    'LOAD_PUSH_ADD',         # LOAD a, PUSH v, ADD
+    'LOAD_PUSH_ADD_STORE',   # LOAD a, PUSH v, ADD, STORE b
+    'CMPLT_JMPF',            # CMPLT, JMPF t
+    'LOAD_LOAD_CMPLT_JMPF',  # LOAD a, LOAD b, CMPLT, JMPF t
+    'LOAD_PUSH_CMPLT_JMPF',  # LOAD a, PUSH v, CMPLT, JMPF t
+])
+
+
+# superinstruction -> the instruction sequence it replaces
+SUPERINSTRUCTIONS = {
+    OpCode.LOAD_LOAD: (OpCode.LOAD, OpCode.LOAD),
+    OpCode.LOAD_PUSH: (OpCode.LOAD, OpCode.PUSH),
+    OpCode.LOAD_LOAD_ADD: (OpCode.LOAD, OpCode.LOAD, OpCode.ADD),
+    OpCode.LOAD_PUSH_ADD: (OpCode.LOAD, OpCode.PUSH, OpCode.ADD),
+    OpCode.LOAD_PUSH_ADD_STORE: (OpCode.LOAD, OpCode.PUSH, OpCode.ADD, OpCode.STORE),
+    OpCode.CMPLT_JMPF: (OpCode.CMPLT, OpCode.JMPF),
+    OpCode.LOAD_LOAD_CMPLT_JMPF: (OpCode.LOAD, OpCode.LOAD, OpCode.CMPLT, OpCode.JMPF),
+    OpCode.LOAD_PUSH_CMPLT_JMPF: (OpCode.LOAD, OpCode.PUSH, OpCode.CMPLT, OpCode.JMPF),
+}
+
+
+# register machine instruction opcodes (mypl --engine=register), where
+# d, a, b, and s are register (frame variable slot) operands, r[a] is
+# the value in register a, L is an instruction offset, F a field
+# offset, N a function name, and S a struct name
+RegOpCode = Enum('RegOpCode', [
+
+    # moves
+    'MOV',     # d, s: r[d] = r[s]
+
+    # arithmetic, relational, and logical operators
+    'ADD',     # d, a, b: r[d] = r[a] + r[b]
+    'SUB',     # d, a, b: r[d] = r[a] - r[b]
+    'MUL',     # d, a, b: r[d] = r[a] * r[b]
+    'DIV',     # d, a, b: r[d] = r[a] // r[b] or r[a] / r[b]
+    'CMPLT',   # d, a, b: r[d] = r[a] < r[b]
+    'CMPLE',   # d, a, b: r[d] = r[a] <= r[b]
+    'CMPEQ',   # d, a, b: r[d] = r[a] == r[b]
+    'CMPNE',   # d, a, b: r[d] = r[a] != r[b]
+    'AND',     # d, a, b: r[d] = r[a] and r[b]
+    'OR',      # d, a, b: r[d] = r[a] or r[b]
+    'NOT',     # d, s: r[d] = not r[s]
+
+    # jump and branch
+    'JMP',     # L: jump to instruction offset L
+    'JMPF',    # s, L: if r[s] is False jump to instruction offset L
+
+    # functions
+    'CALL',    # d, N, (a, ...): call N with arguments r[a], ..., r[d] = result
+    'RET',     # s: return r[s] from the current function
+
+    # built ins
+    'WRITE',   # s: print r[s] to standard output
+    'READ',    # d: r[d] = line read from standard input
+    'LEN',     # d, s: r[d] = len(r[s]) if str, else len(obj(r[s]))
+    'GETC',    # d, a, b: r[d] = r[b][r[a]]
+    'TOINT',   # d, s: r[d] = int(r[s])
+    'TODBL',   # d, s: r[d] = double(r[s])
+    'TOSTR',   # d, s: r[d] = str(r[s])
+
+    # heap
+    'NEWS',    # d, S, (a, ...): allocate struct object S with fields r[a], ..., r[d] = oid
+    'SETF',    # a, F, s: obj(r[a])[F] = r[s]
+    'GETF',    # d, a, F: r[d] = obj(r[a])[F]
+    'ALLOCA',  # d, s: allocate array object with r[s] None values, r[d] = oid
+    'SETI',    # a, b, s: array obj(r[a])[r[b]] = r[s]
+    'GETI',    # d, a, b: r[d] = array obj(r[a])[r[b]]
+
+    # special
+    'NOP',     # do nothing
 ])
+
+# register opcode -> the kinds of its operands ('d' written register,
+# 'r' read register, 'L' offset, 'F' field offset, 'N' function name,
+# 'S' struct name, 'A' tuple of read registers)
+REG_OPERANDS = {
+    RegOpCode.MOV: 'dr',
+    RegOpCode.ADD: 'drr', RegOpCode.SUB: 'drr', RegOpCode.MUL: 'drr',
+    RegOpCode.DIV: 'drr', RegOpCode.CMPLT: 'drr', RegOpCode.CMPLE: 'drr',
+    RegOpCode.CMPEQ: 'drr', RegOpCode.CMPNE: 'drr', RegOpCode.AND: 'drr',
+    RegOpCode.OR: 'drr', RegOpCode.NOT: 'dr',
+    RegOpCode.JMP: 'L', RegOpCode.JMPF: 'rL',
+    RegOpCode.CALL: 'dNA', RegOpCode.RET: 'r',
+    RegOpCode.WRITE: 'r', RegOpCode.READ: 'd', RegOpCode.LEN: 'dr',
+    RegOpCode.GETC: 'drr', RegOpCode.TOINT: 'dr', RegOpCode.TODBL: 'dr',
+    RegOpCode.TOSTR: 'dr',
+    RegOpCode.NEWS: 'dSA', RegOpCode.SETF: 'rFr', RegOpCode.GETF: 'drF',
+    RegOpCode.ALLOCA: 'dr', RegOpCode.SETI: 'rrr', RegOpCode.GETI: 'drr',
+    RegOpCode.NOP: '',
+}
@@ -0,0 +1,503 @@
+"""Closure-threaded execution engine for the MyPL VM.
+
+Each VMFrameTemplate is compiled once into a list of Python closures,
+one per instruction, with the operand (and jump target) already bound.
+Running a frame is then just pc = ops[pc](frame), with no opcode
+decoding at run time. The engine shares the VM's heap, garbage
+collector, and call stack: instructions that touch the heap delegate to
+the VM's table handlers, while the hot stack, arithmetic, and branch
+instructions (and the superinstructions built from them) get
+specialized closures.
+
+NAME: Colin McClelland
+DATE: Spring 2024
+CLASS: CPSC 326
+
+"""
+
+from mypl_opcode import OpCode
+
+
+# pc values returned by closures that leave the current frame
+SWITCH = -1     # CALL or RET changed the top of the call stack
+HALT = -2       # ran off the end of the function's instructions
+
+
+def run_threaded(vm):
+    """Run the frame on top of the VM call stack (and any frames it
+    calls) until the program finishes.
+
+    Args:
+        vm -- The VM to run, with the main frame already pushed.
+
+    """
+    call_stack = vm.call_stack
+    frame = call_stack[-1]
+    ops = frame.template.closures or compile_template(vm, frame.template)
+    pc = frame.pc
+    while True:
+        while pc >= 0:
+            pc = ops[pc](frame)
+        if pc == HALT or not call_stack:
+            return
+        frame = call_stack[-1]
+        ops = frame.template.closures or compile_template(vm, frame.template)
+        pc = frame.pc
+
+
+def compile_template(vm, template):
+    """Returns (and caches on the template) the list of closures for
+    the template's instructions, followed by an end-of-code closure.
+
+    """
+    ops = []
+    for i in range(len(template.opcodes)):
+        opcode = template.opcodes[i]
+        operand = template.operands[i]
+        if opcode == 0:
+            ops.append(make_end())
+        elif opcode in FACTORIES:
+            ops.append(FACTORIES[opcode](vm, i, operand))
+        else:
+            ops.append(make_delegate(vm, i, opcode, operand))
+    template.closures = ops
+    return ops
+
+
+#----------------------------------------------------------------------
+# Closure factories (each returns the closure for instruction i)
+#----------------------------------------------------------------------
+
+def make_end():
+    def op(frame):
+        return HALT
+    return op
+
+
+def make_delegate(vm, i, opcode, operand):
+    handler = vm.dispatch[opcode]
+    nxt = i + 1
+    def op(frame):
+        handler(frame, operand)
+        return nxt
+    return op
+
+
+#------------------------------------------------------------
+# Literals and Variables
+#------------------------------------------------------------
+
+def make_push(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        frame.operand_stack.append(operand)
+        return nxt
+    return op
+
+
+def make_pop(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        frame.operand_stack.pop()
+        return nxt
+    return op
+
+
+def make_load(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        frame.operand_stack.append(frame.variables[operand])
+        return nxt
+    return op
+
+
+def make_store(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        val = frame.operand_stack.pop()
+        frame.variables[operand] = val
+        return nxt
+    return op
+
+
+#------------------------------------------------------------
+# Operations
+#------------------------------------------------------------
+
+def make_add(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        y = stack.pop()
+        if x is None or y is None:
+            vm.error("null cannot be used in arithmetic operations")
+        stack.append(y + x)
+        return nxt
+    return op
+
+
+def make_sub(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        y = stack.pop()
+        if x is None or y is None:
+            vm.error("null cannot be used in arithmetic operations")
+        stack.append(y - x)
+        return nxt
+    return op
+
+
+def make_mul(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        y = stack.pop()
+        if x is None or y is None:
+            vm.error("null cannot be used in arithmetic operations")
+        stack.append(y * x)
+        return nxt
+    return op
+
+
+def make_div(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        y = stack.pop()
+        if x == 0:
+            vm.error("Division by zero error")
+        if x is None or y is None:
+            vm.error("null cannot be used in arithmetic operations")
+        if type(x) == int and type(y) == int:
+            stack.append(y // x)
+        else:
+            stack.append(y / x)
+        return nxt
+    return op
+
+
+def make_cmplt(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        y = stack.pop()
+        if x is None or y is None:
+            vm.error("null cannot be used in operations")
+        stack.append(y < x)
+        return nxt
+    return op
+
+
+def make_cmple(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        y = stack.pop()
+        if x is None or y is None:
+            vm.error("null cannot be used in operations")
+        stack.append(y <= x)
+        return nxt
+    return op
+
+
+def make_cmpeq(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        stack.append(stack.pop() == x)
+        return nxt
+    return op
+
+
+def make_cmpne(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        stack.append(stack.pop() != x)
+        return nxt
+    return op
+
+
+def make_and(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        y = stack.pop()
+        if x is None or y is None:
+            vm.error("null cannot be used in logical operations")
+        stack.append(y and x)
+        return nxt
+    return op
+
+
+def make_or(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        y = stack.pop()
+        if x is None or y is None:
+            vm.error("null cannot be used in logical operations")
+        stack.append(y or x)
+        return nxt
+    return op
+
+
+def make_not(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        if x is None:
+            vm.error("null cannot be used in logical operations")
+        stack.append(not x)
+        return nxt
+    return op
+
+
+#------------------------------------------------------------
+# Branching
+#------------------------------------------------------------
+
+def make_jmp(vm, i, operand):
+    def op(frame):
+        return operand
+    return op
+
+
+def make_jmpf(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        if frame.operand_stack.pop() == False:
+            return operand
+        return nxt
+    return op
+
+
+#------------------------------------------------------------
+# Functions
+#------------------------------------------------------------
+
+def make_call(vm, i, operand):
+    handler = vm.dispatch[OpCode.CALL.value]
+    nxt = i + 1
+    def op(frame):
+        # save the return address before switching to the callee
+        frame.pc = nxt
+        handler(frame, operand)
+        return SWITCH
+    return op
+
+
+def make_ret(vm, i, operand):
+    handler = vm.dispatch[OpCode.RET.value]
+    def op(frame):
+        handler(frame, operand)
+        return SWITCH
+    return op
+
+
+#------------------------------------------------------------
+# Heap
+#------------------------------------------------------------
+
+def make_getf(vm, i, operand):
+    if vm.heap is not None:
+        # the copying collector's heap is accessed through the VM
+        return make_delegate(vm, i, OpCode.GETF.value, operand)
+    nxt = i + 1
+    struct_heap = vm.struct_heap
+    def op(frame):
+        stack = frame.operand_stack
+        oid = stack.pop()
+        if oid is None:
+            vm.error("null object")
+        stack.append(struct_heap[oid][operand])
+        return nxt
+    return op
+
+
+def make_geti(vm, i, operand):
+    if vm.heap is not None:
+        # the copying collector's heap is accessed through the VM
+        return make_delegate(vm, i, OpCode.GETI.value, operand)
+    nxt = i + 1
+    array_heap = vm.array_heap
+    def op(frame):
+        stack = frame.operand_stack
+        idx = stack.pop()
+        oid = stack.pop()
+        if oid is None:
+            vm.error("array cannot be null")
+        if idx is None:
+            vm.error("index cannot be null")
+        array = array_heap[oid]
+        if idx < 0 or idx > len(array) - 1:
+            vm.error("index out of bounds")
+        stack.append(array[idx])
+        return nxt
+    return op
+
+
+#------------------------------------------------------------
+# Special
+#------------------------------------------------------------
+
+def make_dup(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        stack = frame.operand_stack
+        stack.append(stack[-1])
+        return nxt
+    return op
+
+
+def make_nop(vm, i, operand):
+    nxt = i + 1
+    def op(frame):
+        return nxt
+    return op
+
+
+#------------------------------------------------------------
+# Superinstructions (see mypl_fusion)
+#------------------------------------------------------------
+
+def make_load_load(vm, i, operand):
+    nxt = i + 1
+    a, b = operand
+    def op(frame):
+        variables = frame.variables
+        frame.operand_stack.append(variables[a])
+        frame.operand_stack.append(variables[b])
+        return nxt
+    return op
+
+
+def make_load_push(vm, i, operand):
+    nxt = i + 1
+    a, v = operand
+    def op(frame):
+        frame.operand_stack.append(frame.variables[a])
+        frame.operand_stack.append(v)
+        return nxt
+    return op
+
+
+def make_load_load_add(vm, i, operand):
+    nxt = i + 1
+    a, b = operand
+    def op(frame):
+        y = frame.variables[a]
+        x = frame.variables[b]
+        if x is None or y is None:
+            vm.error("null cannot be used in arithmetic operations")
+        frame.operand_stack.append(y + x)
+        return nxt
+    return op
+
+
+def make_load_push_add(vm, i, operand):
+    nxt = i + 1
+    a, x = operand
+    def op(frame):
+        y = frame.variables[a]
+        if x is None or y is None:
+            vm.error("null cannot be used in arithmetic operations")
+        frame.operand_stack.append(y + x)
+        return nxt
+    return op
+
+
+def make_load_push_add_store(vm, i, operand):
+    a, x, b = operand
+    store = make_store(vm, i, b)
+    def op(frame):
+        y = frame.variables[a]
+        if x is None or y is None:
+            vm.error("null cannot be used in arithmetic operations")
+        frame.operand_stack.append(y + x)
+        return store(frame)
+    return op
+
+
+def make_cmplt_jmpf(vm, i, operand):
+    nxt = i + 1
+    target, = operand
+    def op(frame):
+        stack = frame.operand_stack
+        x = stack.pop()
+        y = stack.pop()
+        if x is None or y is None:
+            vm.error("null cannot be used in operations")
+        return nxt if y < x else target
+    return op
+
+
+def make_load_load_cmplt_jmpf(vm, i, operand):
+    nxt = i + 1
+    a, b, target = operand
+    def op(frame):
+        y = frame.variables[a]
+        x = frame.variables[b]
+        if x is None or y is None:
+            vm.error("null cannot be used in operations")
+        return nxt if y < x else target
+    return op
+
+
+def make_load_push_cmplt_jmpf(vm, i, operand):
+    nxt = i + 1
+    a, x, target = operand
+    def op(frame):
+        y = frame.variables[a]
+        if x is None or y is None:
+            vm.error("null cannot be used in operations")
+        return nxt if y < x else target
+    return op
+
+
+# opcode value -> closure factory (other opcodes delegate to the VM)
+FACTORIES = {
+    OpCode.PUSH.value: make_push,
+    OpCode.POP.value: make_pop,
+    OpCode.LOAD.value: make_load,
+    OpCode.STORE.value: make_store,
+    OpCode.ADD.value: make_add,
+    OpCode.SUB.value: make_sub,
+    OpCode.MUL.value: make_mul,
+    OpCode.DIV.value: make_div,
+    OpCode.AND.value: make_and,
+    OpCode.OR.value: make_or,
+    OpCode.NOT.value: make_not,
+    OpCode.CMPLT.value: make_cmplt,
+    OpCode.CMPLE.value: make_cmple,
+    OpCode.CMPEQ.value: make_cmpeq,
+    OpCode.CMPNE.value: make_cmpne,
+    OpCode.JMP.value: make_jmp,
+    OpCode.JMPF.value: make_jmpf,
+    OpCode.CALL.value: make_call,
+    OpCode.RET.value: make_ret,
+    OpCode.GETF.value: make_getf,
+    OpCode.GETI.value: make_geti,
+    OpCode.DUP.value: make_dup,
+    OpCode.NOP.value: make_nop,
+    OpCode.LOAD_LOAD.value: make_load_load,
+    OpCode.LOAD_PUSH.value: make_load_push,
+    OpCode.LOAD_LOAD_ADD.value: make_load_load_add,
+    OpCode.LOAD_PUSH_ADD.value: make_load_push_add,
+    OpCode.LOAD_PUSH_ADD_STORE.value: make_load_push_add_store,
+    OpCode.CMPLT_JMPF.value: make_cmplt_jmpf,
+    OpCode.LOAD_LOAD_CMPLT_JMPF.value: make_load_load_cmplt_jmpf,
+    OpCode.LOAD_PUSH_CMPLT_JMPF.value: make_load_push_cmplt_jmpf,
+}
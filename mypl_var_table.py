@@ -12,6 +12,8 @@ class VarTable:
     def __init__(self):
         """Create an empty var table"""
         self.environments = []
+        # var name -> type name, per environment
+        self.types = []
         self.total_vars = 0
         
         
@@ -28,6 +30,7 @@ class VarTable:
     def push_environment(self):
         """Add a new environment to the symbol table."""
         self.environments.append([])
+        self.types.append({})
 
         
     def pop_environment(self):
@@ -37,17 +40,21 @@ class VarTable:
         if self.environments:
             self.total_vars -= len(self.environments[-1])
             self.environments.pop()
+            self.types.pop()
 
             
-    def add(self, var_name):
+    def add(self, var_name, type_name=None):
         """Add a variable to the table in the current environment.
         
         Args: 
             var_name -- The variable name to add.
+            type_name -- The variable's type name (the element type
+                         name for an array), if needed.
 
         """
         if self.environments:
             self.environments[-1].append(var_name)
+            self.types[-1][var_name] = type_name
             self.total_vars += 1
             
             
@@ -66,4 +73,16 @@ class VarTable:
                 return num_remaining + self.environments[-i].index(var_name)
         return None
 
-    
+
+    def get_type(self, var_name):
+        """Returns the type name the variable was added with. Returns
+        None if the variable name is not in the table.
+
+        Args:
+            var_name -- The variable to lookup in the table.
+
+        """
+        for types in reversed(self.types):
+            if var_name in types:
+                return types[var_name]
+        return None
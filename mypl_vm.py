@@ -6,108 +6,724 @@ CLASS: CPSC 326
 
 """
 
+import sys
+import time
+from collections import Counter
+
 from mypl_error import *
 from mypl_opcode import *
 from mypl_frame import *
+from mypl_threaded import run_threaded
+from mypl_jit import record_trace, compile_trace
+from mypl_fusion import fuse_instructions, fusion_report
+from mypl_debug import TraceEvent, TraceSink
+from mypl_gc_stats import GCStats
+from mypl_heap_snapshot import write_snapshot, heap_objects, size_estimate
+
+
+# kinds of heap objects in the object table
+STRUCT = 'struct'
+ARRAY = 'array'
 
 
 class HeapObject:
-    def __init__(self, oid):
+    def __init__(self, oid, kind):
         self.oid = oid
-        self.parents = [] 
-        self.references = []
+        self.kind = kind
+        self.ref_count = 0           # heap references to the object (refcount gc)
+        self.parents = {}            # id -> slots of that object referencing this one
+        self.references = {}         # id -> slots of this object referencing it
     
     def add_parent(self, parent):
-        self.parents.append(parent)
+        self.parents[parent] = self.parents.get(parent, 0) + 1
 
     def add_reference(self, ref):
-        self.references.append(ref)
+        self.references[ref] = self.references.get(ref, 0) + 1
+
+    def remove_parent(self, parent):
+        count = self.parents[parent] - 1
+        if count:
+            self.parents[parent] = count
+        else:
+            del self.parents[parent]
+
+    def remove_reference(self, ref):
+        count = self.references[ref] - 1
+        if count:
+            self.references[ref] = count
+        else:
+            del self.references[ref]
 
     def __repr__(self):
         string_representation = " parents: " + str(self.parents) + " references: " + str(self.references)
         return string_representation
         
 
+# execution engines selectable with VM(engine=...)
+ENGINES = ('table', 'closure', 'py', 'register')
+
+# garbage collectors selectable with VM(gc=...)
+GC_MODES = ('marksweep', 'generational', 'incremental', 'refcount', 'copying')
+
+# heap growth factor for allocation-triggered collections, and the most
+# a run of collections that reclaim little can scale it up by
+GC_GROWTH = 2.0
+GC_MAX_BOOST = 4
+
+# default heap size that starts a collection for the generational (old
+# generation), incremental, refcount (backup cycle), and copying
+# collectors
+GC_THRESHOLD = 1024
+
+# generational collection: objects allocated between minor collections
+NURSERY_SIZE = 256
+
+# incremental collection: instructions between marking steps, and the
+# objects a step marks
+GC_STEP_INTERVAL = 1000
+GC_STEP_BUDGET = 100
+
+# estimated sizes (in bytes) of an empty struct and an empty array, and
+# of each field or array slot, charged against the heap byte limit
+STRUCT_BYTES = sys.getsizeof(Struct())
+ARRAY_BYTES = sys.getsizeof([])
+SLOT_BYTES = sys.getsizeof([None]) - ARRAY_BYTES
+
+# suffixes of byte sizes in heap limits (see parse_heap_limit)
+BYTE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+# file name given to the Python code compiled by the py engine, used to
+# find the compiled functions' frames when scanning for roots
+PY_CODE_FILENAME = '<mypl>'
+
+
+def parse_heap_limit(text):
+    """Returns the ('objects', n) or ('bytes', n) pair for a heap limit
+    given as a number of objects (e.g., '100000') or as a size with a
+    B, KB, MB, or GB suffix (e.g., '64MB').
+
+    """
+    text = text.strip().upper()
+    for unit in sorted(BYTE_UNITS, key=len, reverse=True):
+        if text.endswith(unit):
+            return ('bytes', int(float(text[:-len(unit)]) * BYTE_UNITS[unit]))
+    return ('objects', int(text))
+
+
+class HaltProgram(Exception):
+    """Raised by code compiled for the py engine when a function runs
+    off the end of its statements, which ends the program (as running
+    out of instructions does in the stack VM).
+
+    """
+
+
 class VM:
 
-    def __init__(self):
-        """Creates a VM."""
-        self.struct_heap = {}        # id -> dict
+    def __init__(self, engine='table', jit_threshold=None, fuse=False, frame_pool=True,
+                 gc_threshold=None, gc_growth=GC_GROWTH, gc='marksweep',
+                 nursery_size=NURSERY_SIZE, gc_step_interval=GC_STEP_INTERVAL,
+                 gc_step_budget=GC_STEP_BUDGET, max_objects=None, max_heap_bytes=None,
+                 scalar_replace=False):
+        """Creates a VM.
+
+        Args:
+            engine -- The execution engine used by run(): 'table'
+                      dispatches each instruction through the opcode
+                      table, 'closure' runs templates compiled into
+                      operand-bound closures (see mypl_threaded),
+                      'py' runs functions compiled to Python by
+                      PyCodeGenerator, and 'register' runs register
+                      machine code from RegCodeGenerator.
+            jit_threshold -- If given, loops run by the table engine
+                      are traced and compiled (see mypl_jit) once
+                      their head has been reached this many times.
+            fuse -- If True, common instruction sequences are fused
+                      into superinstructions (see mypl_fusion) as
+                      frame templates are added.
+            frame_pool -- If True, frames are recycled through their
+                      template's free list instead of being created
+                      for each call.
+            gc_threshold -- If given, garbage is collected when an
+                      allocation finds this many objects (or, after
+                      a collection, the surviving objects times the
+                      growth factor) on the heap, instead of after
+                      every return. The py engine always collects
+                      on return.
+            gc_growth -- The heap growth factor between allocation-
+                      triggered collections. It is doubled (up to
+                      GC_MAX_BOOST times) while collections reclaim
+                      less than half of the heap.
+            gc -- The garbage collector: 'marksweep' collects the
+                      whole heap, 'generational' allocates objects
+                      in a nursery that is collected whenever
+                      nursery_size objects have been allocated, and
+                      promotes the survivors to an old generation
+                      that is collected when it reaches gc_threshold
+                      (default GC_THRESHOLD) objects, and
+                      'incremental' starts marking when the heap
+                      reaches gc_threshold (default GC_THRESHOLD)
+                      objects and marks in steps between
+                      instructions (see run_incremental), and
+                      'refcount' frees objects when their reference
+                      count drops to zero (see release_objects), with
+                      a full collection of cycles when the heap
+                      reaches gc_threshold (default GC_THRESHOLD)
+                      objects, and 'copying' keeps the objects in a
+                      dense list (heap) indexed by object number and
+                      copies the live ones into a new list, renumbered
+                      in order, when an allocation finds gc_threshold
+                      (default GC_THRESHOLD) objects in it (see
+                      copy_collection).
+            nursery_size -- The nursery size for the generational
+                      collector.
+            gc_step_interval -- The number of instructions between
+                      incremental marking steps.
+            gc_step_budget -- The number of objects an incremental
+                      marking step marks.
+            max_objects -- If given, the most objects the heap may
+                      hold.
+            max_heap_bytes -- If given, the most bytes (estimated) the
+                      heap may hold. An allocation that would exceed
+                      a limit first collects the garbage and, if the
+                      heap is still over, raises an out of memory
+                      VMError (see reserve_heap).
+            scalar_replace -- If True, the code generators keep the
+                      fields of struct variables that never escape
+                      their function in local slots instead of
+                      allocating the structs (see mypl_escape).
+
+        """
+        if engine not in ENGINES:
+            self.error(f'unknown engine "{engine}"')
+        if gc not in GC_MODES:
+            self.error(f'unknown garbage collector "{gc}"')
+        if engine == 'py' and gc != 'marksweep':
+            self.error('the py engine only supports the marksweep collector')
+        self.engine = engine
+        self.jit_threshold = jit_threshold
+        self.loop_counts = {}        # (function name, loop head) -> count
+        self.traces = {}             # (function name, loop head) -> trace or False
+        self.fuse = fuse
+        self.fusion_counts = Counter()  # superinstruction name -> times fused
+        self.frame_pool = frame_pool
+        self.frames_created = 0      # frames allocated (not reused from free lists)
+        self.struct_heap = {}        # id -> Struct (field values by offset)
+        self.struct_types = {}       # struct name -> Struct subclass
         self.array_heap = {}         # id -> list
-        self.next_obj_id = (2024, "heap_object")      # next available object id (int)
+        self.next_obj_id = 2024      # next available object number
         self.frame_templates = {}    # function name -> VMFrameTemplate
         self.call_stack = []         # function call stack
-        self.call_stack_id = 0
-        self.root_set = []
-        self.object_graph = {}
-        self.yellow_light_from_return = False
+        self.main_frame = None       # the frame main runs in (a Python frame for py)
+        self.object_graph = {}       # id number -> HeapObject (the object table)
+        self.gc_threshold = gc_threshold
+        self.gc_growth = gc_growth
+        self.gc_factor = gc_growth   # current (adapted) growth factor
+        # heap size that triggers the next collection
+        self.gc_limit = gc_threshold if engine != 'py' else None
+        self.collections = 0         # garbage collections run
+        self.gc = gc
+        self.nursery_size = nursery_size
+        self.nursery = None          # ids of the young objects (generational)
+        self.remembered = set()      # ids of old objects that may reference young ones
+        self.minor_collections = 0   # nursery collections run
+        self.gc_step_interval = gc_step_interval
+        self.gc_step_budget = gc_step_budget
+        self.gray = None             # objects left to scan (incremental, while marking)
+        self.marked = set()          # gray and black objects (incremental)
+        self.max_gc_pause = 0.0      # longest incremental step (seconds)
+        self.ref_counting = gc == 'refcount'
+        # call depth -> objects whose count became zero (or that were
+        # created) while a frame at that depth ran, not yet freed (refcount)
+        self.zero_counts = {}
+        self.objects_released = 0    # objects freed by reference counting
+        self.peak_heap = 0           # most objects on the heap at once
+        self.gc_history = GCStats()  # the collections run
+        self.cycle_time = 0.0        # time spent in the current incremental collection
+        self.cycle_pause = 0.0       # longest step of the current incremental collection
+        self.cycle_end = None        # how the incremental step that ended a collection went
+        self.max_objects = max_objects
+        self.max_heap_bytes = max_heap_bytes
+        self.limit_heap = max_objects is not None or max_heap_bytes is not None
+        self.heap_bytes = 0          # estimated heap size (measured at forced collections)
+        self.scalar_replace = scalar_replace
+        if gc != 'marksweep' and gc_threshold is None:
+            self.gc_threshold = GC_THRESHOLD
+        if gc == 'generational':
+            self.nursery = set()
+            self.old_limit = self.gc_threshold
+            self.gc_limit = nursery_size
+        elif gc in ('incremental', 'refcount'):
+            self.gc_limit = self.gc_threshold
+        self.heap = None             # object number -> Struct or list (copying)
+        self.heap_structs = 0        # structs in heap (copying)
+        self.new_fields = None       # field values of the struct being allocated (copying)
+        if gc == 'copying':
+            self.heap = []
+            self.gc_limit = self.gc_threshold
+            self.alloc_struct = self.copying_alloc_struct
+            self.alloc_array = self.copying_alloc_array
+            self.set_field = self.copying_set_field
+            self.get_field = self.copying_get_field
+            self.set_index = self.copying_set_index
+            self.get_index = self.copying_get_index
+            self.length = self.copying_length
+        self.dispatch = self.build_dispatch_table()  # opcode value -> handler
+        self.reg_dispatch = self.build_reg_dispatch_table()  # register opcode value -> handler
+        self.py_functions = {}       # function name -> compiled Python function
+        self.py_sources = {}         # function name -> Python source
 
 
     def run_garbage_collector(self):
-        initial_marked_objects = self.get_parents()
-        parents = initial_marked_objects[0]
-        marked_objects = list(self.mark_phase(parents)) + initial_marked_objects[1]
-        self.sweep_phase(marked_objects)
-        
+        """Collects the objects not reachable from the roots found by
+        scanning the frames on the call stack (see get_roots). For the
+        generational collector this is a full collection, after which
+        the surviving young objects are old.
+
+        """
+        if self.heap is not None:
+            self.copy_collection()
+            return
+        if not self.object_graph:
+            return
+        self.collections += 1
+        start = time.perf_counter()
+        self.mark_and_sweep('full', start, self.get_roots())
+        if self.nursery:
+            self.nursery.clear()
+            self.remembered.clear()
+
+
+    def gc_stats(self):
+        """Returns a summary of the garbage collections run so far (see
+        GCStats.summary in mypl_gc_stats).
+
+        """
+        return self.gc_history.summary()
+
+
+    def heap_snapshot(self, out, fmt='json'):
+        """Writes a snapshot of the heap (see mypl_heap_snapshot) as
+        'json' or 'dot' to the stream out. The roots are the frames on
+        the call stack (the compiled functions' Python frames for the
+        py engine) or, once the program has ended, main's frame.
+
+        """
+        frames = self.py_frames() if self.engine == 'py' else self.call_stack
+        if not frames and self.main_frame is not None:
+            frames = [self.main_frame]
+        write_snapshot(self, out, fmt, frames)
+
+
+    def collect_on_allocation(self):
+        """Runs the collection triggered by an allocation reaching the
+        heap limit. For the generational collector, the limit is
+        reached when the nursery is full: the nursery is collected,
+        followed by the whole heap if the old generation has reached
+        its limit.
+
+        """
+        if self.gc == 'incremental':
+            if self.gray is None:
+                self.timed_gc_step(self.start_marking)
+            return
+        if self.nursery is None:
+            self.gc_limit = self.collect_heap()
+            if self.ref_counting:
+                self.recount()
+            return
+        self.minor_collection()
+        if len(self.object_graph) >= self.old_limit:
+            self.old_limit = self.collect_heap()
+        self.gc_limit = len(self.object_graph) + self.nursery_size
+
+
+    def collect_heap(self):
+        """Collects the whole heap and returns the heap limit for the
+        next collection: the number of surviving objects times the
+        growth factor, which is adapted to how much was reclaimed.
+
+        """
+        before = len(self.object_graph)
+        self.run_garbage_collector()
+        return self.next_heap_limit(before, len(self.object_graph))
 
-    def mark_phase(self, parents):
-        marked_objects = set()
-        for obj_id in parents:
-            marked_objects.add(obj_id)
-            marked = set(self.get_references(obj_id))
-            marked_objects = marked_objects | marked
-        return marked_objects
 
+    def next_heap_limit(self, before, live):
+        """Returns the heap limit for the next collection after one that
+        left live of before objects, adapting the growth factor to how
+        much was reclaimed.
 
-    def get_references(self, obj_id):
-        marked_objects = []
-        root = self.object_graph[obj_id]
-        if root.references == []:
-            return []
+        """
+        if 2 * (before - live) < before:
+            self.gc_factor = min(self.gc_factor * 2, self.gc_growth * GC_MAX_BOOST)
         else:
-            for ref in root.references:
-                marked_objects.append(ref)
-                marked_objects += self.get_references(ref)
+            self.gc_factor = self.gc_growth
+        return max(self.gc_threshold, int(live * self.gc_factor))
+
+
+    def minor_collection(self):
+        """Collects the nursery. Its roots are the young objects
+        referenced from the frames on the call stack or from the old
+        objects in the remembered set, only references to young objects
+        are followed, and the survivors are promoted to the old
+        generation.
+
+        """
+        self.minor_collections += 1
+        start = time.perf_counter()
+        nursery = self.nursery
+        object_graph = self.object_graph
+        roots = self.get_roots()
+        for obj_id in self.remembered:
+            roots.update(object_graph[obj_id].references)
+        self.mark_and_sweep('minor', start, roots, nursery)
+        nursery.clear()
+        self.remembered.clear()
+
+
+    def start_marking(self):
+        """Starts an incremental collection by shading the roots gray."""
+        self.gray = []
+        self.marked = set()
+        for obj_id in self.get_roots():
+            self.shade(obj_id)
+
+
+    def shade(self, obj_id):
+        """Colors a white object gray (incremental marking)."""
+        if obj_id not in self.marked:
+            self.marked.add(obj_id)
+            self.gray.append(obj_id)
+
+
+    def gc_step(self):
+        """Runs an incremental marking step: scans up to gc_step_budget
+        gray objects, coloring them black and their white references
+        gray. Once no gray objects are left, the roots are scanned
+        again (frames have no write barrier) and, if they are all
+        marked, the white objects are swept and the collection ends.
+
+        """
+        gray = self.gray
+        object_graph = self.object_graph
+        for _ in range(self.gc_step_budget):
+            if not gray:
+                break
+            obj = object_graph.get(gray.pop())
+            if obj is not None:
+                for ref in obj.references:
+                    self.shade(ref)
+        if gray:
+            return
+        for obj_id in self.get_roots():
+            self.shade(obj_id)
+        if gray:
+            return
+        before = len(object_graph)
+        self.collections += 1
+        start = time.perf_counter()
+        freed = self.sweep_phase(self.marked)
+        self.cycle_end = (before, len(object_graph), freed, time.perf_counter() - start)
+        self.gray = None
+        self.marked = set()
+        self.gc_limit = self.next_heap_limit(before, len(object_graph))
+
+
+    def timed_gc_step(self, step):
+        """Runs an incremental collection step, recording the longest
+        pause, and the collection once a step ends it.
+
+        """
+        start = time.perf_counter()
+        step()
+        pause = time.perf_counter() - start
+        if pause > self.max_gc_pause:
+            self.max_gc_pause = pause
+        self.cycle_time += pause
+        self.cycle_pause = max(self.cycle_pause, pause)
+        if self.cycle_end is not None:
+            before, after, freed, sweep_time = self.cycle_end
+            self.gc_history.record('incremental', self.cycle_pause, self.cycle_time - sweep_time,
+                                   sweep_time, before, after, *freed)
+            self.cycle_time = self.cycle_pause = 0.0
+            self.cycle_end = None
+
+
+    def count_write(self, old, val):
+        """Updates the reference counts for a heap slot holding old being
+        set to val.
+
+        """
+        if type(val) == HeapRef:
+            self.object_graph[val].ref_count += 1
+        if type(old) == HeapRef:
+            obj = self.object_graph.get(old)
+            if obj is not None:
+                obj.ref_count -= 1
+                if obj.ref_count == 0:
+                    self.zero_counts.setdefault(len(self.call_stack), set()).add(old)
+
+
+    def release_objects(self, depth):
+        """Called on returning from the frame at the given call depth
+        (the call stack's length before the return) when objects got a
+        zero reference count while it ran. Frees those objects, and the
+        caller's earlier ones (whose frame slots may since have been
+        overwritten), that are not referenced from a frame on the call
+        stack, along with the objects whose count drops to zero as a
+        result. The rest are left to the caller's return. Frame slots
+        are not counted (they are written by too many instructions), so
+        the frames are scanned instead, once per call to
+        release_objects.
+
+        """
+        start = time.perf_counter()
+        zero_counts = self.zero_counts
+        worklist = list(zero_counts.pop(depth))
+        worklist.extend(zero_counts.pop(depth - 1, ()))
+        roots = self.get_roots()
+        object_graph = self.object_graph
+        before = len(object_graph)
+        freed = Counter()
+        heaps = {STRUCT: self.struct_heap, ARRAY: self.array_heap}
+        deferred = set()
+        while worklist:
+            obj_id = worklist.pop()
+            obj = object_graph.get(obj_id)
+            if obj is None or obj.ref_count > 0:
+                continue
+            if obj_id in roots:
+                deferred.add(obj_id)
+                continue
+            del object_graph[obj_id]
+            heap = heaps[obj.kind]
+            vals = heap.pop(obj_id)
+            self.objects_released += 1
+            freed[obj.kind] += 1
+            for val in vals:
+                if type(val) == HeapRef:
+                    child = object_graph.get(val)
+                    if child is not None:
+                        child.parents.pop(obj_id, None)
+                        child.ref_count -= 1
+                        if child.ref_count == 0:
+                            worklist.append(val)
+        if deferred:
+            zero_counts[depth - 1] = deferred
+        if not freed:
+            return
+        pause = time.perf_counter() - start
+        self.gc_history.record('refcount', pause, 0.0, pause, before, len(object_graph),
+                               freed[STRUCT], freed[ARRAY])
+
+
+    def recount(self):
+        """Recomputes the reference counts after a full collection (which
+        may have freed objects referencing survivors).
+
+        """
+        object_graph = self.object_graph
+        for obj in object_graph.values():
+            obj.ref_count = 0
+        for vals in list(self.struct_heap.values()) + list(self.array_heap.values()):
+            for val in vals:
+                if type(val) == HeapRef:
+                    object_graph[val].ref_count += 1
+        # the survivors are referenced from frames, so they are left to
+        # the current frame's return
+        zero = {obj_id for obj_id, obj in object_graph.items() if obj.ref_count == 0}
+        self.zero_counts = {len(self.call_stack): zero} if zero else {}
+
+
+    def get_roots(self):
+        """Returns the ids of the heap objects referenced from the
+        variables (or registers) and operand stacks of the frames on
+        the call stack.
+
+        """
+        roots = set()
+        for frame in self.call_stack:
+            for val in frame.variables:
+                if type(val) == HeapRef:
+                    roots.add(val)
+            for val in frame.operand_stack:
+                if type(val) == HeapRef:
+                    roots.add(val)
+        return roots
+
+
+    def mark_phase(self, roots, within=None):
+        """Returns the set of object ids reachable from the given root
+        object ids (through objects in the within set, if given).
+        Marking uses a worklist instead of recursion, and each object's
+        references are followed only the first time the object is
+        reached, so shared subgraphs are walked once and long chains do
+        not hit the recursion limit.
+
+        """
+        object_graph = self.object_graph
+        marked_objects = set()
+        worklist = list(roots)
+        if within is not None:
+            worklist = [obj_id for obj_id in worklist if obj_id in within]
+        while worklist:
+            obj_id = worklist.pop()
+            if obj_id in marked_objects:
+                continue
+            marked_objects.add(obj_id)
+            obj = object_graph.get(obj_id)
+            if obj is None:
+                continue
+            if within is None:
+                worklist.extend(ref for ref in obj.references if ref not in marked_objects)
+            else:
+                worklist.extend(ref for ref in obj.references
+                                if ref in within and ref not in marked_objects)
         return marked_objects
                  
 
-    def sweep_phase(self, marked_objects):
-        struct_keys = [key[0] for key in self.struct_heap.keys()]
-        array_keys = [key[0] for key in self.array_heap.keys()]
-        object_graph_copy = self.object_graph.copy()
-        for key in object_graph_copy:
-            if key not in marked_objects:
-                if key in struct_keys:
-                    del self.struct_heap[(key,"heap_object")]
-                if key in array_keys:
-                    del self.array_heap[(key,"heap_object")]
-                del self.object_graph[key]
-
-    def get_parents(self):
-        parents = []
-        referenced_children = []
-        self.root_set = list(set(self.root_set))
-        for i in range(len(self.root_set)):
-            obj_id = self.root_set[i][1]
-            if len(self.object_graph[obj_id].parents) == 0:
-                parents.append(obj_id)
-            else:
-                referenced_children.append(obj_id)
-        return (parents, referenced_children)
+    def sweep_phase(self, marked_objects, candidates=None):
+        """Frees the objects whose ids are not in the marked_objects set,
+        from the candidates (default: the whole heap), and returns the
+        number of structs and arrays freed. The object table
+        (object_graph) records each object's kind, so this is a single
+        pass over the candidates (which also removes the freed objects
+        from the parents of the objects they reference).
+
+        """
+        heaps = {STRUCT: self.struct_heap, ARRAY: self.array_heap}
+        object_graph = self.object_graph
+        if candidates is None:
+            candidates = object_graph
+        garbage = [key for key in candidates if key not in marked_objects]
+        structs = 0
+        for key in garbage:
+            obj = object_graph.pop(key)
+            del heaps[obj.kind][key]
+            if obj.kind == STRUCT:
+                structs += 1
+            for ref in obj.references:
+                child = object_graph.get(ref)
+                if child is not None:
+                    child.parents.pop(key, None)
+        return (structs, len(garbage) - structs)
+
+
+    def mark_and_sweep(self, collector, start, roots, within=None):
+        """Marks the objects reachable from the roots (through objects in
+        the within set, if given), sweeps the others (of the within set),
+        and records the collection, which started at the given time.
 
+        """
+        before = len(self.object_graph)
+        mark_start = time.perf_counter()
+        marked = self.mark_phase(roots, within)
+        sweep_start = time.perf_counter()
+        freed = self.sweep_phase(marked, within)
+        end = time.perf_counter()
+        self.gc_history.record(collector, end - start, sweep_start - mark_start, end - sweep_start,
+                               before, len(self.object_graph), *freed)
+
+
+    def copy_collection(self):
+        """Cheney-style copying collection for the copying collector.
+        The objects referenced from the frames on the call stack are
+        copied to a new (to-space) list, then the to-space is scanned in
+        order, copying the objects its references reach. Each object
+        copied is numbered by its position in the to-space, and every
+        reference (in frames and in objects) is updated to the new
+        number. The field values of a struct being allocated are roots
+        too (and updated the same way). Pooled frames are not roots: their
+        slots are cleared when they are returned to the pool (op_ret,
+        reg_ret), so they hold no references to forward.
 
-    def clean_root_set(self, call_stack_id):
-        # make sure this works as expected - i think it should be fine
-        root_set_copy = self.root_set[:]
-        for obj in root_set_copy:
-            if obj[0] == call_stack_id:
-                self.root_set.remove(obj)
+        """
+        start = time.perf_counter()
+        heap = self.heap
+        to_space = []
+        forward = [None] * len(heap)   # old object number -> new reference
+        def copy(ref):
+            new_ref = forward[ref]
+            if new_ref is None:
+                new_ref = HeapRef(len(to_space))
+                forward[ref] = new_ref
+                to_space.append(heap[ref])
+            return new_ref
+        self.collections += 1
+        roots = [vals for frame in self.call_stack
+                 for vals in (frame.variables, frame.operand_stack)]
+        if self.new_fields is not None:
+            roots.append(self.new_fields)
+        for vals in roots:
+            for i in range(len(vals)):
+                if type(vals[i]) == HeapRef:
+                    vals[i] = copy(vals[i])
+        scan = 0
+        structs = 0
+        while scan < len(to_space):
+            obj = to_space[scan]
+            if isinstance(obj, Struct):
+                structs += 1
+            for i in range(len(obj)):
+                if type(obj[i]) == HeapRef:
+                    obj[i] = copy(obj[i])
+            scan += 1
+        before = len(heap)
+        heap[:] = to_space
+        pause = time.perf_counter() - start
+        freed_structs = self.heap_structs - structs
+        self.gc_history.record('copying', pause, pause, 0.0, before, len(heap), freed_structs,
+                               before - len(heap) - freed_structs)
+        self.heap_structs = structs
+
+
+    def collect_py_garbage(self):
+        """Garbage collection for the py engine. The roots are the heap
+        references held in the locals of the compiled mypl functions
+        currently on the Python call stack.
 
+        """
+        if not self.object_graph:
+            return
+        start = time.perf_counter()
+        roots = set()
+        for frame in self.py_frames():
+            for val in frame.f_locals.values():
+                if type(val) == HeapRef:
+                    roots.add(val)
+        self.mark_and_sweep('full', start, roots)
+
+
+    def py_frames(self):
+        """Returns the Python frames of the compiled mypl functions
+        currently on the Python call stack (py engine), main's first.
+
+        """
+        frames = []
+        frame = sys._getframe(1)
+        while frame is not None:
+            if frame.f_code.co_filename == PY_CODE_FILENAME:
+                frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+        return frames
+
+
+    def enter_py_main(self):
+        """Keeps the Python frame main runs in (py engine), whose locals
+        are the roots of heap snapshots once the program has ended.
+
+        """
+        self.main_frame = sys._getframe(1)
 
 
         
     def __repr__(self):
-        """Returns a string representation of frame templates."""
+        """Returns a string representation of frame templates (or of the
+        generated Python source for the py engine)."""
+        if self.engine == 'py':
+            return '\n' + '\n'.join(self.py_sources.values())
         s = ''
         for name, template in self.frame_templates.items():
             s += f'\nFrame {name}\n'
@@ -119,12 +735,54 @@ class VM:
     def add_frame_template(self, template):
         """Add the new frame info to the VM. 
 
+        Templates built without frame sizes are sized from their
+        instructions. The template's instructions are then fused into
+        superinstructions (if enabled) and lowered into the packed
+        opcode and operand tuples the run loop executes from.
+
         Args: 
             frame -- The frame info to add.
 
         """
+        if template.local_count is None or template.max_stack_depth is None:
+            arg_counts = {name: t.arg_count for name, t in self.frame_templates.items()}
+            field_counts = {name: len(t.fields) for name, t in self.struct_types.items()}
+            template.size_frame(arg_counts, field_counts)
+        if self.fuse and self.engine != 'register':
+            template.instructions = fuse_instructions(template.instructions, self.fusion_counts)
+        template.lower()
         self.frame_templates[template.function_name] = template
 
+
+    def add_struct_type(self, struct_name, field_names):
+        """Adds the struct type (a Struct subclass) whose objects hold
+        the named fields at their offsets, allocated by NEWS struct_name.
+
+        """
+        self.struct_types[struct_name] = type(struct_name, (Struct,),
+                                              {'__slots__': (), 'fields': tuple(field_names)})
+
+
+    def fusion_report(self):
+        """Returns a summary of the superinstructions created when the
+        frame templates were added.
+
+        """
+        return fusion_report(self.fusion_counts)
+
+
+    def add_py_function(self, name, function, source):
+        """Add a function compiled by the Python backend to the VM.
+
+        Args:
+            name -- The mypl function name.
+            function -- The compiled Python function.
+            source -- The Python source the function was compiled from.
+
+        """
+        self.py_functions[name] = function
+        self.py_sources[name] = source
+
     
     def error(self, msg, frame=None):
         """Report a VM error."""
@@ -137,374 +795,1147 @@ class VM:
         raise VMError(msg)
 
     
+    #----------------------------------------------------------------------
+    # HEAP OPERATIONS (shared by all execution engines)
+    #----------------------------------------------------------------------
+
+    def alloc_struct(self, values=(), struct_type=Struct):
+        """Allocates a struct object of the given type whose fields (by
+        offset) hold the given values and returns its oid. The values must also be held
+        by the caller's frame (e.g., still on the operand stack), which
+        keeps the objects they reference alive if allocating collects.
+
+        """
+        if self.gc_limit is not None and len(self.object_graph) >= self.gc_limit:
+            self.collect_on_allocation()
+        if self.limit_heap:
+            self.reserve_heap(STRUCT_BYTES + SLOT_BYTES * len(values))
+        oid = HeapRef(self.next_obj_id)
+        fields = struct_type(values)
+        self.struct_heap[oid] = fields
+        self.add_object(oid, STRUCT)
+        self.next_obj_id += 1
+        for val in fields:
+            if type(val) == HeapRef:
+                if self.ref_counting:
+                    self.count_write(None, val)
+                self.add_edge(oid, val)
+        return oid
+
+
+    def alloc_array(self, array_len):
+        """Allocates an array object of array_len null values and
+        returns its oid.
+
+        """
+        if(array_len == None):
+            self.error("array length cannot be null")
+        elif (array_len < 0):
+            self.error("array length cannot be negative")
+        if self.gc_limit is not None and len(self.object_graph) >= self.gc_limit:
+            self.collect_on_allocation()
+        if self.limit_heap:
+            self.reserve_heap(ARRAY_BYTES + SLOT_BYTES * array_len)
+        oid = HeapRef(self.next_obj_id)
+        self.array_heap[oid] = [None for _ in range(array_len)]
+        self.add_object(oid, ARRAY)
+        self.next_obj_id += 1
+        return oid
+
+
+    def reserve_heap(self, size):
+        """Charges an allocation of the given estimated size (in bytes)
+        against the heap limits. If it would take the heap past
+        max_objects objects or max_heap_bytes bytes, the garbage is
+        collected first (and the heap size measured), and if the heap
+        is still over a limit the allocation fails with an out of
+        memory error.
+
+        """
+        if self.over_heap_limit(size):
+            self.force_collection()
+            self.heap_bytes = sum(size_estimate(data) for _, _, data in heap_objects(self))
+            limit = self.over_heap_limit(size)
+            if limit:
+                self.error(f'out of memory: heap limit of {limit} reached '
+                           f'({self.heap_count()} objects, about {self.heap_bytes} bytes, '
+                           f'allocating {size} bytes)')
+        self.heap_bytes += size
+
+
+    def over_heap_limit(self, size):
+        """Returns the heap limit ('N objects' or 'N bytes') an
+        allocation of the given estimated size would exceed, or None.
+
+        """
+        if self.max_objects is not None and self.heap_count() >= self.max_objects:
+            return f'{self.max_objects} objects'
+        if self.max_heap_bytes is not None and self.heap_bytes + size > self.max_heap_bytes:
+            return f'{self.max_heap_bytes} bytes'
+        return None
+
+
+    def heap_count(self):
+        """Returns the number of objects on the heap."""
+        if self.heap is not None:
+            return len(self.heap)
+        return len(self.object_graph)
+
+
+    def force_collection(self):
+        """Collects the whole heap now, abandoning an incremental
+        collection in progress.
+
+        """
+        if self.engine == 'py':
+            self.collect_py_garbage()
+            return
+        self.gray = None
+        self.marked = set()
+        self.run_garbage_collector()
+        if self.ref_counting:
+            self.recount()
+
+
+    def add_object(self, obj_id, kind):
+        """Adds a new object to the object table, and to the collector's
+        bookkeeping: young for the generational collector, black while
+        incremental marking is in progress, and unreferenced for
+        reference counting.
+
+        """
+        object_graph = self.object_graph
+        object_graph[obj_id] = HeapObject(obj_id, kind)
+        if self.nursery is not None:
+            self.nursery.add(obj_id)
+        elif self.gray is not None:
+            self.marked.add(obj_id)
+        elif self.ref_counting:
+            self.zero_counts.setdefault(len(self.call_stack), set()).add(obj_id)
+        if len(object_graph) > self.peak_heap:
+            self.peak_heap = len(object_graph)
+
+
+    def set_field(self, oid, offset, val):
+        """Sets the field at the given offset of the struct object oid
+        to val.
+
+        """
+        if oid == None:
+            self.error("null object")
+        fields = self.struct_heap[oid]
+        old = fields[offset]
+        if self.ref_counting:
+            self.count_write(old, val)
+        fields[offset] = val
+        if type(old) == HeapRef:
+            self.remove_edge(oid, old)
+        if type(val) == HeapRef:
+            self.add_edge(oid, val)
+
+
+    def add_edge(self, oid, val):
+        """Adds a reference from object oid to object val to the object
+        table, when a slot of oid is set to val, and applies the
+        collector's write barriers.
+
+        """
+        self.object_graph[oid].add_reference(val)
+        self.object_graph[val].add_parent(oid)
+        # write barrier: remember old objects pointing to young ones
+        nursery = self.nursery
+        if nursery and val in nursery and oid not in nursery:
+            self.remembered.add(oid)
+        # write barrier: no black object may point to a white one
+        if self.gray is not None:
+            self.shade(val)
+
+
+    def remove_edge(self, oid, old):
+        """Removes a reference from object oid to object old from the
+        object table, when the slot holding it is overwritten.
+
+        """
+        object_graph = self.object_graph
+        object_graph[oid].remove_reference(old)
+        child = object_graph.get(old)
+        if child is not None:
+            child.remove_parent(oid)
+
+
+    def get_field(self, oid, offset):
+        """Returns the value of the field at the given offset of the
+        struct object oid.
+
+        """
+        if oid == None:
+            self.error("null object")
+        return self.struct_heap[oid][offset]
+
+
+    def set_index(self, oid, idx, val):
+        """Sets index idx of the array object oid to val."""
+        if (oid == None):
+            self.error("array cannot be null")
+        if(idx == None):
+            self.error("index cannot be null")
+        elif (idx < 0 or idx > len(self.array_heap[oid])-1):
+            self.error("array index out of bounds")
+        array = self.array_heap[oid]
+        old = array[idx]
+        if self.ref_counting:
+            self.count_write(old, val)
+        array[idx] = val
+        if type(old) == HeapRef:
+            self.remove_edge(oid, old)
+        if type(val) == HeapRef:
+            self.add_edge(oid, val)
+
+
+    def get_index(self, oid, idx):
+        """Returns the value at index idx of the array object oid."""
+        if (oid == None):
+            self.error("array cannot be null")
+        if(idx == None):
+            self.error("index cannot be null")
+        elif (idx < 0 or idx > len(self.array_heap[oid])-1):
+            self.error("index out of bounds")
+        return self.array_heap[oid][idx]
+
+
+    def length(self, obj):
+        """Returns the length of a string or of the array object obj."""
+        if obj == None:
+            self.error("argument to len cannot be null")
+        if type(obj) == str:
+            return len(obj)
+        return len(self.array_heap[obj])
+
+    
+    #----------------------------------------------------------------------
+    # COPYING HEAP OPERATIONS (replace the ones above for gc='copying')
+    #----------------------------------------------------------------------
+
+    def copying_alloc(self, obj):
+        """Adds the struct (Struct) or array (list) obj to the heap,
+        collecting first if the heap has reached its limit, and returns
+        its oid.
+
+        """
+        heap = self.heap
+        if len(heap) >= self.gc_limit:
+            before = len(heap)
+            self.copy_collection()
+            self.gc_limit = self.next_heap_limit(before, len(heap))
+        heap.append(obj)
+        if len(heap) > self.peak_heap:
+            self.peak_heap = len(heap)
+        return HeapRef(len(heap) - 1)
+
+
+    def copying_alloc_struct(self, values=(), struct_type=Struct):
+        fields = struct_type(values)
+        # a collection while allocating updates the references in fields
+        self.new_fields = fields
+        if self.limit_heap:
+            self.reserve_heap(STRUCT_BYTES + SLOT_BYTES * len(fields))
+        oid = self.copying_alloc(fields)
+        self.new_fields = None
+        self.heap_structs += 1
+        return oid
+
+
+    def copying_alloc_array(self, array_len):
+        if(array_len == None):
+            self.error("array length cannot be null")
+        elif (array_len < 0):
+            self.error("array length cannot be negative")
+        if self.limit_heap:
+            self.reserve_heap(ARRAY_BYTES + SLOT_BYTES * array_len)
+        return self.copying_alloc([None] * array_len)
+
+
+    def copying_set_field(self, oid, offset, val):
+        if oid == None:
+            self.error("null object")
+        self.heap[oid][offset] = val
+
+
+    def copying_get_field(self, oid, offset):
+        if oid == None:
+            self.error("null object")
+        return self.heap[oid][offset]
+
+
+    def copying_set_index(self, oid, idx, val):
+        if (oid == None):
+            self.error("array cannot be null")
+        if(idx == None):
+            self.error("index cannot be null")
+        array = self.heap[oid]
+        if (idx < 0 or idx > len(array)-1):
+            self.error("array index out of bounds")
+        array[idx] = val
+
+
+    def copying_get_index(self, oid, idx):
+        if (oid == None):
+            self.error("array cannot be null")
+        if(idx == None):
+            self.error("index cannot be null")
+        array = self.heap[oid]
+        if (idx < 0 or idx > len(array)-1):
+            self.error("index out of bounds")
+        return array[idx]
+
+
+    def copying_length(self, obj):
+        if obj == None:
+            self.error("argument to len cannot be null")
+        if type(obj) == str:
+            return len(obj)
+        return len(self.heap[obj])
+
+    
     #----------------------------------------------------------------------
     # RUN FUNCTION
     #----------------------------------------------------------------------
     
-    def run(self, debug=False):
-        """Run the virtual machine."""
+    def run(self, debug=False, trace=None):
+        """Run the virtual machine.
+
+        Args:
+            debug -- If True, each instruction is traced to standard
+                     output (see mypl_debug).
+            trace -- A TraceSink the instructions are traced to.
+
+        Tracing uses its own run loop (running stack VM code through
+        the dispatch table, whatever the engine) so the other run
+        loops have no debugging checks, as does the incremental
+        collector. The py engine runs no VM instructions, so it cannot
+        be traced.
+
+        """
+        if self.engine == 'py':
+            if debug or trace is not None:
+                self.error('the py engine does not support tracing')
+            self.run_python()
+            return
 
         # grab the "main" function frame and instantiate it
         if not 'main' in self.frame_templates:
             self.error('No "main" functrion')
-        frame = VMFrame(self.frame_templates['main'])
+        main_template = self.frame_templates['main']
+        if self.engine == 'register':
+            variables = list(main_template.registers)
+        else:
+            variables = [None] * main_template.local_count
+        frame = VMFrame(main_template, 0, variables)
+        self.main_frame = frame
+        self.frames_created += 1
         self.call_stack.append(frame)
 
+        if debug or trace is not None:
+            self.run_traced(trace or TraceSink())
+            return
+        if self.gc == 'incremental':
+            self.run_incremental()
+            return
+        if self.engine == 'closure':
+            run_threaded(self)
+            return
+        if self.engine == 'register':
+            self.run_registers()
+            return
+
+        dispatch = self.dispatch
+        opcodes = frame.template.opcodes
+        operands = frame.template.operands
 
         # run loop (continue until run out of call frames or instructions)
-        while self.call_stack and frame.pc < len(frame.template.instructions):
-            # get the next instruction
-            instr = frame.template.instructions[frame.pc]
-            # increment the program count (pc)
-            frame.pc += 1
-            # for debugging:
-            if debug:
-                print('\n')
-                print('\t FRAME.........:', frame.template.function_name)
-                print('\t PC............:', frame.pc)
-                print('\t INSTRUCTION...:', instr)
-                val = None if not frame.operand_stack else frame.operand_stack[-1]
-                print('\t NEXT OPERAND..:', val)
-                cs = self.call_stack
-                fun = cs[-1].template.function_name if cs else None
-                print('\t NEXT FUNCTION..:', fun)
-
-            # print(instr.opcode)
-            
-            #------------------------------------------------------------
-            # Literals and Variables
-            #------------------------------------------------------------
-            
-
-            if instr.opcode == OpCode.PUSH:
-                frame.operand_stack.append(instr.operand)
-
-            elif instr.opcode == OpCode.POP:
-                frame.operand_stack.pop()
-
-            elif instr.opcode == OpCode.LOAD:
-                val = frame.variables[instr.operand]
-                frame.operand_stack.append(val)
-        
-            elif instr.opcode == OpCode.STORE:
-                val = frame.operand_stack.pop()
-                if instr.operand <= len(frame.variables) - 1:
-                    frame.variables[instr.operand] = val
-                else:
-                    frame.variables.append(val)
-
-                if type(val) == tuple:
-                    self.root_set.append((self.call_stack_id, val[0]))
-
-                # print(val)
-
-                if self.yellow_light_from_return:
-                    if type(val) == tuple:
-                        self.root_set.append((self.call_stack_id, val[0]))
-                    self.run_garbage_collector()
-                    self.yellow_light_from_return = False
-
-            #------------------------------------------------------------
-            # Operations
-            #------------------------------------------------------------
-
-            elif instr.opcode == OpCode.ADD:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                if x == None or y == None:
-                    self.error("null cannot be used in arithmetic operations")
-                frame.operand_stack.append(y+x)
-            
-            elif instr.opcode == OpCode.SUB:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                if x == None or y == None:
-                    self.error("null cannot be used in arithmetic operations")
-                frame.operand_stack.append(y-x)
-
-            elif instr.opcode == OpCode.MUL:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                if x == None or y == None:
-                    self.error("null cannot be used in arithmetic operations")
-                frame.operand_stack.append(y*x)
-
-            elif instr.opcode == OpCode.DIV:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                if x == 0:
-                    self.error("Division by zero error")
-                if x == None or y == None:
-                    self.error("null cannot be used in arithmetic operations")
-                if type(x) == int and type(y) == int:
-                    frame.operand_stack.append(y//x)
-                else:
-                    frame.operand_stack.append(y/x)
-            
-            elif instr.opcode == OpCode.AND:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                if x == None or y == None:
-                    self.error("null cannot be used in logical operations")
-                frame.operand_stack.append(y and x)
-
-            elif instr.opcode == OpCode.OR:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                if x == None or y == None:
-                    self.error("null cannot be used in logical operations")
-                frame.operand_stack.append(y or x)
-
-            elif instr.opcode == OpCode.NOT:
-                x = frame.operand_stack.pop()
-                if x == None:
-                    self.error("null cannot be used in logical operations")
-                frame.operand_stack.append(not x)
-
-            elif instr.opcode == OpCode.CMPLT:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                if x == None or y == None:
-                    self.error("null cannot be used in operations")
-                frame.operand_stack.append(y < x)
-
-            elif instr.opcode == OpCode.CMPLE:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                if x == None or y == None:
-                    self.error("null cannot be used in operations")
-                frame.operand_stack.append(y <= x)
-
-            elif instr.opcode == OpCode.CMPEQ:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                frame.operand_stack.append(y == x)
-
-            elif instr.opcode == OpCode.CMPNE:
-                x = frame.operand_stack.pop()
-                y = frame.operand_stack.pop()
-                frame.operand_stack.append(y != x)
-
-
-            #------------------------------------------------------------
-            # Branching
-            #------------------------------------------------------------
-
-            elif instr.opcode == OpCode.JMP:
-                frame.pc = instr.operand
-
-            elif instr.opcode == OpCode.JMPF:
-                val = frame.operand_stack.pop()
-                if val == False:
-                    frame.pc = instr.operand
-            
-                    
-            #------------------------------------------------------------
-            # Functions
-            #------------------------------------------------------------
-
-            elif instr.opcode == OpCode.CALL:
-                callee_name = instr.operand
-                callee_template = self.frame_templates[callee_name]
-                callee_frame = VMFrame(callee_template)
-                self.call_stack.append(callee_frame)
-                for i in range(callee_template.arg_count):
-                    arg = frame.operand_stack.pop()
-                    callee_frame.operand_stack.append(arg)
-                frame = callee_frame
-                self.call_stack_id += 1
-
-            elif instr.opcode == OpCode.RET:
-                return_val = frame.operand_stack.pop()
-                self.call_stack.pop()
-                if len(self.call_stack) > 0:
-                    frame = self.call_stack[-1]
-                    frame.operand_stack.append(return_val)
-                    self.clean_root_set(self.call_stack_id)
-                    self.call_stack_id -= 1
-                    if frame.template.instructions[frame.pc].opcode in [OpCode.STORE, OpCode.SETF, OpCode.SETI]:
-                        self.yellow_light_from_return = True
-                    else:
-                        self.run_garbage_collector()
-
-
-            
-            #------------------------------------------------------------
-            # Built-In Functions
-            #------------------------------------------------------------
-
-            elif instr.opcode == OpCode.WRITE:
-                val = frame.operand_stack.pop()
-                if type(val) == bool:
-                    if val == True:
-                        val = 'true'
-                    elif val == False:
-                        val = 'false'
-                if val == None:
-                    print('null', end='')
-                else:
-                    print(val, end='')
-            
-            elif instr.opcode == OpCode.READ:
-                val = input()
-                frame.operand_stack.append(val)
-            
-            elif instr.opcode == OpCode.LEN:
-                obj = frame.operand_stack.pop()
-                if obj == None:
-                    self.error("argument to len cannot be null")
-                if type(obj) == str:
-                    frame.operand_stack.append(len(obj))
-                else:
-                    array = self.array_heap[obj]
-                    frame.operand_stack.append(len(array))
-
-            elif instr.opcode == OpCode.GETC:
-                string = frame.operand_stack.pop()
-                idx = frame.operand_stack.pop()
-                if idx == None:
-                    self.error("index cannot be null")
-                if string == None:
-                    self.error("string cannot be null")
-                if (idx < 0 or idx > len(string)-1):
-                    self.error("index out of bounds")
-                frame.operand_stack.append(string[idx])
-
-            elif instr.opcode == OpCode.TOINT:
-                val = frame.operand_stack.pop()
-                if val == None:
-                    self.error("argument cannot be null")
-                try:
-                    frame.operand_stack.append(int(val))
-                except ValueError:
-                    self.error("invalid argument")
-
-            elif instr.opcode == OpCode.TODBL:
-                val = frame.operand_stack.pop()
-                if val == None:
-                    self.error("argument cannot be null")
-                try:
-                    frame.operand_stack.append(float(val))
-                except ValueError:
-                    self.error("invalid argument")
-
-            elif instr.opcode == OpCode.TOSTR:
-                val = frame.operand_stack.pop()
-                if val == None:
-                    self.error("argument cannot be null")
-                try:
-                    frame.operand_stack.append(str(val))
-                except ValueError:
-                    self.error("invalid argument")
-
-            
-            #------------------------------------------------------------
-            # Heap
-            #------------------------------------------------------------
-
-            elif instr.opcode == OpCode.ALLOCS:
-                self.struct_heap[self.next_obj_id] = {}
-                frame.operand_stack.append(self.next_obj_id)
-                self.object_graph[self.next_obj_id[0]] = HeapObject(self.next_obj_id[0])
-                self.next_obj_id = (self.next_obj_id[0]+1,"heap_object")
-
-
-            elif instr.opcode == OpCode.SETF:
-                val = frame.operand_stack.pop()
-                oid = frame.operand_stack.pop()
-                oid_num = oid[0]
-                val_num = None
-                if oid == None:
-                    self.error("null object")
-                if type(val) == tuple:
-                    val_num = val[0]
-                    self.struct_heap[oid][instr.operand] = val
-                    self.object_graph[oid_num].add_reference(val_num)
-                    self.object_graph[val_num].add_parent(oid_num)
-                else:
-                    self.struct_heap[oid][instr.operand] = val
-                
-                if self.yellow_light_from_return:
-                    if type(val) == tuple:
-                        self.root_set.append((self.call_stack_id, val[0]))
-                    self.run_garbage_collector()
-                    self.yellow_light_from_return = False
-
-
-            elif instr.opcode == OpCode.GETF:
-                oid = frame.operand_stack.pop()
-                if oid == None:
-                    self.error("null object")
-                frame.operand_stack.append(self.struct_heap[oid][instr.operand])
-
-
-            elif instr.opcode == OpCode.ALLOCA:
-                oid = self.next_obj_id
-                array_len = frame.operand_stack.pop()
-                if(array_len == None):
-                    self.error("array length cannot be null")
-                elif (array_len < 0):
-                    self.error("array length cannot be negative")
-                self.array_heap[oid] = [None for _ in range(array_len)]
-                frame.operand_stack.append(self.next_obj_id)
-                self.object_graph[self.next_obj_id[0]] = HeapObject(self.next_obj_id[0])
-                self.next_obj_id = (self.next_obj_id[0]+1,"heap_object")
-
-
-            elif instr.opcode == OpCode.SETI:
-                val = frame.operand_stack.pop()
-                idx = frame.operand_stack.pop()
-                oid = frame.operand_stack.pop()
-                oid_num = oid[0]
-                val_num = None
-                if (oid == None):
-                    self.error("array cannot be null")
-                if(idx == None):
-                    self.error("index cannot be null")
-                elif (idx < 0 or idx > len(self.array_heap[oid])-1):
-                    self.error("array index out of bounds")
-                if type(val) == tuple:
-                    val_num = val[0]
-                    self.array_heap[oid][idx] = val
-                    self.object_graph[oid_num].add_reference(val_num)
-                    self.object_graph[val_num].add_parent(oid_num)
-                else:
-                    self.array_heap[oid][idx] = val
-
-                if self.yellow_light_from_return:
-                    if type(val) == tuple:
-                        self.root_set.append((self.call_stack_id, val[0]))
-                    self.run_garbage_collector()
-                    self.yellow_light_from_return = False
-
-
-            elif instr.opcode == OpCode.GETI:
-                idx = frame.operand_stack.pop()
-                oid = frame.operand_stack.pop()
-                oid_num = oid[0]
-                if (oid == None):
-                    self.error("array cannot be null")
-                if(idx == None):
-                    self.error("index cannot be null")
-                elif (idx < 0 or idx > len(self.array_heap[oid])-1):
-                    self.error("index out of bounds")
-                val = self.array_heap[oid][idx]
-                frame.operand_stack.append(val)
-            
-            #------------------------------------------------------------
-            # Special 
-            #------------------------------------------------------------
-
-            elif instr.opcode == OpCode.DUP:
-                x = frame.operand_stack.pop()
-                frame.operand_stack.append(x)
-                frame.operand_stack.append(x)
-
-            elif instr.opcode == OpCode.NOP:
-                # do nothing
-                pass
+        while frame is not None:
+            # get the next instruction and increment the program count (pc)
+            pc = frame.pc
+            frame.pc = pc + 1
+            # execute the instruction, the handler returns the frame to
+            # continue with (a different one after CALL and RET, None
+            # once the program is done)
+            next_frame = dispatch[opcodes[pc]](frame, operands[pc])
+            if next_frame is not frame:
+                frame = next_frame
+                if frame is not None:
+                    opcodes = frame.template.opcodes
+                    operands = frame.template.operands
+
+        # print("struct:", [int(key) for key in self.struct_heap.keys()], ", array:", [int(key) for key in self.array_heap.keys()])
+
+
+    def run_traced(self, sink):
+        """Instrumented run loop that reports each instruction the sink
+        accepts to the sink before executing it.
+
+        """
+        register = self.engine == 'register'
+        dispatch = self.reg_dispatch if register else self.dispatch
+        frame = self.call_stack[-1]
+        while frame is not None:
+            pc = frame.pc
+            frame.pc = pc + 1
+            template = frame.template
+            if sink.accepts(template.function_name, pc):
+                instrs = template.instructions
+                instr = instrs[pc] if pc < len(instrs) else 'END'
+                top = frame.operand_stack[-1] if frame.operand_stack else None
+                sink.emit(TraceEvent(template.function_name, pc, instr, top, len(self.call_stack)))
+            if register:
+                frame = dispatch[template.opcodes[pc]](frame, frame.variables, template.operands[pc])
+            else:
+                frame = dispatch[template.opcodes[pc]](frame, template.operands[pc])
 
+
+    def run_incremental(self):
+        """Run loop for the incremental collector: runs a marking step
+        every gc_step_interval instructions while a collection is in
+        progress.
+
+        """
+        register = self.engine == 'register'
+        dispatch = self.reg_dispatch if register else self.dispatch
+        interval = self.gc_step_interval
+        countdown = interval
+        frame = self.call_stack[-1]
+        while frame is not None:
+            pc = frame.pc
+            frame.pc = pc + 1
+            template = frame.template
+            if register:
+                frame = dispatch[template.opcodes[pc]](frame, frame.variables, template.operands[pc])
             else:
-                self.error(f'unsupported operation {instr}')
+                frame = dispatch[template.opcodes[pc]](frame, template.operands[pc])
+            countdown -= 1
+            if countdown == 0:
+                countdown = interval
+                if self.gray is not None:
+                    self.timed_gc_step(self.gc_step)
+
+
+    def run_registers(self):
+        """Run loop of the register engine. Frames keep their registers
+        in their variables list, starting from a copy of the template's
+        initial registers (see run() and reg_call()).
 
-        # print("struct:", [key[0] for key in self.struct_heap.keys()], ", array:", [key[0] for key in self.array_heap.keys()])
+        """
+        dispatch = self.reg_dispatch
+        frame = self.call_stack[-1]
+        regs = frame.variables
+        opcodes = frame.template.opcodes
+        operands = frame.template.operands
+        while frame is not None:
+            pc = frame.pc
+            frame.pc = pc + 1
+            next_frame = dispatch[opcodes[pc]](frame, regs, operands[pc])
+            if next_frame is not frame:
+                frame = next_frame
+                if frame is not None:
+                    regs = frame.variables
+                    opcodes = frame.template.opcodes
+                    operands = frame.template.operands
+
+
+    def run_python(self):
+        """Run the program compiled into Python functions (py engine)."""
+        if not 'main' in self.py_functions:
+            self.error('No "main" functrion')
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(limit, 20000))
+        try:
+            self.py_functions['main']()
+        except HaltProgram:
+            pass
+        except RecursionError:
+            self.error("call stack overflow")
+        finally:
+            sys.setrecursionlimit(limit)
+
+
+    #----------------------------------------------------------------------
+    # INSTRUCTION HANDLERS
+    #----------------------------------------------------------------------
+
+    def build_dispatch_table(self):
+        """Returns a list indexed by opcode value whose entries are the
+        bound handler methods for each instruction.
+
+        """
+        table = [self.op_unsupported] * (len(OpCode) + 1)
+        table[0] = self.op_end
+        for opcode in OpCode:
+            table[opcode.value] = getattr(self, 'op_' + opcode.name.lower(), self.op_unsupported)
+        if self.jit_threshold is not None:
+            table[OpCode.JMP.value] = self.op_jmp_jit
+        return table
+
+
+    def op_end(self, frame, operand):
+        # ran off the end of the current function's instructions
+        return None
+
+    def op_unsupported(self, frame, operand):
+        instr = frame.template.instructions[frame.pc - 1]
+        self.error(f'unsupported operation {instr}')
+
+    #------------------------------------------------------------
+    # Literals and Variables
+    #------------------------------------------------------------
+
+    def op_push(self, frame, operand):
+        frame.operand_stack.append(operand)
+        return frame
+
+    def op_pop(self, frame, operand):
+        frame.operand_stack.pop()
+        return frame
+
+    def op_load(self, frame, operand):
+        val = frame.variables[operand]
+        frame.operand_stack.append(val)
+        return frame
+
+    def op_store(self, frame, operand):
+        val = frame.operand_stack.pop()
+        frame.variables[operand] = val
+        return frame
+
+    #------------------------------------------------------------
+    # Operations
+    #------------------------------------------------------------
+
+    def op_add(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        frame.operand_stack.append(y+x)
+        return frame
+
+    def op_sub(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        frame.operand_stack.append(y-x)
+        return frame
+
+    def op_mul(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        frame.operand_stack.append(y*x)
+        return frame
+
+    def op_div(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == 0:
+            self.error("Division by zero error")
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        if type(x) == int and type(y) == int:
+            frame.operand_stack.append(y//x)
+        else:
+            frame.operand_stack.append(y/x)
+        return frame
+
+    def op_and(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("null cannot be used in logical operations")
+        frame.operand_stack.append(y and x)
+        return frame
+
+    def op_or(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("null cannot be used in logical operations")
+        frame.operand_stack.append(y or x)
+        return frame
+
+    def op_not(self, frame, operand):
+        x = frame.operand_stack.pop()
+        if x == None:
+            self.error("null cannot be used in logical operations")
+        frame.operand_stack.append(not x)
+        return frame
+
+    def op_cmplt(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("null cannot be used in operations")
+        frame.operand_stack.append(y < x)
+        return frame
+
+    def op_cmple(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("null cannot be used in operations")
+        frame.operand_stack.append(y <= x)
+        return frame
+
+    def op_cmpeq(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        frame.operand_stack.append(y == x)
+        return frame
+
+    def op_cmpne(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        frame.operand_stack.append(y != x)
+        return frame
+
+    #------------------------------------------------------------
+    # Branching
+    #------------------------------------------------------------
+
+    def op_jmp(self, frame, operand):
+        frame.pc = operand
+        return frame
+
+    def op_jmp_jit(self, frame, operand):
+        # JMP that counts loop back edges and runs (or records) traces
+        back_edge = frame.pc - 1
+        frame.pc = operand
+        if operand < back_edge:
+            key = (frame.template.function_name, operand)
+            trace = self.traces.get(key)
+            if trace is None:
+                count = self.loop_counts.get(key, 0) + 1
+                self.loop_counts[key] = count
+                if count < self.jit_threshold:
+                    return frame
+                entries = record_trace(self, frame, operand, back_edge)
+                trace = entries and compile_trace(self, frame, operand, entries)
+                self.traces[key] = trace or False
+                if not trace or frame.pc != operand:
+                    return frame
+            if trace:
+                frame.pc = trace(frame)
+        return frame
+
+    def op_jmpf(self, frame, operand):
+        val = frame.operand_stack.pop()
+        if val == False:
+            frame.pc = operand
+        return frame
+
+    #------------------------------------------------------------
+    # Functions
+    #------------------------------------------------------------
+
+    def op_call(self, frame, operand):
+        callee_template = self.frame_templates[operand]
+        free_frames = callee_template.free_frames
+        if free_frames:
+            callee_frame = free_frames.pop()
+            callee_frame.pc = 0
+        else:
+            callee_frame = VMFrame(callee_template, 0, [None] * callee_template.local_count)
+            self.frames_created += 1
+        self.call_stack.append(callee_frame)
+        for i in range(callee_template.arg_count):
+            arg = frame.operand_stack.pop()
+            callee_frame.operand_stack.append(arg)
+        return callee_frame
+
+    def op_ret(self, frame, operand):
+        return_val = frame.operand_stack.pop()
+        self.call_stack.pop()
+        if len(self.call_stack) > 0:
+            if self.frame_pool:
+                # a pooled frame is not a root, so its variables are
+                # cleared (leaving the objects they reference to the
+                # collector); main's frame is kept as is for heap
+                # snapshots at exit
+                frame.operand_stack.clear()
+                variables = frame.variables
+                variables[:] = [None] * len(variables)
+                frame.template.free_frames.append(frame)
+            frame = self.call_stack[-1]
+            frame.operand_stack.append(return_val)
+            # the return value is on the caller's stack, so is a root
+            if self.gc_limit is None:
+                self.run_garbage_collector()
+            elif len(self.call_stack) + 1 in self.zero_counts:
+                self.release_objects(len(self.call_stack) + 1)
+            return frame
+        return None
+
+    #------------------------------------------------------------
+    # Built-In Functions
+    #------------------------------------------------------------
+
+    def op_write(self, frame, operand):
+        val = frame.operand_stack.pop()
+        if type(val) == bool:
+            if val == True:
+                val = 'true'
+            elif val == False:
+                val = 'false'
+        if val == None:
+            print('null', end='')
+        else:
+            print(val, end='')
+        return frame
+
+    def op_read(self, frame, operand):
+        val = input()
+        frame.operand_stack.append(val)
+        return frame
+
+    def op_len(self, frame, operand):
+        obj = frame.operand_stack.pop()
+        frame.operand_stack.append(self.length(obj))
+        return frame
+
+    def op_getc(self, frame, operand):
+        string = frame.operand_stack.pop()
+        idx = frame.operand_stack.pop()
+        if idx == None:
+            self.error("index cannot be null")
+        if string == None:
+            self.error("string cannot be null")
+        if (idx < 0 or idx > len(string)-1):
+            self.error("index out of bounds")
+        frame.operand_stack.append(string[idx])
+        return frame
+
+    def op_toint(self, frame, operand):
+        val = frame.operand_stack.pop()
+        if val == None:
+            self.error("argument cannot be null")
+        try:
+            frame.operand_stack.append(int(val))
+        except ValueError:
+            self.error("invalid argument")
+        return frame
+
+    def op_todbl(self, frame, operand):
+        val = frame.operand_stack.pop()
+        if val == None:
+            self.error("argument cannot be null")
+        try:
+            frame.operand_stack.append(float(val))
+        except ValueError:
+            self.error("invalid argument")
+        return frame
+
+    def op_tostr(self, frame, operand):
+        val = frame.operand_stack.pop()
+        if val == None:
+            self.error("argument cannot be null")
+        try:
+            frame.operand_stack.append(str(val))
+        except ValueError:
+            self.error("invalid argument")
+        return frame
+
+    #------------------------------------------------------------
+    # Heap
+    #------------------------------------------------------------
+
+    def op_news(self, frame, operand):
+        struct_type = self.struct_types[operand]
+        stack = frame.operand_stack
+        start = len(stack) - len(struct_type.fields)
+        # the field values stay on the stack (as roots) while allocating
+        oid = self.alloc_struct(stack[start:], struct_type)
+        del stack[start:]
+        stack.append(oid)
+        return frame
+
+    def op_setf(self, frame, operand):
+        val = frame.operand_stack.pop()
+        oid = frame.operand_stack.pop()
+        self.set_field(oid, operand, val)
+        return frame
+
+    def op_getf(self, frame, operand):
+        oid = frame.operand_stack.pop()
+        frame.operand_stack.append(self.get_field(oid, operand))
+        return frame
+
+    def op_alloca(self, frame, operand):
+        array_len = frame.operand_stack.pop()
+        frame.operand_stack.append(self.alloc_array(array_len))
+        return frame
+
+    def op_seti(self, frame, operand):
+        val = frame.operand_stack.pop()
+        idx = frame.operand_stack.pop()
+        oid = frame.operand_stack.pop()
+        self.set_index(oid, idx, val)
+        return frame
+
+    def op_geti(self, frame, operand):
+        idx = frame.operand_stack.pop()
+        oid = frame.operand_stack.pop()
+        frame.operand_stack.append(self.get_index(oid, idx))
+        return frame
+
+    #------------------------------------------------------------
+    # Special
+    #------------------------------------------------------------
+
+    def op_dup(self, frame, operand):
+        x = frame.operand_stack.pop()
+        frame.operand_stack.append(x)
+        frame.operand_stack.append(x)
+        return frame
+
+    def op_nop(self, frame, operand):
+        # do nothing
+        return frame
+
+    #------------------------------------------------------------
+    # Superinstructions (see mypl_fusion)
+    #------------------------------------------------------------
+
+    def op_load_load(self, frame, operand):
+        variables = frame.variables
+        frame.operand_stack.append(variables[operand[0]])
+        frame.operand_stack.append(variables[operand[1]])
+        return frame
+
+    def op_load_push(self, frame, operand):
+        frame.operand_stack.append(frame.variables[operand[0]])
+        frame.operand_stack.append(operand[1])
+        return frame
+
+    def op_load_load_add(self, frame, operand):
+        y = frame.variables[operand[0]]
+        x = frame.variables[operand[1]]
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        frame.operand_stack.append(y+x)
+        return frame
+
+    def op_load_push_add(self, frame, operand):
+        y = frame.variables[operand[0]]
+        x = operand[1]
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        frame.operand_stack.append(y+x)
+        return frame
+
+    def op_load_push_add_store(self, frame, operand):
+        y = frame.variables[operand[0]]
+        x = operand[1]
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        frame.operand_stack.append(y+x)
+        return self.op_store(frame, operand[2])
+
+    def op_cmplt_jmpf(self, frame, operand):
+        x = frame.operand_stack.pop()
+        y = frame.operand_stack.pop()
+        if x == None or y == None:
+            self.error("null cannot be used in operations")
+        if not y < x:
+            frame.pc = operand[0]
+        return frame
+
+    def op_load_load_cmplt_jmpf(self, frame, operand):
+        y = frame.variables[operand[0]]
+        x = frame.variables[operand[1]]
+        if x == None or y == None:
+            self.error("null cannot be used in operations")
+        if not y < x:
+            frame.pc = operand[2]
+        return frame
+
+    def op_load_push_cmplt_jmpf(self, frame, operand):
+        y = frame.variables[operand[0]]
+        x = operand[1]
+        if x == None or y == None:
+            self.error("null cannot be used in operations")
+        if not y < x:
+            frame.pc = operand[2]
+        return frame
+
+
+    #----------------------------------------------------------------------
+    # REGISTER INSTRUCTION HANDLERS (register engine)
+    #----------------------------------------------------------------------
+
+    def build_reg_dispatch_table(self):
+        """Returns the list mapping each register opcode value to its
+        handler, as build_dispatch_table does for the stack VM. Each
+        handler is called with the frame, its registers, and the
+        instruction's operand tuple, and returns the frame to continue
+        with.
+
+        """
+        table = [self.reg_unsupported] * (len(RegOpCode) + 1)
+        table[0] = self.reg_end
+        for opcode in RegOpCode:
+            table[opcode.value] = getattr(self, 'reg_' + opcode.name.lower(), self.reg_unsupported)
+        return table
+
+    def reg_end(self, frame, regs, operand):
+        # ran off the end of the function's instructions
+        return None
+
+    def reg_unsupported(self, frame, regs, operand):
+        instr = frame.template.instructions[frame.pc - 1]
+        self.error(f'unsupported operation {instr}')
+
+    def reg_mov(self, frame, regs, operand):
+        regs[operand[0]] = regs[operand[1]]
+        return frame
+
+    #------------------------------------------------------------
+    # Operations
+    #------------------------------------------------------------
+
+    def reg_add(self, frame, regs, operand):
+        d, a, b = operand
+        y = regs[a]
+        x = regs[b]
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        regs[d] = y+x
+        return frame
+
+    def reg_sub(self, frame, regs, operand):
+        d, a, b = operand
+        y = regs[a]
+        x = regs[b]
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        regs[d] = y-x
+        return frame
+
+    def reg_mul(self, frame, regs, operand):
+        d, a, b = operand
+        y = regs[a]
+        x = regs[b]
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        regs[d] = y*x
+        return frame
+
+    def reg_div(self, frame, regs, operand):
+        d, a, b = operand
+        y = regs[a]
+        x = regs[b]
+        if x == 0:
+            self.error("Division by zero error")
+        if x == None or y == None:
+            self.error("null cannot be used in arithmetic operations")
+        if type(x) == int and type(y) == int:
+            regs[d] = y//x
+        else:
+            regs[d] = y/x
+        return frame
+
+    def reg_and(self, frame, regs, operand):
+        d, a, b = operand
+        y = regs[a]
+        x = regs[b]
+        if x == None or y == None:
+            self.error("null cannot be used in logical operations")
+        regs[d] = y and x
+        return frame
+
+    def reg_or(self, frame, regs, operand):
+        d, a, b = operand
+        y = regs[a]
+        x = regs[b]
+        if x == None or y == None:
+            self.error("null cannot be used in logical operations")
+        regs[d] = y or x
+        return frame
+
+    def reg_not(self, frame, regs, operand):
+        x = regs[operand[1]]
+        if x == None:
+            self.error("null cannot be used in logical operations")
+        regs[operand[0]] = not x
+        return frame
+
+    def reg_cmplt(self, frame, regs, operand):
+        d, a, b = operand
+        y = regs[a]
+        x = regs[b]
+        if x == None or y == None:
+            self.error("null cannot be used in operations")
+        regs[d] = y < x
+        return frame
+
+    def reg_cmple(self, frame, regs, operand):
+        d, a, b = operand
+        y = regs[a]
+        x = regs[b]
+        if x == None or y == None:
+            self.error("null cannot be used in operations")
+        regs[d] = y <= x
+        return frame
+
+    def reg_cmpeq(self, frame, regs, operand):
+        d, a, b = operand
+        regs[d] = regs[a] == regs[b]
+        return frame
+
+    def reg_cmpne(self, frame, regs, operand):
+        d, a, b = operand
+        regs[d] = regs[a] != regs[b]
+        return frame
+
+    #------------------------------------------------------------
+    # Branching
+    #------------------------------------------------------------
+
+    def reg_jmp(self, frame, regs, operand):
+        frame.pc = operand[0]
+        return frame
+
+    def reg_jmpf(self, frame, regs, operand):
+        if regs[operand[0]] == False:
+            frame.pc = operand[1]
+        return frame
+
+    #------------------------------------------------------------
+    # Functions
+    #------------------------------------------------------------
+
+    def reg_call(self, frame, regs, operand):
+        callee_template = self.frame_templates[operand[1]]
+        free_frames = callee_template.free_frames
+        if free_frames:
+            callee_frame = free_frames.pop()
+            callee_frame.pc = 0
+        else:
+            callee_frame = VMFrame(callee_template, 0, list(callee_template.registers))
+            self.frames_created += 1
+        callee_regs = callee_frame.variables
+        args = operand[2]
+        for i in range(len(args)):
+            callee_regs[i] = regs[args[i]]
+        self.call_stack.append(callee_frame)
+        return callee_frame
+
+    def reg_ret(self, frame, regs, operand):
+        return_val = regs[operand[0]]
+        self.call_stack.pop()
+        if len(self.call_stack) > 0:
+            if self.frame_pool:
+                # a pooled frame is not a root, so its registers are
+                # reset to the initial register file (variables and
+                # temporaries null, constants filled in)
+                frame.variables[:] = frame.template.registers
+                frame.template.free_frames.append(frame)
+            frame = self.call_stack[-1]
+            # the result goes to the destination of the caller's CALL
+            frame.variables[frame.template.operands[frame.pc - 1][0]] = return_val
+            if self.gc_limit is None:
+                self.run_garbage_collector()
+            elif len(self.call_stack) + 1 in self.zero_counts:
+                self.release_objects(len(self.call_stack) + 1)
+            return frame
+        return None
+
+    #------------------------------------------------------------
+    # Built-In Functions
+    #------------------------------------------------------------
+
+    def reg_write(self, frame, regs, operand):
+        val = regs[operand[0]]
+        if type(val) == bool:
+            val = 'true' if val else 'false'
+        print('null' if val == None else val, end='')
+        return frame
+
+    def reg_read(self, frame, regs, operand):
+        regs[operand[0]] = input()
+        return frame
+
+    def reg_len(self, frame, regs, operand):
+        regs[operand[0]] = self.length(regs[operand[1]])
+        return frame
+
+    def reg_getc(self, frame, regs, operand):
+        idx = regs[operand[1]]
+        string = regs[operand[2]]
+        if idx == None:
+            self.error("index cannot be null")
+        if string == None:
+            self.error("string cannot be null")
+        if (idx < 0 or idx > len(string)-1):
+            self.error("index out of bounds")
+        regs[operand[0]] = string[idx]
+        return frame
+
+    def reg_toint(self, frame, regs, operand):
+        val = regs[operand[1]]
+        if val == None:
+            self.error("argument cannot be null")
+        try:
+            regs[operand[0]] = int(val)
+        except ValueError:
+            self.error("invalid argument")
+        return frame
+
+    def reg_todbl(self, frame, regs, operand):
+        val = regs[operand[1]]
+        if val == None:
+            self.error("argument cannot be null")
+        try:
+            regs[operand[0]] = float(val)
+        except ValueError:
+            self.error("invalid argument")
+        return frame
+
+    def reg_tostr(self, frame, regs, operand):
+        val = regs[operand[1]]
+        if val == None:
+            self.error("argument cannot be null")
+        regs[operand[0]] = str(val)
+        return frame
+
+    #------------------------------------------------------------
+    # Heap
+    #------------------------------------------------------------
+
+    def reg_news(self, frame, regs, operand):
+        values = [regs[reg] for reg in operand[2]]
+        regs[operand[0]] = self.alloc_struct(values, self.struct_types[operand[1]])
+        return frame
+
+    def reg_setf(self, frame, regs, operand):
+        self.set_field(regs[operand[0]], operand[1], regs[operand[2]])
+        return frame
+
+    def reg_getf(self, frame, regs, operand):
+        regs[operand[0]] = self.get_field(regs[operand[1]], operand[2])
+        return frame
+
+    def reg_alloca(self, frame, regs, operand):
+        regs[operand[0]] = self.alloc_array(regs[operand[1]])
+        return frame
+
+    def reg_seti(self, frame, regs, operand):
+        self.set_index(regs[operand[0]], regs[operand[1]], regs[operand[2]])
+        return frame
+
+    def reg_geti(self, frame, regs, operand):
+        regs[operand[0]] = self.get_index(regs[operand[1]], regs[operand[2]])
+        return frame
+
+    def reg_nop(self, frame, regs, operand):
+        # do nothing
+        return frame
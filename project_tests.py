@@ -12,6 +12,8 @@ These unit tests examine the value of the struct heap and the array heap at the
 
 import pytest
 import io
+import json
+import sys
 
 from mypl_error import *
 from mypl_iowrapper import *
@@ -21,6 +23,8 @@ from mypl_ast_parser import *
 from mypl_var_table import *
 from mypl_code_gen import *
 from mypl_vm import *
+from mypl_debug import *
+from mypl_escape import *
 
 def build(program):
     in_stream = FileWrapper(io.StringIO(program))
@@ -404,20 +408,23 @@ def test_path_expression_return(capsys):
         'void main() {\n'
         '    array int xs = new int[5];  // 2024\n'
         '    array Node nodes = new Node[6];  // 2025\n'
-        '    Node newer_node = create_new_node(); //2029\n'
+        '    Node newer_node = create_new_node(); //2030\n'
         '}\n'
         '\n'
         'Node create_new_node() {\n'
         '    array int zs = new int[7];  // 2026\n'
         '    array int as = new int[8];  // 2027\n'
-        '    Node new_node = new Node(1, new Node(2, new Node(3, new Node(4, null)))); // 2028, 2029, 2030, 2031\n'
-        '    return new_node.next;   // 2029\n'
+        '    Node new_node = new Node(1, new Node(2, new Node(3, new Node(4, null)))); // 2031, 2030, 2029, 2028\n'
+        '    return new_node.next;   // 2030\n'
         '}\n'
     )
     build(program).run()
     captured = capsys.readouterr()
     print(captured.out)
-    assert captured.out == 'struct: [2029] , array: [2024, 2025]\n'
+    # the field values of a struct are allocated before it (NEWS pops
+    # them), so 2030 is a root, and reaches 2029 and 2028 through its
+    # next fields
+    assert captured.out == 'struct: [2028, 2029, 2030] , array: [2024, 2025]\n'
 
 def test_return_array_and_set_field(capsys):
     program = (
@@ -785,3 +792,1092 @@ def test_struct_of_arrays(capsys):
     print(captured.out)
     assert captured.out == 'struct: [2024] , array: [2026, 2028, 2030, 2032]\n'
 
+
+# tests below check the VM instruction dispatch table
+
+def test_dispatch_table_has_handler_for_every_opcode():
+    vm = VM()
+    for opcode in OpCode:
+        assert vm.dispatch[opcode.value] != vm.op_unsupported
+
+def test_frame_template_lowered_on_add():
+    vm = build(
+        'void main() {\n'
+        '    int x = 1 + 2;\n'
+        '}\n'
+    )
+    template = vm.frame_templates['main']
+    assert template.opcodes[:-1] == tuple(i.opcode.value for i in template.instructions)
+    assert template.operands[:-1] == tuple(i.operand for i in template.instructions)
+    assert template.opcodes[-1] == 0
+
+# tests below check the closure-threaded execution engine
+
+def build_engine(program, engine, **vm_options):
+    vm = VM(engine=engine, **vm_options)
+    codegen = code_generator(vm)
+    ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse().accept(codegen)
+    return vm
+
+def test_closure_engine_same_output_as_table_engine(capsys):
+    program = (
+        'int fib(int n) {\n'
+        '    if (n <= 1) {\n'
+        '        return n;\n'
+        '    }\n'
+        '    return fib(n - 1) + fib(n - 2);\n'
+        '}\n'
+        'void main() {\n'
+        '    array int xs = new int[10];\n'
+        '    for (int i = 0; i < 10; i = i + 1) {\n'
+        '        xs[i] = fib(i);\n'
+        '    }\n'
+        '    print(itos(xs[9]) + " " + dtos(itod(xs[8]) / 2.0));\n'
+        '}\n'
+    )
+    build_engine(program, 'table').run()
+    table_out = capsys.readouterr().out
+    build_engine(program, 'closure').run()
+    closure_out = capsys.readouterr().out
+    assert table_out == '34 10.5'
+    assert closure_out == table_out
+
+def test_closure_engine_collects_garbage_on_return():
+    program = (
+        'void main() {\n'
+        '    array int xs = new int[5];  // 2024\n'
+        '    my_fun(); \n'
+        '}\n'
+        '\n'
+        'void my_fun() {\n'
+        '    array int ys = new int[7];  // 2025\n'
+        '}\n'
+    )
+    vm = build_engine(program, 'closure')
+    vm.run()
+    assert [int(key) for key in vm.array_heap] == [2024]
+
+# tests below check the Python backend (py engine)
+
+def test_py_engine_same_output_as_table_engine(capsys):
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'int count(Node n) {\n'
+        '    int total = 0;\n'
+        '    while (n != null) {\n'
+        '        total = total + n.val;\n'
+        '        n = n.next;\n'
+        '    }\n'
+        '    return total;\n'
+        '}\n'
+        'int inc(array int xs, int i) {\n'
+        '    xs[i] = xs[i] + 1;\n'
+        '    return i;\n'
+        '}\n'
+        'void main() {\n'
+        '    Node head = new Node(1, new Node(2, new Node(3, null)));\n'
+        '    array int xs = new int[3];\n'
+        '    xs[0] = 5;\n'
+        '    int y = xs[0] + xs[inc(xs, 0)];\n'
+        '    if (count(head) > 5) {\n'
+        '        print("big ");\n'
+        '    } elseif (count(head) == 6) {\n'
+        '        print("six ");\n'
+        '    } else {\n'
+        '        print("small ");\n'
+        '    }\n'
+        '    print(itos(y) + " " + itos(7 / 2) + " " + dtos(7.0 / 2.0));\n'
+        '    print(not (1 < 2) or true);\n'
+        '}\n'
+    )
+    build_engine(program, 'table').run()
+    table_out = capsys.readouterr().out
+    build_engine(program, 'py').run()
+    py_out = capsys.readouterr().out
+    assert table_out == 'big 11 3 3.5false'
+    assert py_out == table_out
+
+def test_py_engine_collects_garbage_on_return():
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'void main() {\n'
+        '    Node node1 = new Node(1, null); // 2024\n'
+        '    set_next(node1);\n'
+        '}\n'
+        'void set_next(Node n) {\n'
+        '    n.next = new Node(2, null); // 2025\n'
+        '    Node node2 = new Node(3, null); // 2026\n'
+        '}\n'
+    )
+    vm = build_engine(program, 'py')
+    vm.run()
+    assert sorted(int(key) for key in vm.struct_heap) == [2024, 2025]
+
+def test_py_engine_null_arithmetic_error():
+    program = (
+        'void main() {\n'
+        '    int x = null;\n'
+        '    int y = x + 1;\n'
+        '}\n'
+    )
+    with pytest.raises(MyPLError):
+        build_engine(program, 'py').run()
+    # the same errors as the table engine
+    for stmt in ['int y = x + 1;', 'int y = 2 * x;', 'bool b = x > 1;', 'bool b = 1 <= x;']:
+        program = 'void main() {\n    int x = null;\n    ' + stmt + '\n}\n'
+        messages = []
+        for engine in ['table', 'py']:
+            with pytest.raises(MyPLError) as ex:
+                build_engine(program, engine).run()
+            messages.append(str(ex.value))
+        assert messages[0] == messages[1]
+
+def test_jit_same_output_as_interpreter(capsys):
+    program = (
+        'void main() {\n'
+        '    array int xs = new int[100];\n'
+        '    for (int i = 0; i < 100; i = i + 1) {\n'
+        '        xs[i] = (i * 7) - ((i / 10) * 3);\n'
+        '    }\n'
+        '    int evens = 0;\n'
+        '    double total = 0.0;\n'
+        '    for (int i = 0; i < 100; i = i + 1) {\n'
+        '        if (((xs[i] / 2) * 2) == xs[i]) {\n'
+        '            evens = evens + 1;\n'
+        '        }\n'
+        '        total = total + itod(xs[i]);\n'
+        '    }\n'
+        '    print(itos(evens) + " " + dtos(total));\n'
+        '}\n'
+    )
+    build_engine(program, 'table').run()
+    table_out = capsys.readouterr().out
+    vm = build_engine(program, 'table', jit_threshold=5)
+    vm.run()
+    jit_out = capsys.readouterr().out
+    assert jit_out == table_out
+    assert len(vm.traces) == 2 and all(vm.traces.values())
+
+def test_jit_trace_deoptimizes_to_interpreter():
+    program = (
+        'void main() {\n'
+        '    int i = 0;\n'
+        '    int x = 0;\n'
+        '    while (i < 20) {\n'
+        '        if (i == 15) {\n'
+        '            x = 100 / (i - 15);\n'
+        '        }\n'
+        '        i = i + 1;\n'
+        '    }\n'
+        '}\n'
+    )
+    vm = build_engine(program, 'table', jit_threshold=2)
+    with pytest.raises(MyPLError) as e:
+        vm.run()
+    assert str(e.value).startswith('VM Error: Division by zero')
+    assert vm.call_stack[-1].variables[0] == 15
+
+def test_fusion_same_output_and_counts(capsys):
+    program = (
+        'struct P {\n'
+        '    int x;\n'
+        '    int y;\n'
+        '}\n'
+        'void main() {\n'
+        '    int total = 0;\n'
+        '    for (int i = 0; i < 10; i = i + 1) {\n'
+        '        P p = new P(i, 2);\n'
+        '        total = total + (p.x * p.y);\n'
+        '    }\n'
+        '    print(total);\n'
+        '}\n'
+    )
+    build_engine(program, 'table').run()
+    table_out = capsys.readouterr().out
+    for engine in ['table', 'closure']:
+        vm = build_engine(program, engine, fuse=True)
+        vm.run()
+        assert capsys.readouterr().out == table_out == '90'
+    assert vm.fusion_counts['LOAD_PUSH_CMPLT_JMPF'] == 1
+    assert vm.fusion_counts['LOAD_PUSH_ADD_STORE'] == 1
+    # the struct is built by a single NEWS (nothing left to fuse)
+    assert OpCode.NEWS in [instr.opcode for instr in vm.frame_templates['main'].instructions]
+
+def test_fusion_remaps_jumps_and_skips_jump_targets():
+    instrs = [LOAD(0), PUSH(1), CMPLT(), JMPF(6), LOAD(0), PUSH(2),
+              ADD(), STORE(0), JMP(0)]
+    # a jump into the middle of LOAD; PUSH; ADD; STORE blocks it
+    fused = fuse_instructions(instrs)
+    assert [i.opcode for i in fused] == [OpCode.LOAD_PUSH_CMPLT_JMPF, OpCode.LOAD_PUSH,
+                                         OpCode.ADD, OpCode.STORE, OpCode.JMP]
+    assert fused[0].operand == (0, 1, 2)
+    assert fused[4].operand == 0
+
+def test_register_engine_same_output_as_table_engine(capsys):
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'int sum(Node n) {\n'
+        '    int total = 0;\n'
+        '    while (n != null) {\n'
+        '        total = total + n.val;\n'
+        '        n = n.next;\n'
+        '    }\n'
+        '    return total;\n'
+        '}\n'
+        'void main() {\n'
+        '    Node head = null;\n'
+        '    for (int i = 1; i <= 4; i = i + 1) {\n'
+        '        head = new Node(i, head);\n'
+        '    }\n'
+        '    array double xs = new double[2];\n'
+        '    xs[1] = 7.0 / 2.0;\n'
+        '    if (sum(head) > 10) {\n'
+        '        print("big ");\n'
+        '    } elseif (sum(head) >= 10) {\n'
+        '        print("ten ");\n'
+        '    }\n'
+        '    print(itos(sum(head)) + " " + dtos(xs[1]) + " " + get(1, "abc"));\n'
+        '    print(not (head.next.val < 3));\n'
+        '}\n'
+    )
+    build_engine(program, 'table').run()
+    table_out = capsys.readouterr().out
+    vm = build_engine(program, 'register')
+    vm.run()
+    assert capsys.readouterr().out == table_out == 'ten 10 3.5 btrue'
+    # variables and constants are read in place, not loaded
+    instrs = vm.frame_templates['sum'].instructions
+    assert instrs[3] == RegInstr(RegOpCode.GETF, (2, 0, 0))
+    assert instrs[4] == RegInstr(RegOpCode.ADD, (1, 1, 2))
+
+def test_register_engine_collects_garbage_on_return():
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'void main() {\n'
+        '    Node node1 = new Node(1, null); // 2024\n'
+        '    set_next(node1);\n'
+        '}\n'
+        'void set_next(Node n) {\n'
+        '    n.next = new Node(2, null); // 2025\n'
+        '    Node node2 = new Node(3, null); // 2026\n'
+        '}\n'
+    )
+    vm = build_engine(program, 'register')
+    vm.run()
+    assert sorted(int(key) for key in vm.struct_heap) == [2024, 2025]
+
+def test_frame_template_sizes():
+    program = (
+        'int add(int x, int y) {\n'
+        '    return x + y;\n'
+        '}\n'
+        'void main() {\n'
+        '    int a = 1;\n'
+        '    for (int i = 0; i < 3; i = i + 1) {\n'
+        '        int b = add(a, (i * 2) + 1);\n'
+        '        add(a, b);\n'
+        '    }\n'
+        '    int c = 2;\n'
+        '}\n'
+    )
+    vm = build_engine(program, 'table')
+    add_template = vm.frame_templates['add']
+    main_template = vm.frame_templates['main']
+    assert add_template.local_count == 2 and add_template.max_stack_depth == 2
+    assert main_template.local_count == 3 and main_template.max_stack_depth == 3
+    # hand built templates are sized from their instructions
+    template = VMFrameTemplate('f', 1, [STORE(0), LOAD(0), DUP(), PUSH(2), ADD(), STORE(1),
+                                        PUSH(None), RET()])
+    vm.add_frame_template(template)
+    assert template.local_count == 2 and template.max_stack_depth == 3
+
+def test_call_statement_result_is_popped():
+    program = (
+        'int one() {\n'
+        '    return 1;\n'
+        '}\n'
+        'void main() {\n'
+        '    for (int i = 0; i < 5; i = i + 1) {\n'
+        '        one();\n'
+        '    }\n'
+        '}\n'
+    )
+    vm = build_engine(program, 'table')
+    instrs = vm.frame_templates['main'].instructions
+    call_idx = [i.opcode for i in instrs].index(OpCode.CALL)
+    assert instrs[call_idx + 1].opcode == OpCode.POP
+    assert vm.frame_templates['main'].max_stack_depth == 2
+
+def test_frames_reused_from_template_free_list(capsys):
+    program = (
+        'int fib(int n) {\n'
+        '    if (n <= 1) {\n'
+        '        return n;\n'
+        '    }\n'
+        '    return fib(n - 1) + fib(n - 2);\n'
+        '}\n'
+        'void main() {\n'
+        '    print(fib(10));\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        vm = build_engine(program, engine)
+        vm.run()
+        assert capsys.readouterr().out == '55'
+        # main plus one frame per level of recursion
+        assert vm.frames_created == 11
+        assert len(vm.frame_templates['fib'].free_frames) == 10
+    vm = build_engine(program, 'table', frame_pool=False)
+    vm.run()
+    assert capsys.readouterr().out == '55'
+    assert vm.frames_created == 178
+
+def test_pooled_frames_hold_no_heap_references(capsys):
+    program = (
+        'int total(int n) {\n'
+        '    array int xs = new int[n];\n'
+        '    xs[0] = n;\n'
+        '    return xs[0];\n'
+        '}\n'
+        'void main() {\n'
+        '    print(total(2) + total(3));\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        vm = build_engine(program, engine)
+        vm.run()
+        assert capsys.readouterr().out == '5'
+        template = vm.frame_templates['total']
+        [frame] = template.free_frames
+        # a reused frame must not make its last call's objects roots
+        if engine == 'register':
+            assert frame.variables == template.registers
+        else:
+            assert frame.variables == [None] * template.local_count
+
+def test_trace_sink_filters_by_function_and_pc(capsys):
+    program = (
+        'int twice(int x) {\n'
+        '    return x * 2;\n'
+        '}\n'
+        'void main() {\n'
+        '    print(twice(3));\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        vm = build_engine(program, engine)
+        sink = ListTraceSink(functions=['twice'], pc_range=(0, 2))
+        vm.run(trace=sink)
+        assert capsys.readouterr().out == '6'
+        assert [(e.function, e.pc) for e in sink.events] == [('twice', 0), ('twice', 1)]
+        assert all(e.depth == 2 for e in sink.events)
+    out = io.StringIO()
+    build_engine(program, 'table').run(trace=TraceSink(out, ['main'], parse_pc_range(':1'), 'json'))
+    assert capsys.readouterr().out == '6'
+    assert json.loads(out.getvalue()) == {'function': 'main', 'pc': 0, 'instr': 'OpCode.PUSH(3)',
+                                          'stack_top': 'None', 'depth': 1}
+    # the py engine runs no VM instructions to trace
+    with pytest.raises(MyPLError):
+        build_engine(program, 'py').run(trace=ListTraceSink())
+    assert capsys.readouterr().out == ''
+
+def test_mark_phase_long_list():
+    # a 1M node linked list: marking must not recurse per node
+    vm = VM()
+    n = 1_000_000
+    for i in range(n):
+        vm.object_graph[i] = HeapObject(i, STRUCT)
+        if i + 1 < n:
+            vm.object_graph[i].add_reference(i + 1)
+    vm.object_graph[n] = HeapObject(n, STRUCT)
+    marked = vm.mark_phase([0])
+    assert len(marked) == n
+    assert n not in marked
+
+def test_mark_phase_diamond_dag_and_cycle():
+    # 200 stacked diamonds (2**200 root-to-bottom paths), the bottom
+    # pointing back to the top
+    vm = VM()
+    for i in range(601):
+        vm.object_graph[i] = HeapObject(i, STRUCT)
+    for d in range(200):
+        top, left, right, bottom = 3 * d, 3 * d + 1, 3 * d + 2, 3 * d + 3
+        for parent, child in [(top, left), (top, right), (left, bottom), (right, bottom)]:
+            vm.object_graph[parent].add_reference(child)
+            vm.object_graph[child].add_parent(parent)
+    vm.object_graph[600].add_reference(0)
+    assert vm.mark_phase([0]) == set(range(601))
+    assert vm.mark_phase([300]) == set(range(601))
+
+def test_roots_found_on_operand_stacks(capsys):
+    # the outer struct is only on main's operand stack when make returns
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'Node make(int v) {\n'
+        '    Node tmp = new Node(v, null);\n'
+        '    Node garbage = new Node(v, null);\n'
+        '    return tmp;\n'
+        '}\n'
+        'void main() {\n'
+        '    Node n = new Node(0, make(1));\n'
+        '    print(n.next.val);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        vm = build_engine(program, engine)
+        vm.run()
+        assert capsys.readouterr().out == '1'
+        assert len(vm.struct_heap) == 2
+        assert not hasattr(vm, 'root_set')
+
+def test_sweep_uses_object_kinds():
+    vm = VM()
+    array = vm.alloc_array(3)
+    vm.set_index(array, 0, vm.alloc_struct())
+    dead_struct = vm.alloc_struct([None])
+    dead_array = vm.alloc_array(2)
+    vm.set_field(dead_struct, 0, dead_array)
+    vm.call_stack.append(VMFrame(VMFrameTemplate('main', 0), 0, [array]))
+    assert vm.object_graph[array].kind == ARRAY
+    assert vm.object_graph[dead_struct].kind == STRUCT
+    vm.run_garbage_collector()
+    assert list(vm.array_heap) == [array]
+    assert list(vm.struct_heap) == [vm.get_index(array, 0)]
+    assert sorted(vm.object_graph) == sorted([array, vm.get_index(array, 0)])
+
+def test_allocation_triggered_collection(capsys):
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'Node build(int n) {\n'
+        '    if (n == 0) {\n'
+        '        return null;\n'
+        '    }\n'
+        '    Node garbage = new Node(n, null);\n'
+        '    return new Node(n, build(n - 1));\n'
+        '}\n'
+        'void main() {\n'
+        '    Node head = null;\n'
+        '    for (int i = 0; i < 4; i = i + 1) {\n'
+        '        head = build(50);\n'
+        '    }\n'
+        '    int total = 0;\n'
+        '    while (head != null) {\n'
+        '        total = total + head.val;\n'
+        '        head = head.next;\n'
+        '    }\n'
+        '    print(total);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        vm = build_engine(program, engine)
+        vm.run()
+        assert capsys.readouterr().out == '1275'
+        assert vm.collections == 204
+        vm = build_engine(program, engine, gc_threshold=20)
+        vm.run()
+        assert capsys.readouterr().out == '1275'
+        assert 0 < vm.collections < 10
+        assert len(vm.object_graph) <= vm.gc_limit
+
+def test_gc_growth_factor_adapts():
+    vm = VM(gc_threshold=4, gc_growth=2.0, engine='table')
+    vm.call_stack.append(VMFrame(VMFrameTemplate('main', 0), 0, []))
+    live = vm.call_stack[0].variables
+    for _ in range(4):
+        live.append(vm.alloc_struct())
+    # nothing reclaimed: the factor doubles
+    live.append(vm.alloc_struct())
+    assert (vm.collections, vm.gc_factor, vm.gc_limit) == (1, 4.0, 16)
+    # everything reclaimed: the factor resets
+    live.clear()
+    for _ in range(12):
+        vm.alloc_struct()
+    assert (vm.collections, vm.gc_factor, vm.gc_limit) == (2, 2.0, 4)
+
+def test_generational_collector_same_output(capsys):
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'void main() {\n'
+        '    array Node xs = new Node[5];\n'
+        '    for (int i = 0; i < 200; i = i + 1) {\n'
+        '        int k = i - ((i / 5) * 5);\n'
+        '        Node garbage = new Node(i, null);\n'
+        '        xs[k] = new Node(i, xs[k]);\n'
+        '    }\n'
+        '    int total = 0;\n'
+        '    for (int j = 0; j < 5; j = j + 1) {\n'
+        '        Node n = xs[j];\n'
+        '        while (n != null) {\n'
+        '            total = total + n.val;\n'
+        '            n = n.next;\n'
+        '        }\n'
+        '    }\n'
+        '    print(total);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        vm = build_engine(program, engine, gc='generational', nursery_size=8, gc_threshold=64)
+        vm.run()
+        assert capsys.readouterr().out == '19900'
+        assert vm.minor_collections > 40
+        assert 0 < vm.collections < vm.minor_collections
+        assert len(vm.object_graph) < 300
+
+def test_write_barrier_remembers_old_to_young_references():
+    vm = VM(engine='table', gc='generational', nursery_size=100)
+    vm.call_stack.append(VMFrame(VMFrameTemplate('main', 0), 0, [None]))
+    old = vm.alloc_array(1)
+    vm.call_stack[0].variables[0] = old
+    vm.minor_collection()
+    assert vm.nursery == set()
+    young = vm.alloc_struct()
+    vm.set_index(old, 0, young)
+    assert vm.remembered == {old}
+    garbage = vm.alloc_struct()
+    # young is only reachable through old, found from the remembered set
+    vm.minor_collection()
+    assert young in vm.struct_heap
+    assert garbage not in vm.struct_heap
+    assert vm.remembered == set()
+
+def test_incremental_collector_same_output(capsys):
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'void main() {\n'
+        '    array Node xs = new Node[5];\n'
+        '    for (int i = 0; i < 200; i = i + 1) {\n'
+        '        int k = i - ((i / 5) * 5);\n'
+        '        Node garbage = new Node(i, null);\n'
+        '        xs[k] = new Node(i, xs[k]);\n'
+        '    }\n'
+        '    int total = 0;\n'
+        '    for (int j = 0; j < 5; j = j + 1) {\n'
+        '        Node n = xs[j];\n'
+        '        while (n != null) {\n'
+        '            total = total + n.val;\n'
+        '            n = n.next;\n'
+        '        }\n'
+        '    }\n'
+        '    print(total);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        vm = build_engine(program, engine, gc='incremental', gc_threshold=32,
+                          gc_step_interval=5, gc_step_budget=3)
+        vm.run()
+        assert capsys.readouterr().out == '19900'
+        assert vm.collections > 1
+        assert vm.max_gc_pause > 0
+        # 401 objects were allocated
+        assert len(vm.object_graph) < 401
+
+def test_incremental_write_barrier_shades_stored_object():
+    vm = VM(engine='table', gc='incremental')
+    black = vm.alloc_struct([None])
+    white = vm.alloc_struct()
+    vm.gray = []
+    vm.marked = {black}
+    vm.set_field(black, 0, white)
+    assert vm.gray == [white]
+    assert white in vm.marked
+    # objects allocated while marking are black
+    new = vm.alloc_struct()
+    assert new in vm.marked and new not in vm.gray
+
+def test_refcount_frees_acyclic_garbage_and_collects_cycles(capsys):
+    program = (
+        'struct DNode {\n'
+        '    int val;\n'
+        '    DNode prev;\n'
+        '    DNode next;\n'
+        '}\n'
+        'void make_pair(int v) {\n'
+        '    DNode a = new DNode(v, null, null);\n'
+        '    DNode b = new DNode(v, a, null);\n'
+        '    a.next = b;\n'
+        '}\n'
+        'DNode make_chain(int n) {\n'
+        '    DNode head = null;\n'
+        '    for (int i = 0; i < n; i = i + 1) {\n'
+        '        head = new DNode(i, null, head);\n'
+        '    }\n'
+        '    return head;\n'
+        '}\n'
+        'void main() {\n'
+        '    DNode keep = make_chain(3);\n'
+        '    for (int i = 0; i < 50; i = i + 1) {\n'
+        '        make_pair(i);\n'
+        '        DNode chain = make_chain(4);\n'
+        '    }\n'
+        '    make_chain(0);\n'
+        '    print(keep.next.val);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        # without a cycle collection the 50 pairs (cycles) are left,
+        # along with keep and the last chain
+        # (and the last chain; with the stack engines also the one
+        # before it, which main drops by storing the last chain after
+        # the last allocating call has returned)
+        chains = 1 if engine == 'register' else 2
+        vm = build_engine(program, engine, gc='refcount', gc_threshold=10_000)
+        vm.run()
+        assert capsys.readouterr().out == '1'
+        assert vm.collections == 0
+        assert len(vm.object_graph) == 3 + 100 + chains * 4
+        assert vm.objects_released == (50 - chains) * 4
+        vm = build_engine(program, engine, gc='refcount', gc_threshold=20)
+        vm.run()
+        assert capsys.readouterr().out == '1'
+        assert vm.collections > 0
+        assert vm.peak_heap < 50
+
+def test_refcount_releases_only_after_returns_that_drop_objects(capsys):
+    program = (
+        'struct P {\n'
+        '    int x;\n'
+        '}\n'
+        'int f(int i) {\n'
+        '    return i + 1;\n'
+        '}\n'
+        'void g() {\n'
+        '    array int xs = new int[2];\n'
+        '}\n'
+        'void main() {\n'
+        '    P keep = new P(1);\n'
+        '    int t = 0;\n'
+        '    for (int j = 0; j < 10; j = j + 1) {\n'
+        '        g();\n'
+        '        for (int i = 0; i < 100; i = i + 1) {\n'
+        '            t = f(t);\n'
+        '        }\n'
+        '    }\n'
+        '    print(t + keep.x);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        vm = build_engine(program, engine, gc='refcount', gc_threshold=10_000)
+        vm.run()
+        assert capsys.readouterr().out == '1001'
+        # only the returns from g free anything (main's struct is kept)
+        stats = vm.gc_stats()
+        assert stats['collections'] == stats['by_collector']['refcount'] == 10
+        assert stats['freed_arrays'] == 10 and stats['freed_structs'] == 0
+        assert list(vm.object_graph) == [2024]
+
+def test_copying_collector_same_output(capsys):
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'void main() {\n'
+        '    array Node xs = new Node[5];\n'
+        '    for (int i = 0; i < 200; i = i + 1) {\n'
+        '        int k = i - ((i / 5) * 5);\n'
+        '        Node garbage = new Node(i, null);\n'
+        '        xs[k] = new Node(i, xs[k]);\n'
+        '    }\n'
+        '    int total = 0;\n'
+        '    for (int j = 0; j < 5; j = j + 1) {\n'
+        '        Node n = xs[j];\n'
+        '        while (n != null) {\n'
+        '            total = total + n.val;\n'
+        '            n = n.next;\n'
+        '        }\n'
+        '    }\n'
+        '    print(total);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        vm = build_engine(program, engine, gc='copying', gc_threshold=16)
+        vm.run()
+        assert capsys.readouterr().out == '19900'
+        assert vm.collections > 2
+        assert vm.struct_heap == {} and vm.object_graph == {}
+        assert len(vm.heap) < 401
+
+def test_copying_collector_with_pooled_frames(capsys):
+    program = (
+        'struct P {\n'
+        '    int a;\n'
+        '    int b;\n'
+        '    array int xs;\n'
+        '    P next;\n'
+        '}\n'
+        'int f(int a) {\n'
+        '    int s = 0;\n'
+        '    for (int j = 0; j < 100; j = j + 1) {\n'
+        '        P p = new P(a, a * 2, new int[3], null);\n'
+        '        s = s + p.a + p.b;\n'
+        '    }\n'
+        '    return s;\n'
+        '}\n'
+        'void main() {\n'
+        '    int total = 0;\n'
+        '    for (int i = 0; i < 10; i = i + 1) {\n'
+        '        total = total + f(i);\n'
+        '        for (int k = 0; k < 50; k = k + 1) {\n'
+        '            array int g = new int[1];\n'
+        '        }\n'
+        '    }\n'
+        '    print(total);\n'
+        '}\n'
+    )
+    # main's allocations compact the heap while f's frame is pooled, so
+    # a reused frame must not carry the references of its last call
+    for engine in ['table', 'closure', 'register']:
+        for pool in [True, False]:
+            vm = build_engine(program, engine, gc='copying', gc_threshold=4, frame_pool=pool)
+            vm.run()
+            assert capsys.readouterr().out == '13500'
+            assert vm.collections > 10
+
+def test_copying_collection_renumbers_objects():
+    vm = VM(engine='table', gc='copying')
+    garbage = vm.alloc_struct()
+    child = vm.alloc_struct([None])
+    parent = vm.alloc_struct([child])
+    vm.call_stack.append(VMFrame(VMFrameTemplate('main', 0), 0, [parent, 7]))
+    assert type(parent) == HeapRef and parent == 2
+    vm.run_garbage_collector()
+    # parent is copied first, then child when parent is scanned
+    assert vm.call_stack[0].variables == [HeapRef(0), 7]
+    assert vm.heap == [[HeapRef(1)], [None]]
+    assert [type(obj) for obj in vm.heap] == [Struct, Struct]
+    assert vm.alloc_array(3) == HeapRef(2)
+
+def test_gc_stats_record_every_collection(capsys):
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'Node make(int n) {\n'
+        '    array int garbage = new int[n];\n'
+        '    return new Node(n, null);\n'
+        '}\n'
+        'void main() {\n'
+        '    Node n = null;\n'
+        '    for (int i = 0; i < 10; i = i + 1) {\n'
+        '        n = make(i);\n'
+        '    }\n'
+        '    print(n.val);\n'
+        '}\n'
+    )
+    for gc in ['marksweep', 'generational', 'refcount', 'copying']:
+        vm = build_engine(program, 'table', gc=gc, gc_threshold=4, nursery_size=4)
+        vm.run()
+        assert capsys.readouterr().out == '9'
+        stats = vm.gc_stats()
+        assert stats['collections'] == len(stats['events']) > 0
+        assert sum(count for _, count in stats['pause_histogram']) == stats['collections']
+        for event in stats['events']:
+            assert event.live_before - event.live_after == event.freed_structs + event.freed_arrays
+            assert event.pause >= event.mark_time + event.sweep_time >= 0
+        assert stats['freed_arrays'] > 0
+    assert 'gc pauses:' in vm.gc_history.report()
+
+def test_gc_stats_keep_totals_and_recent_events():
+    from mypl_gc_stats import GCStats
+    history = GCStats(max_events=10)
+    for i in range(100):
+        history.record('full', 0.002 if i == 50 else 0.0, 0.0, 0.0, 3, 1, 1, 1)
+    stats = history.summary()
+    assert stats['collections'] == 100 and stats['by_collector'] == {'full': 100}
+    assert stats['freed_structs'] == stats['freed_arrays'] == 100
+    assert stats['pause_max'] == stats['pause_total'] == 0.002
+    assert dict(stats['pause_histogram'])[10] == 1
+    assert len(stats['events']) == 10
+
+def test_heap_snapshot_retaining_paths():
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'void main() {\n'
+        '    Node head = new Node(0, null);\n'
+        '    Node n = head;\n'
+        '    for (int i = 1; i < 12; i = i + 1) {\n'
+        '        n.next = new Node(i, null);\n'
+        '        n = n.next;\n'
+        '    }\n'
+        '    n = null;\n'
+        '    array int garbage = new int[3];\n'
+        '    garbage = null;\n'
+        '}\n'
+    )
+    for gc in ['marksweep', 'copying']:
+        vm = build_engine(program, 'table', gc=gc, gc_threshold=100)
+        vm.run()
+        out = io.StringIO()
+        vm.heap_snapshot(out)
+        snapshot = json.loads(out.getvalue())
+        objects = snapshot['objects']
+        assert snapshot['summary'] == {'objects': 13, 'reachable': 12,
+                                       'size': sum(obj['size'] for obj in objects)}
+        assert all(obj['size'] > 0 for obj in objects)
+        garbage = [obj for obj in objects if not obj['reachable']]
+        assert [obj['kind'] for obj in garbage] == ['array']
+        assert garbage[0]['path'] is None
+        nodes = [obj for obj in objects if obj['reachable']]
+        assert nodes[0]['path'] == ['main#0.var0']
+        assert nodes[1]['path'] == ['main#0.var0', f'{nodes[0]["id"]}.next']
+        # the middle of a long path is elided
+        last = nodes[-1]['path']
+        assert len(last) == 9 and last[4] == '...'
+        assert last[:4] == [obj['path'][-1] for obj in nodes[:4]]
+        assert last[-1] == f'{nodes[-2]["id"]}.next'
+        assert nodes[-1]['edges'] == [] and nodes[0]['edges'] == [{'label': 'next', 'to': nodes[1]['id']}]
+        out = io.StringIO()
+        vm.heap_snapshot(out, 'dot')
+        assert out.getvalue().startswith('digraph heap {')
+        assert 'style=dashed' in out.getvalue()
+    # the py engine's roots are the locals of main's Python frame
+    vm = build_engine(program, 'py', gc_threshold=100)
+    vm.run()
+    out = io.StringIO()
+    vm.heap_snapshot(out)
+    snapshot = json.loads(out.getvalue())
+    assert snapshot['summary']['objects'] == 13
+    assert snapshot['roots'][0]['label'] == 'main#0.v0'
+    nodes = [obj for obj in snapshot['objects'] if obj['kind'] == 'struct']
+    assert all(obj['reachable'] for obj in nodes)
+    assert nodes[1]['path'] == ['main#0.v0', f'{nodes[0]["id"]}.next']
+
+def test_heap_snapshot_and_gc_stats_written_when_run_fails(tmp_path, capsys):
+    from mypl import run_normal_mode
+    program = (
+        'struct Node {\n'
+        '    Node next;\n'
+        '}\n'
+        'void main() {\n'
+        '    Node n = new Node(null);\n'
+        '    n = n.next.next;\n'
+        '}\n'
+    )
+    for engine in ['table', 'py']:
+        path = tmp_path / f'{engine}.json'
+        with pytest.raises(SystemExit):
+            run_normal_mode(FileWrapper(io.StringIO(program)), engine,
+                            gc_stats=True, heap_snapshot=str(path))
+        captured = capsys.readouterr()
+        assert 'null object' in captured.out
+        assert 'gc collections' in captured.err
+        snapshot = json.loads(path.read_text())
+        assert snapshot['roots'][0]['label'] == ('main#0.v0' if engine == 'py' else 'main#0.var0')
+        assert snapshot['summary']['reachable'] == 1
+
+def test_heap_limits_collect_then_raise_out_of_memory(capsys):
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'void main() {\n'
+        '    Node keep = null;\n'
+        '    for (int i = 0; i < 500; i = i + 1) {\n'
+        '        Node garbage = new Node(i, null);\n'
+        '    }\n'
+        '    for (int j = 0; j < 30; j = j + 1) {\n'
+        '        keep = new Node(j, keep);\n'
+        '    }\n'
+        '    print(keep.val);\n'
+        '    array int big = new int[100000000];\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        for gc in ['marksweep', 'copying']:
+            # garbage is collected to stay under the limits
+            vm = build_engine(program, engine, gc=gc, max_objects=40, max_heap_bytes=1024 ** 2)
+            with pytest.raises(MyPLError) as e:
+                vm.run()
+            assert capsys.readouterr().out == '29'
+            assert 'out of memory' in str(e.value) and '1048576 bytes' in str(e.value)
+            assert vm.heap_count() <= 40 and vm.collections > 0
+            # the live objects do not fit
+            vm = build_engine(program, engine, gc=gc, max_objects=20)
+            with pytest.raises(MyPLError) as e:
+                vm.run()
+            assert capsys.readouterr().out == ''
+            assert 'heap limit of 20 objects' in str(e.value)
+    assert parse_heap_limit('64MB') == ('bytes', 64 * 1024 ** 2)
+    assert parse_heap_limit('100000') == ('objects', 100000)
+
+def test_heap_refs_are_compact_handles():
+    vm = VM()
+    array = vm.alloc_array(2)
+    struct = vm.alloc_struct([None])
+    vm.set_index(array, 0, struct)
+    vm.set_field(struct, 0, 2024)
+    assert type(array) == HeapRef and type(vm.get_index(array, 0)) == HeapRef
+    assert array == 2024 and struct == 2025
+    # an int field value is not a reference
+    assert type(vm.get_field(struct, 0)) == int
+    assert vm.object_graph[array].references == {struct: 1}
+    assert vm.struct_heap[2025] is vm.struct_heap[struct]
+    assert sys.getsizeof(struct) < sys.getsizeof((2025, 'heap_object'))
+
+def test_object_graph_edges_counted_and_removed_on_overwrite(capsys):
+    vm = VM()
+    array = vm.alloc_array(3)
+    struct = vm.alloc_struct()
+    vm.set_index(array, 0, struct)
+    vm.set_index(array, 1, struct)
+    assert vm.object_graph[array].references == {struct: 2}
+    assert vm.object_graph[struct].parents == {array: 2}
+    vm.set_index(array, 0, None)
+    assert vm.object_graph[array].references == {struct: 1}
+    vm.set_index(array, 1, 7)
+    assert vm.object_graph[array].references == {}
+    assert vm.object_graph[struct].parents == {}
+    program = (
+        'struct Node {\n'
+        '    int val;\n'
+        '    Node next;\n'
+        '}\n'
+        'void main() {\n'
+        '    Node n = new Node(0, null);\n'
+        '    for (int i = 1; i < 1000; i = i + 1) {\n'
+        '        n.next = new Node(i, null);\n'
+        '    }\n'
+        '    print(n.next.val);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register']:
+        for gc in ['marksweep', 'generational', 'incremental']:
+            vm = build_engine(program, engine, gc=gc, gc_threshold=100, nursery_size=50)
+            vm.run()
+            assert capsys.readouterr().out == '999'
+            # the overwritten nodes are not kept reachable by stale edges
+            assert len(vm.object_graph) <= 200
+            assert max(len(obj.references) + len(obj.parents) for obj in vm.object_graph.values()) <= 1
+
+def test_escape_analysis_finds_local_structs():
+    program = (
+        'struct P {\n'
+        '    int x;\n'
+        '    P next;\n'
+        '}\n'
+        'P make() {\n'
+        '    P returned = new P(1, null);\n'
+        '    return returned;\n'
+        '}\n'
+        'int use(P p) {\n'
+        '    return p.x;\n'
+        '}\n'
+        'void main() {\n'
+        '    P local = new P(1, null);\n'
+        '    local = new P(local.x + 1, make());\n'
+        '    local.next.x = local.x;\n'
+        '    P passed = new P(2, null);\n'
+        '    int y = use(passed);\n'
+        '    P stored = new P(3, null);\n'
+        '    local.next.next = stored;\n'
+        '    P compared = new P(4, null);\n'
+        '    bool b = compared == null;\n'
+        '    P aliased = new P(5, null);\n'
+        '    P alias = aliased;\n'
+        '    P unset = null;\n'
+        '    unset = new P(6, null);\n'
+        '}\n'
+    )
+    program_ast = ASTParser(Lexer(FileWrapper(io.StringIO(program)))).parse()
+    analysis = EscapeAnalysis()
+    program_ast.accept(analysis)
+    names = {id(stmt): stmt.var_def.var_name.lexeme for fun in program_ast.fun_defs
+             for stmt in fun.stmts if isinstance(stmt, VarDecl)}
+    assert sorted(names[decl] for decl in analysis.replaced) == ['local']
+    # the reassignment, the two field stores, and the two field reads
+    assert len(analysis.uses) == 5
+
+def test_scalar_replacement_allocates_no_local_structs(capsys):
+    program = (
+        'struct Point {\n'
+        '    int x;\n'
+        '    int y;\n'
+        '}\n'
+        'int dist(int x1, int y1, int x2, int y2) {\n'
+        '    Point d = new Point(x2 - x1, y2 - y1);\n'
+        '    if (d.x < 0) {\n'
+        '        d.x = 0 - d.x;\n'
+        '    }\n'
+        '    d = new Point(d.y, d.x);\n'
+        '    if (d.x < 0) {\n'
+        '        d.x = 0 - d.x;\n'
+        '    }\n'
+        '    return d.x + d.y;\n'
+        '}\n'
+        'void main() {\n'
+        '    int total = 0;\n'
+        '    for (int i = 0; i < 10; i = i + 1) {\n'
+        '        total = total + dist(i, 0, 0, i);\n'
+        '    }\n'
+        '    print(total);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register', 'py']:
+        for scalar_replace in [False, True]:
+            vm = build_engine(program, engine, scalar_replace=scalar_replace)
+            vm.run()
+            assert capsys.readouterr().out == '90'
+            assert vm.next_obj_id - 2024 == (0 if scalar_replace else 20)
+
+def test_structs_are_slot_lists_with_field_offsets(capsys):
+    program = (
+        'struct Pair {\n'
+        '    int a;\n'
+        '    Pair rest;\n'
+        '}\n'
+        'struct Wrap {\n'
+        '    Pair rest;\n'
+        '    int a;\n'
+        '}\n'
+        'void main() {\n'
+        '    Pair p = new Pair(1, new Pair(2, null));\n'
+        '    Wrap w = new Wrap(p, 3);\n'
+        '    w.rest.rest.a = w.a + p.a;\n'
+        '    print(p.rest.a);\n'
+        '}\n'
+    )
+    for engine in ['table', 'closure', 'register', 'py']:
+        build_engine(program, engine).run()
+        assert capsys.readouterr().out == '4'
+    # field names resolve to offsets in the field's own struct type
+    vm = build_engine(program, 'table')
+    instrs = vm.frame_templates['main'].instructions
+    assert [i.operand for i in instrs if i.opcode == OpCode.NEWS] == ['Pair', 'Pair', 'Wrap']
+    assert vm.struct_types['Wrap'].fields == ('rest', 'a')
+    assert [i.operand for i in instrs if i.opcode == OpCode.GETF] == [0, 1, 1, 0, 1, 0]
+    assert [i.operand for i in instrs if i.opcode == OpCode.SETF] == [0]
+    vm = VM(engine='table', gc='refcount')
+    child = vm.alloc_struct([2, None])
+    parent = vm.alloc_struct([1, child])
+    assert type(vm.struct_heap[parent]) == Struct and vm.struct_heap[parent] == [1, child]
+    assert vm.object_graph[child].parents == {parent: 1}
+    assert vm.object_graph[child].ref_count == 1